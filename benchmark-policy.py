@@ -0,0 +1,62 @@
+"""
+Report how long compiling an STS policy takes, and how large the policies are,
+for a user with a growing number of foreign workspaces.
+Usage: python benchmark-policy.py [max workspaces]
+"""
+import os
+import sys
+import time
+import uuid
+
+for name in ["WIO_OIDC_CLIENT_ID", "WIO_OIDC_CLIENT_SECRET", "WIO_OIDC_WELL_KNOWN_URL"]:
+    os.environ.setdefault(name, "benchmark")
+
+from workspacesio import models, s3policy  # noqa: E402
+from workspacesio.common import schemas  # noqa: E402
+from workspacesio.indexing import models as indexing_models  # noqa: E402,F401
+
+
+def constellation(count: int):
+    node = models.StorageNode(id=uuid.uuid4(), api_url="http://minio:9000")
+    root = models.WorkspaceRoot(
+        id=uuid.uuid4(),
+        bucket="fast",
+        base_path="private",
+        root_type=schemas.RootType.PRIVATE,
+        storage_node=node,
+    )
+    user = models.User(id=uuid.uuid4(), username="benchmark")
+    owners = [models.User(id=uuid.uuid4(), username=f"owner{i}") for i in range(10)]
+    mine = [models.Workspace(id=uuid.uuid4(), name="home", owner=user, root=root)]
+    mine[0].owner_id = user.id
+    foreign = []
+    for i in range(count):
+        owner = owners[i % len(owners)]
+        workspace = models.Workspace(
+            id=uuid.uuid4(), name=f"workspace{i}", owner=owner, root=root
+        )
+        workspace.owner_id = owner.id
+        permission = schemas.ShareType.READWRITE if i % 2 else schemas.ShareType.READ
+        foreign.append((workspace, models.Share(permission=permission)))
+    return user, mine, foreign
+
+
+def main(largest: int):
+    print(f"{'workspaces':>10} {'policies':>8} {'bytes':>8} {'largest':>8} {'ms':>8}")
+    count = 1
+    while count <= largest:
+        user, mine, foreign = constellation(count)
+        s3policy.compiled_policies.clear()
+        started = time.perf_counter()
+        compiled = s3policy.compilePolicies(user, mine, foreign, key=count)
+        elapsed = (time.perf_counter() - started) * 1000
+        sizes = [s3policy._size(policy) for _, policy in compiled]
+        print(
+            f"{count:>10} {len(compiled):>8} {sum(sizes):>8} "
+            f"{max(sizes):>8} {elapsed:>8.1f}"
+        )
+        count *= 4
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1024)
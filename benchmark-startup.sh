@@ -0,0 +1,14 @@
+#!/bin/bash
+# Report how long the wio cli spends importing modules for common commands.
+# Usage: ./benchmark-startup.sh [python]
+
+PYTHON=${1:-python}
+
+for args in "--help" "mc --help" "token fetch --help" "credential-process --help" "search --help" "workspace ls --help"; do
+    $PYTHON -X importtime -c "from workspacesio.cli import cli; cli()" $args 2>&1 >/dev/null \
+        | awk -F'|' -v args="$args" '
+            /^import time:/ && $2 !~ /cumulative/ {
+                split($1, self, ":"); total += self[2]; modules += 1
+            }
+            END { printf "%-30s %4d modules %8.1f ms\n", "wio " args, modules, total / 1000 }'
+done
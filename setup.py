@@ -17,8 +17,10 @@ deps = [
     "fastapi-contrib",
     "ffmpeg-python",
     "gunicorn",
+    "httpx",
     "jinja2",
     "minio",
+    "msgpack",
     "psycopg2-binary",
     "pydantic",
     "pyjwt",
@@ -30,6 +32,10 @@ deps = [
     "uvicorn",
 ]
 
+extras = {
+    "fsspec": ["fsspec", "s3fs"],
+}
+
 setup(
     name="workspacesio",
     version="0.1.0",
@@ -37,12 +43,17 @@ setup(
     python_requires=">3.7",
     zip_safe=False,
     install_requires=deps,
+    extras_require=extras,
     include_package_data=True,
     packages=find_packages(exclude=["test"]),
     entry_points={
         "console_scripts": [
             "wio=workspacesio.cli:cli",
             "workspaces-create-tables=workspacesio.dev_cli:main",
+            "workspaces-event-worker=workspacesio.indexing.worker:main",
+        ],
+        "fsspec.specs": [
+            "wio=workspacesio.sdk.filesystem:WioFileSystem",
         ],
     },
 )
@@ -0,0 +1,38 @@
+import os
+
+for name in ["WIO_OIDC_CLIENT_ID", "WIO_OIDC_CLIENT_SECRET", "WIO_OIDC_WELL_KNOWN_URL"]:
+    os.environ.setdefault(name, "test")
+
+import pytest  # noqa: E402
+from sqlalchemy import create_engine  # noqa: E402
+from sqlalchemy.dialects.postgresql import JSONB, UUID  # noqa: E402
+from sqlalchemy.ext.compiler import compiles  # noqa: E402
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from workspacesio import dbutils, models  # noqa: E402
+from workspacesio.indexing import models as indexing_models  # noqa: E402,F401
+
+
+@compiles(UUID, "sqlite")
+def _compile_uuid(type_, compiler, **kw):
+    return "CHAR(36)"
+
+
+@compiles(JSONB, "sqlite")
+def _compile_jsonb(type_, compiler, **kw):
+    return "JSON"
+
+
+@pytest.fixture
+def engine():
+    engine = create_engine("sqlite://")
+    models.Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def db(engine):
+    session = sessionmaker(bind=engine)(query_cls=dbutils.Query)
+    yield session
+    session.close()
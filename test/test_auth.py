@@ -0,0 +1,27 @@
+import pytest
+from fastapi import HTTPException
+from fastapi.security import HTTPBasicCredentials
+
+from workspacesio import auth, crud, models
+
+
+def login(db, key_id: str, secret: str) -> models.User:
+    credentials = HTTPBasicCredentials(username=key_id, password=secret)
+    return auth.get_current_user(session_cookie=None, credentials=credentials, db=db)
+
+
+def test_deleted_apikey_is_rejected_while_cached(db):
+    user = models.User(sub="sub", username="alice", email="a")
+    db.add(user)
+    db.commit()
+    key = crud.apikey_create(db, user)
+    auth.apikey_cache.clear()
+    assert login(db, key.key_id, key.secret).id == user.id
+    assert login(db, key.key_id, key.secret).id == user.id
+
+    # Deleted through another worker, whose cache invalidation never reaches here
+    db.query(models.ApiKey).delete()
+    db.commit()
+    with pytest.raises(HTTPException) as raised:
+        login(db, key.key_id, key.secret)
+    assert raised.value.status_code == 401
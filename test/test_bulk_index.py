@@ -0,0 +1,76 @@
+import datetime
+
+from sqlalchemy.orm import sessionmaker
+
+from workspacesio import dbutils, models
+from workspacesio.common import indexing_schemas, schemas
+from workspacesio.indexing import crud
+from workspacesio.indexing import models as indexing_models
+
+
+class FakeElasticsearch:
+    def bulk(self, body):
+        return {"errors": False}
+
+
+def make_crawl(db):
+    operator = models.User(sub="operator", username="operator", email="o")
+    db.add(operator)
+    db.flush()
+    node = models.StorageNode(
+        name="node",
+        api_url="http://minio:9000",
+        creator_id=operator.id,
+        access_key_id="access",
+        secret_access_key="secret",
+    )
+    db.add(node)
+    db.flush()
+    root = models.WorkspaceRoot(
+        node_id=node.id,
+        root_type=schemas.RootType.PRIVATE,
+        bucket="fast",
+        base_path="private",
+    )
+    db.add(root)
+    db.flush()
+    workspace = models.Workspace(name="home", owner_id=operator.id, root_id=root.id)
+    db.add(workspace)
+    db.add(indexing_models.RootIndex(root_id=root.id, index_type="wio"))
+    db.flush()
+    crawl = indexing_models.WorkspaceCrawlRound(workspace_id=workspace.id)
+    db.add(crawl)
+    db.commit()
+    return operator, workspace.id, crawl.id
+
+
+def document(path: str, size: int) -> indexing_schemas.IndexDocumentBase:
+    return indexing_schemas.IndexDocumentBase(
+        time=datetime.datetime(2020, 1, 1),
+        size=size,
+        eTag="etag",
+        path=path,
+        filename=path,
+        extension="",
+    )
+
+
+def test_interleaved_writers_both_count(engine, db):
+    operator, workspace_id, crawl_id = make_crawl(db)
+    other = sessionmaker(bind=engine)(query_cls=dbutils.Query)
+    try:
+        # Both writers load the crawl round before either finishes
+        first = crud.BulkIndexWriter(db, FakeElasticsearch(), operator, workspace_id)
+        second = crud.BulkIndexWriter(
+            other, FakeElasticsearch(), operator, workspace_id
+        )
+        first.add_many([document("a", 1), document("b", 2)])
+        second.add_many([document("c", 4)])
+        first.finish()
+        second.finish()
+    finally:
+        other.close()
+    db.expire_all()
+    crawl = db.query(indexing_models.WorkspaceCrawlRound).get(crawl_id)
+    assert crawl.total_objects == 3
+    assert crawl.total_size == 7
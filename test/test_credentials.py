@@ -0,0 +1,24 @@
+from datetime import timedelta
+from types import SimpleNamespace
+
+from workspacesio.cli import credentials, mc
+from workspacesio.common import schemas
+
+
+def test_misses_are_cached_briefly(tmp_path, monkeypatch):
+    ctx = SimpleNamespace(config=SimpleNamespace(api_url="http://wio", access_key="a"))
+    cache = credentials.CredentialCache(ctx, str(tmp_path))
+    cache.put(["nothing"], schemas.S3TokenSearchResponse(tokens=[], workspaces={}))
+    cached = credentials.CredentialCache(ctx, str(tmp_path)).get(["nothing"])
+    assert cached is not None and cached.workspaces == {}
+
+    later = credentials._now() + credentials.MISS_TTL + timedelta(seconds=1)
+    monkeypatch.setattr(credentials, "_now", lambda: later)
+    assert credentials.CredentialCache(ctx, str(tmp_path)).get(["nothing"]) is None
+
+
+def test_mc_searches_only_possible_workspaces(tmp_path):
+    local = str(tmp_path)
+    args = ["cp", "--recursive", local, "alice/data/"]
+    assert mc.transform_arguments(args) == ["alice/data/"]
+    assert mc.transform_arguments(["alias", "list"]) == []
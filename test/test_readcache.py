@@ -0,0 +1,50 @@
+import itertools
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from workspacesio.cli import readcache
+
+
+@pytest.fixture(autouse=True)
+def clock(monkeypatch):
+    """A clock that always moves forward, so last use is never tied"""
+    ticks = itertools.count(1)
+    monkeypatch.setattr(readcache, "time", SimpleNamespace(time=lambda: next(ticks)))
+
+
+def download(tmp_path, name: str, size: int) -> str:
+    path = tmp_path / name
+    path.write_bytes(os.urandom(size))
+    return str(path)
+
+
+def test_put_larger_than_budget_returns_source(tmp_path):
+    with readcache.ReadCache(10, str(tmp_path / "cache")) as cache:
+        source = download(tmp_path, "big", 100)
+        assert cache.put("http://s3", "bucket", "big", "etag", source) == source
+        assert os.path.exists(source)
+        assert cache.get("http://s3", "bucket", "big", "etag") is None
+
+
+def test_put_evicts_older_objects_but_not_the_new_one(tmp_path):
+    with readcache.ReadCache(150, str(tmp_path / "cache")) as cache:
+        first = cache.put("http://s3", "bucket", "a", "1", download(tmp_path, "a", 100))
+        second = cache.put(
+            "http://s3", "bucket", "b", "1", download(tmp_path, "b", 100)
+        )
+        assert not os.path.exists(first)
+        assert os.path.exists(second)
+        assert cache.get("http://s3", "bucket", "a", "1") is None
+        assert cache.get("http://s3", "bucket", "b", "1") == second
+
+
+def test_get_refreshes_last_use(tmp_path):
+    with readcache.ReadCache(250, str(tmp_path / "cache")) as cache:
+        a = cache.put("http://s3", "bucket", "a", "1", download(tmp_path, "a", 100))
+        cache.put("http://s3", "bucket", "b", "1", download(tmp_path, "b", 100))
+        assert cache.get("http://s3", "bucket", "a", "1") == a
+        cache.put("http://s3", "bucket", "c", "1", download(tmp_path, "c", 100))
+        assert cache.get("http://s3", "bucket", "a", "1") == a
+        assert cache.get("http://s3", "bucket", "b", "1") is None
@@ -0,0 +1,67 @@
+import datetime
+import gzip
+import json
+
+import msgpack
+import pytest
+
+from workspacesio.indexing.crud import RecordDecoder
+
+
+def record(path: str) -> dict:
+    return {
+        "time": datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc),
+        "size": 1,
+        "eTag": "etag",
+        "path": path,
+        "filename": path,
+        "extension": "",
+    }
+
+
+def ndjson(paths) -> bytes:
+    lines = [json.dumps(record(p), default=str) for p in paths]
+    return "\n".join(lines).encode("utf-8")
+
+
+def decode(decoder: RecordDecoder, body: bytes, chunk_size: int = 7):
+    records = []
+    for i in range(0, len(body), chunk_size):
+        records += decoder.feed(body[i : i + chunk_size])
+    return [r.path for r in records + decoder.close()]
+
+
+@pytest.mark.parametrize("encoding", [None, "gzip"])
+def test_ndjson_split_across_chunks(encoding):
+    body = ndjson(["a", "b", "c"])
+    if encoding == "gzip":
+        body = gzip.compress(body)
+    decoder = RecordDecoder("application/x-ndjson; charset=utf-8", encoding)
+    assert decode(decoder, body) == ["a", "b", "c"]
+
+
+def test_msgpack():
+    body = b"".join(msgpack.packb(record(p), datetime=True) for p in ["a", "b"])
+    assert decode(RecordDecoder("application/msgpack"), body) == ["a", "b"]
+
+
+def test_truncated_streams():
+    with pytest.raises(ValueError, match="Truncated gzip"):
+        decode(
+            RecordDecoder("application/x-ndjson", "gzip"),
+            gzip.compress(ndjson(["a"]))[:-4],
+        )
+    packed = msgpack.packb(record("a"), datetime=True)
+    with pytest.raises(ValueError, match="Truncated msgpack"):
+        decode(RecordDecoder("application/msgpack"), packed[:-2])
+
+
+def test_invalid_input():
+    with pytest.raises(ValueError, match="Invalid record"):
+        decode(RecordDecoder("application/x-ndjson"), b'{"path": "a"}\n')
+    with pytest.raises(ValueError, match="Invalid gzip"):
+        decode(RecordDecoder("application/x-ndjson", "gzip"), b"not gzip at all")
+    with pytest.raises(ValueError):
+        RecordDecoder("application/json")
+    with pytest.raises(ValueError):
+        RecordDecoder("application/x-ndjson", "br")
@@ -0,0 +1,100 @@
+import uuid
+from typing import List, Set, Tuple
+
+import pytest
+
+from workspacesio import models, s3policy
+from workspacesio.common import schemas
+from workspacesio.settings import settings
+
+
+@pytest.fixture(autouse=True)
+def no_memo():
+    s3policy.compiled_policies.clear()
+    yield
+    s3policy.compiled_policies.clear()
+
+
+def constellation(count: int):
+    node = models.StorageNode(id=uuid.uuid4(), api_url="http://minio:9000")
+    root = models.WorkspaceRoot(
+        id=uuid.uuid4(),
+        bucket="fast",
+        base_path="private",
+        root_type=schemas.RootType.PRIVATE,
+        storage_node=node,
+    )
+    user = models.User(id=uuid.uuid4(), username="user")
+    owners = [models.User(id=uuid.uuid4(), username=f"owner{i}") for i in range(3)]
+    mine = [models.Workspace(id=uuid.uuid4(), name="home", owner=user, root=root)]
+    mine[0].owner_id = user.id
+    foreign = []
+    for i in range(count):
+        owner = owners[i % len(owners)]
+        workspace = models.Workspace(
+            id=uuid.uuid4(), name=f"workspace{i}", owner=owner, root=root
+        )
+        workspace.owner_id = owner.id
+        permission = schemas.ShareType.READWRITE if i % 2 else schemas.ShareType.READ
+        foreign.append((workspace, models.Share(permission=permission)))
+    return user, mine, foreign
+
+
+def grants(policy: s3policy.PolicyDoc) -> Set[Tuple[str, str, str]]:
+    """(action, resource, prefix) for everything a policy allows explicitly"""
+    granted = set()
+    for statement in policy["Statement"]:
+        prefixes: List[str] = [""]
+        if "Condition" in statement:
+            prefixes = s3policy._as_list(
+                statement["Condition"]["StringLike"]["s3:prefix"]
+            )
+        for action in s3policy._as_list(statement["Action"]):
+            for resource in s3policy._as_list(statement["Resource"]):
+                for prefix in prefixes:
+                    granted.add((action, resource, prefix))
+    return granted
+
+
+def allowed(
+    granted: Set[Tuple[str, str, str]], action: str, resource: str, prefix: str
+):
+    return any(
+        a in (action, "s3:*")
+        and s3policy._covers(r, resource)
+        and s3policy._covers(p, prefix)
+        for a, r, p in granted
+    )
+
+
+def test_compact_policy_grants_the_same_access():
+    user, mine, foreign = constellation(6)
+    policy = s3policy.makePolicy(user, mine, foreign)
+    compact = s3policy.compactPolicy(policy)
+    assert s3policy._size(compact) < s3policy._size(policy)
+    before, after = grants(policy), grants(compact)
+    assert all(allowed(after, *grant) for grant in before)
+    assert all(allowed(before, *grant) for grant in after)
+
+
+def test_compile_policies_splits_under_the_limit(monkeypatch):
+    user, mine, foreign = constellation(12)
+    whole = s3policy.compactPolicy(s3policy.makePolicy(user, mine, foreign))
+    max_bytes = s3policy._size(whole) // 3
+    monkeypatch.setattr(settings, "sts_policy_max_bytes", max_bytes)
+    compiled = s3policy.compilePolicies(user, mine, foreign, key="split")
+    assert len(compiled) > 1
+    assert all(s3policy._size(policy) <= max_bytes for _, policy in compiled)
+    # Every foreign workspace is covered by exactly one policy
+    covered = [w.id for chunk, _ in compiled for w, _ in chunk]
+    assert sorted(covered) == sorted(w.id for w, _ in foreign)
+    # Only the first policy covers the user's own workspace
+    home = s3policy.compactPolicy(s3policy.makePolicy(user, mine, []))
+    for i, (_, policy) in enumerate(compiled):
+        assert all(allowed(grants(policy), *g) for g in grants(home)) == (i == 0)
+    # The same constellation splits the same way, in any order
+    s3policy.compiled_policies.clear()
+    again = s3policy.compilePolicies(user, mine, list(reversed(foreign)), key="split")
+    assert [[w.id for w, _ in chunk] for chunk, _ in again] == [
+        [w.id for w, _ in chunk] for chunk, _ in compiled
+    ]
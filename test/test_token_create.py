@@ -0,0 +1,133 @@
+import datetime
+import uuid
+from contextlib import contextmanager
+from typing import List
+
+import pytest
+from sqlalchemy import event
+
+from workspacesio import crud, models, s3policy
+from workspacesio.common import schemas
+from workspacesio.settings import settings
+
+
+@contextmanager
+def count_queries(engine):
+    statements: List[str] = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture(autouse=True)
+def no_sts(monkeypatch):
+    def assume_role(b3, node, requester_id, policy):
+        return {
+            "AccessKeyId": "access",
+            "SecretAccessKey": "secret",
+            "SessionToken": "session",
+            "Expiration": datetime.datetime.utcnow() + datetime.timedelta(hours=1),
+        }
+
+    monkeypatch.setattr(crud, "assume_role", assume_role)
+    # Advisory locks are postgres only
+    monkeypatch.setattr(crud, "lock_constellation", lambda *args, **kwargs: True)
+    # One token per node, however many workspaces are shared
+    monkeypatch.setattr(settings, "sts_policy_max_bytes", 0)
+    s3policy.compiled_policies.clear()
+
+
+def make_constellation(db, shared: int):
+    """
+    A requester with one workspace, and `shared` workspaces shared with them,
+    each with its own owner and root so that nothing is loaded only once
+    """
+    requester = models.User(sub="requester", username="requester", email="r")
+    db.add(requester)
+    db.flush()
+    node = models.StorageNode(
+        name="node",
+        api_url="http://minio:9000",
+        creator_id=requester.id,
+        access_key_id="access",
+        secret_access_key="secret",
+    )
+    db.add(node)
+    db.flush()
+    owners = [requester]
+    for i in range(shared):
+        owners.append(models.User(sub=f"owner{i}", username=f"owner{i}", email=f"{i}"))
+    db.add_all(owners)
+    db.flush()
+    workspaces = []
+    for i, owner in enumerate(owners):
+        root = models.WorkspaceRoot(
+            node_id=node.id,
+            root_type=schemas.RootType.PRIVATE,
+            bucket="fast",
+            base_path=f"private{i}",
+        )
+        db.add(root)
+        db.flush()
+        workspaces.append(
+            models.Workspace(name=f"workspace{i}", owner_id=owner.id, root_id=root.id)
+        )
+    db.add_all(workspaces)
+    db.flush()
+    for owner, workspace in zip(owners[1:], workspaces[1:]):
+        db.add(
+            models.Share(
+                workspace_id=workspace.id,
+                creator_id=owner.id,
+                sharee_id=requester.id,
+                permission=schemas.ShareType.READ,
+            )
+        )
+    db.commit()
+    request = schemas.S3TokenCreate(workspaces=[w.id for w in workspaces])
+    return requester.id, request
+
+
+def fresh_requester(db, requester_id: uuid.UUID) -> models.User:
+    """The requester, with nothing else left over in the identity map"""
+    db.expunge_all()
+    return db.query(models.User).get(requester_id)
+
+
+def token_create_queries(engine, db, shared: int):
+    requester_id, request = make_constellation(db, shared)
+    requester = fresh_requester(db, requester_id)
+    with count_queries(engine) as issued:
+        created = crud.token_create(db, None, requester, request)
+    requester = fresh_requester(db, requester_id)
+    with count_queries(engine) as reused:
+        again = crud.token_create(db, None, requester, request)
+    assert len(created) == len(again) == 1
+    assert set(created[0].workspace_ids) == set(request.workspaces)
+    assert created[0].token.id == again[0].token.id
+    return len(issued), len(reused)
+
+
+def test_token_create_query_count_is_constant(engine, db):
+    few = token_create_queries(engine, db, shared=2)
+    for table in reversed(models.Base.metadata.sorted_tables):
+        db.execute(table.delete())
+    db.commit()
+    s3policy.compiled_policies.clear()
+    many = token_create_queries(engine, db, shared=20)
+    # Issuing and reusing a token each cost the same, however many are shared
+    assert few == many
+
+
+def test_token_create_missing_workspaces(engine, db):
+    requester = fresh_requester(db, make_constellation(db, shared=0)[0])
+    request = schemas.S3TokenCreate(workspaces=[uuid.uuid4()])
+    with count_queries(engine) as statements:
+        assert crud.token_create(db, None, requester, request) == []
+    assert len(statements) == 1
@@ -0,0 +1,89 @@
+import json
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from workspacesio.cli import transfer
+
+MIB = 1024 * 1024
+
+
+@pytest.fixture
+def s3():
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        yield client
+
+
+def engine(
+    s3, tmp_path, part_size: int, concurrency: int = 2
+) -> transfer.TransferEngine:
+    return transfer.TransferEngine(
+        s3,
+        part_size=part_size,
+        concurrency=concurrency,
+        journal_dir=str(tmp_path / "journal"),
+    )
+
+
+def write(path, size: int) -> bytes:
+    data = os.urandom(size)
+    path.write_bytes(data)
+    return data
+
+
+def test_download_verifies_with_uploaded_part_size(s3, tmp_path):
+    source = tmp_path / "source"
+    data = write(source, 12 * MIB)
+    # Two 7 MiB parts up, and two 8 MiB parts down
+    with engine(s3, tmp_path, 7 * MIB) as uploader:
+        etag = uploader.upload(str(source), "bucket", "key")
+    assert etag.endswith("-2")
+    target = tmp_path / "target"
+    with engine(s3, tmp_path, 8 * MIB) as downloader:
+        assert downloader.download("bucket", "key", str(target)) == etag
+    assert target.read_bytes() == data
+
+
+def test_verify_rejects_corrupt_download(s3, tmp_path):
+    source = tmp_path / "source"
+    write(source, 1024)
+    with engine(s3, tmp_path, 8 * MIB) as e:
+        etag = e.upload(str(source), "bucket", "key")
+        corrupt = tmp_path / "corrupt"
+        write(corrupt, 1024)
+        with pytest.raises(transfer.TransferError):
+            e._verify(str(corrupt), "bucket", "key", etag, 1024)
+    assert not corrupt.exists()
+
+
+def test_interrupted_upload_resumes_from_journal(s3, tmp_path, monkeypatch):
+    source = tmp_path / "source"
+    data = write(source, 16 * MIB)
+    sent = []
+    upload_part = transfer.TransferEngine._upload_part
+
+    def flaky_upload_part(self, path, bucket, key, upload_id, n, part_size):
+        if n == 3 and not sent.count(3):
+            sent.append(3)
+            raise ConnectionError("interrupted")
+        sent.append(n)
+        return upload_part(self, path, bucket, key, upload_id, n, part_size)
+
+    monkeypatch.setattr(transfer.TransferEngine, "_upload_part", flaky_upload_part)
+    # One part at a time, so the parts before the failure are recorded
+    with engine(s3, tmp_path, 5 * MIB, concurrency=1) as e:
+        with pytest.raises(ConnectionError):
+            e.upload(str(source), "bucket", "key")
+    (journal,) = (tmp_path / "journal").glob("upload-*.json")
+    recorded = {int(n) for n in json.loads(journal.read_text())["parts"]}
+    assert recorded and 3 not in recorded
+    first = len(sent)
+    with engine(s3, tmp_path, 5 * MIB) as e:
+        e.upload(str(source), "bucket", "key")
+    # Parts the journal recorded are not sent again
+    assert sorted(sent[first:]) == sorted({1, 2, 3, 4} - recorded)
+    assert s3.get_object(Bucket="bucket", Key="key")["Body"].read() == data
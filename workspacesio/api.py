@@ -172,7 +172,7 @@ def delete_all_keys(
     user: models.User = Depends(auth.get_current_user),
     db: database.SessionLocal = Depends(get_db),
 ):
-    return crud.apikey_delete_all(db, user)
+    auth.invalidate_apikeys(crud.apikey_delete_all(db, user))
 
 
 @router.post(
@@ -220,6 +220,14 @@ def search_token(
     return crud.token_search(db, boto_sts, user, terms)
 
 
+@router.post("/token/sweep", tags=["token"], response_model=int)
+def sweep_tokens(
+    db: database.SessionLocal = Depends(get_db),
+    user: models.User = Depends(auth.get_admin_user),
+):
+    return crud.token_sweep_expired(db)
+
+
 @router.delete("/token/{token_id}", tags=["token"])
 def revoke_token(
     token_id: uuid.UUID,
@@ -9,7 +9,7 @@ from sqlalchemy.orm import Session
 
 from workspacesio.common import schemas
 
-from . import api, auth, crud, database, depends, indexing, models, settings
+from . import api, auth, crud, database, depends, indexing, models, settings, tasks
 
 
 def create_app(env: typing.Dict[str, str]) -> FastAPI:
@@ -25,5 +25,25 @@ def create_app(env: typing.Dict[str, str]) -> FastAPI:
     else:
         logger.error("ERROR:\tStatic directory not found.")
 
+    @app.on_event("startup")
+    def startup():
+        depends.open_elastic_client()
+        auth.open_http_client()
+        auth.oidc_cache.refresh_in_background()
+        if settings.settings.token_refresh_interval > 0:
+            tasks.token_refresher.start()
+        if settings.settings.token_sweep_interval > 0:
+            tasks.token_sweeper.start()
+        if settings.settings.event_worker_interval > 0:
+            tasks.event_worker.start()
+
+    @app.on_event("shutdown")
+    async def shutdown():
+        tasks.token_refresher.stop()
+        tasks.token_sweeper.stop()
+        tasks.event_worker.stop()
+        depends.close_elastic_client()
+        await auth.close_http_client()
+
     crud.register_handlers(app)
     return app
@@ -1,14 +1,20 @@
+import asyncio
 import datetime
+import hashlib
+import hmac
 import json
+import logging
 import secrets
+import threading
+import time
 import uuid
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import Any, Dict, Iterable, List, Optional, Tuple, Union
 
 import bcrypt
+import httpx
 import jwt
 import jwt.algorithms
 import jwt.exceptions
-import requests
 import uvicorn
 from fastapi import Depends, Header, HTTPException, Request, status
 from fastapi.responses import RedirectResponse
@@ -17,8 +23,10 @@ from fastapi.security import APIKeyCookie, HTTPBasic, HTTPBasicCredentials
 from fastapi.security.utils import get_authorization_scheme_param
 from pydantic import BaseModel
 from sqlalchemy import and_
+from sqlalchemy.orm import make_transient_to_detached
+from starlette.concurrency import run_in_threadpool
 
-from workspacesio import database, depends, models
+from workspacesio import cache, database, depends, models
 from workspacesio.common import schemas
 from workspacesio.settings import settings
 from workspacesio.utils import build_url
@@ -69,36 +77,132 @@ class OIDCConfig(BaseModel):
 router = APIRouter()
 sessioncookie = APIKeyCookie(name="session", auto_error=False)
 security = HTTPBasic(auto_error=False)
-oidc_conf: Union[OIDCConfig, None] = None
+# (key_id, secret digest) -> (primary key of the key, column values of its user)
+apikey_cache = cache.TTLCache(
+    maxsize=settings.apikey_cache_size, ttl=settings.apikey_cache_ttl
+)
+# sha256 of session token -> decoded JWToken, until the token expires
+session_cache = cache.TTLCache(maxsize=settings.session_cache_size)
+# oidc sub -> column values of the user
+session_user_cache = cache.TTLCache(
+    maxsize=settings.session_cache_size, ttl=settings.session_cache_ttl
+)
+logger = logging.getLogger("auth")
+# Pooled client for talking to the identity provider, opened on startup
+http_client: Optional[httpx.AsyncClient] = None
+
+# Minimum seconds between refetches triggered by an unknown key ID
+JWKS_REFETCH_INTERVAL = 30
+# Seconds to remember tokens that failed verification
+UNVERIFIED_SESSION_TTL = 60
+
+
+def open_http_client() -> httpx.AsyncClient:
+    """Create the identity provider client.  Must be called from the event loop."""
+    global http_client
+    if http_client is None:
+        http_client = httpx.AsyncClient(
+            timeout=settings.oidc_timeout,
+            limits=httpx.Limits(max_connections=settings.oidc_max_connections),
+        )
+        oidc_cache.loop = asyncio.get_event_loop()
+    return http_client
 
 
-def _openid_config():
-    global oidc_conf
-    if oidc_conf is None:
-        wellknown_resp = requests.get(settings.oidc_well_known_url)
-        wellknown_resp.raise_for_status()
-        wellknown = OIDCWellKnown(**wellknown_resp.json())
+async def close_http_client():
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
 
-        keys_resp = requests.get(wellknown.jwks_uri)
-        keys_resp.raise_for_status()
-        keys = OIDCKeys(**keys_resp.json())
 
-        public_keys: Dict[str, Any] = {}
-        for jwk in keys.keys:
-            kid = jwk["kid"]
-            public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+async def _fetch_openid_config(client: httpx.AsyncClient) -> OIDCConfig:
+    wellknown_resp = await client.get(settings.oidc_well_known_url)
+    wellknown_resp.raise_for_status()
+    wellknown = OIDCWellKnown(**wellknown_resp.json())
 
-        oidc_conf = OIDCConfig(
-            well_known=wellknown,
-            keys=public_keys,
-        )
-    yield oidc_conf
+    keys_resp = await client.get(wellknown.jwks_uri)
+    keys_resp.raise_for_status()
+    keys = OIDCKeys(**keys_resp.json())
+
+    public_keys: Dict[str, Any] = {}
+    for jwk in keys.keys:
+        kid = jwk["kid"]
+        public_keys[kid] = jwt.algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))
+
+    return OIDCConfig(
+        well_known=wellknown,
+        keys=public_keys,
+    )
+
+
+class OIDCConfigCache:
+    """
+    Discovery document and signing keys for the identity provider.
+
+    Once the first fetch succeeds, requests are always served from memory.
+    Expired configs and unknown key IDs schedule a refetch on the event loop,
+    which may be requested from any thread.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.config: Optional[OIDCConfig] = None
+        self.fetched = 0.0
+        self.last_attempt = 0.0
+        self.refreshing = False
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.lock = threading.Lock()
+
+    async def refresh(self):
+        try:
+            config = await _fetch_openid_config(open_http_client())
+            with self.lock:
+                self.config = config
+                self.fetched = time.monotonic()
+        except httpx.HTTPError:
+            logger.exception("Failed to fetch openid config")
+        finally:
+            with self.lock:
+                self.refreshing = False
+
+    def refresh_in_background(self):
+        with self.lock:
+            now = time.monotonic()
+            if self.loop is None or self.refreshing:
+                return
+            if now - self.last_attempt < JWKS_REFETCH_INTERVAL:
+                return
+            self.refreshing = True
+            self.last_attempt = now
+        asyncio.run_coroutine_threadsafe(self.refresh(), self.loop)
+
+    async def get(self) -> OIDCConfig:
+        if self.config is None:
+            # Nothing to serve yet, so the first fetch has to be awaited
+            await self.refresh()
+            if self.config is None:
+                raise HTTPException(
+                    status.HTTP_503_SERVICE_UNAVAILABLE, "openid config unavailable"
+                )
+        elif time.monotonic() - self.fetched > self.ttl:
+            self.refresh_in_background()
+        return self.config
+
+
+oidc_cache = OIDCConfigCache(ttl=settings.oidc_jwks_ttl)
+
+
+async def _openid_config() -> OIDCConfig:
+    return await oidc_cache.get()
 
 
 def _verify_jwt(token: str, config: OIDCConfig, verify=True) -> JWToken:
     kid = jwt.get_unverified_header(token)["kid"]
     key = config.keys.get(kid)
     if key is None:
+        # The provider may have rotated its keys
+        oidc_cache.refresh_in_background()
         raise HTTPException(
             status.HTTP_400_BAD_REQUEST, "key ID not found in openid config"
         )
@@ -120,6 +224,33 @@ def _verify_token(token, hashed_token):
     pass
 
 
+def _secret_digest(secret: str) -> str:
+    """Keyed digest so that plaintext secrets are never held in memory"""
+    return hmac.new(
+        settings.secret.encode("utf-8"), secret.encode("utf-8"), hashlib.sha256
+    ).hexdigest()
+
+
+def _user_snapshot(user: models.User) -> Dict[str, Any]:
+    return {c.key: getattr(user, c.key) for c in models.User.__table__.columns}
+
+
+def _attach_user(db: database.SessionLocal, snapshot: Dict[str, Any]) -> models.User:
+    """Rebuild a cached user in this session without a database round trip"""
+    user = models.User(**snapshot)
+    make_transient_to_detached(user)
+    return db.merge(user, load=False)
+
+
+def invalidate_apikeys(key_ids: Iterable[str]):
+    """
+    Forget verified secrets for the given keys in this process.  Other
+    processes notice that a key was deleted on its next use.
+    """
+    key_id_set = set(key_ids)
+    apikey_cache.pop_where(lambda key, _: key[0] in key_id_set)
+
+
 def _maybe_session_user(
     session: str = Depends(sessioncookie),
     config: OIDCConfig = Depends(_openid_config),
@@ -131,10 +262,17 @@ def _maybe_session_user(
     if session is None:
         return None
 
+    token_key = hashlib.sha256(session.encode("utf-8")).hexdigest()
+    token: Optional[JWToken] = session_cache.get(token_key)
+    if token is not None:
+        return token
     try:
-        return _verify_jwt(session, config)
+        token = _verify_jwt(session, config)
+        session_cache.set(token_key, token, ttl=token.exp - time.time())
     except jwt.exceptions.PyJWTError as e:
-        return _verify_jwt(session, config, verify=False)
+        token = _verify_jwt(session, config, verify=False)
+        session_cache.set(token_key, token, ttl=UNVERIFIED_SESSION_TTL)
+    return token
 
 
 def _make_redirect(config: OIDCConfig, token: Optional[JWToken]) -> RedirectResponse:
@@ -158,14 +296,25 @@ def get_current_user(
     credentials: HTTPBasicCredentials = Depends(security),
     db: database.SessionLocal = Depends(depends.get_db),
 ) -> models.User:
-
     if session_cookie is not None and session_cookie.verified:
+        snapshot = session_user_cache.get(session_cookie.sub)
+        if snapshot is not None:
+            return _attach_user(db, snapshot)
         user = (
             db.query(models.User).filter(models.User.sub == session_cookie.sub).first()
         )
         if user is not None:
+            session_user_cache.set(session_cookie.sub, _user_snapshot(user))
             return user
     if credentials:
+        cache_key = (credentials.username, _secret_digest(credentials.password))
+        cached = apikey_cache.get(cache_key)
+        if cached is not None:
+            apikey_id, snapshot = cached
+            # The key may have been deleted through another worker
+            if db.query(models.ApiKey.id).filter(models.ApiKey.id == apikey_id).first():
+                return _attach_user(db, snapshot)
+            apikey_cache.pop(cache_key)
         apikey: Optional[models.ApiKey] = (
             db.query(models.ApiKey)
             .filter(models.ApiKey.key_id == credentials.username)
@@ -174,10 +323,42 @@ def get_current_user(
         if apikey is not None:
             verified = apikey.verify(credentials.password)
             if verified:
+                snapshot = _user_snapshot(apikey.user)
+                if apikey.needs_rehash:
+                    # Transparently migrate legacy bcrypt hashes
+                    apikey.secret_hash = models.ApiKey.make_password_hash(
+                        credentials.password
+                    )
+                    db.commit()
+                apikey_cache.set(cache_key, (apikey.id, snapshot))
                 return apikey.user
     raise HTTPException(status.HTTP_401_UNAUTHORIZED, "Unauthorized")
 
 
+def get_admin_user(user: models.User = Depends(get_current_user)) -> models.User:
+    """Require a user listed in settings.admins"""
+    if user.username not in settings.admins:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN, detail="Administrator only"
+        )
+    return user
+
+
+def _upsert_user(db: database.SessionLocal, verified: JWToken) -> models.User:
+    user: Optional[models.User] = (
+        db.query(models.User).filter(models.User.sub == verified.sub).first()
+    )
+    if user is None:
+        user = models.User(
+            username=verified.nickname or verified.email,
+            email=verified.email,
+            sub=verified.sub,
+        )
+        db.add(user)
+        db.commit()
+    return user
+
+
 @router.get("/login")
 async def login(
     config: OIDCConfig = Depends(_openid_config),
@@ -205,7 +386,7 @@ async def auth(
     if code is None:
         raise HTTPException(400, "No error, code missing.")
     # https://auth0.com/docs/api/authentication#get-token
-    resp = requests.post(
+    resp = await open_http_client().post(
         config.well_known.token_endpoint,
         data={
             "grant_type": "authorization_code",
@@ -218,19 +399,7 @@ async def auth(
     resp.raise_for_status()
     token = OIDCJWTokenResponse(**resp.json())
     verified = _verify_jwt(token.id_token, config)
-
-    user: schemas.UserDB = (
-        db.query(models.User).filter(models.User.sub == verified.sub).first()
-    )
-
-    if user is None:
-        user = models.User(
-            username=verified.nickname or verified.email,
-            email=verified.email,
-            sub=verified.sub,
-        )
-        db.add(user)
-        db.commit()
+    await run_in_threadpool(_upsert_user, db, verified)
 
     response = RedirectResponse(url="/app")
     response.set_cookie("session", value=token.id_token, samesite="lax", httponly=True)
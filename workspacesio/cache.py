@@ -0,0 +1,67 @@
+"""
+Small in-process caches for the server
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """
+    Bounded, thread-safe LRU cache whose entries expire.
+
+    Caches are per-process.  When several workers run, an invalidation in one
+    worker is not seen by the others, so `ttl` bounds how long stale entries live.
+
+    :param maxsize: maximum number of entries before the least recently used is evicted
+    :param ttl: default lifetime of an entry in seconds
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self.lock:
+            entry = self.data.get(key, None)
+            if entry is not None:
+                expires, value = entry
+                if expires > time.monotonic():
+                    self.hits += 1
+                    self.data.move_to_end(key)
+                    return value
+                del self.data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else ttl
+        if ttl <= 0:
+            return
+        with self.lock:
+            self.data[key] = (time.monotonic() + ttl, value)
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def pop_where(self, predicate: Callable[[Hashable, Any], bool]):
+        """Remove every entry for which predicate(key, value) is true"""
+        with self.lock:
+            for key in [k for k, (_, v) in self.data.items() if predicate(k, v)]:
+                del self.data[key]
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self) -> int:
+        return len(self.data)
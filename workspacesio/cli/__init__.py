@@ -1,6 +1,6 @@
+import importlib
 import json
-import os
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 
 import click
@@ -10,7 +10,55 @@ from click_aliases import ClickAliasedGroup
 from requests.exceptions import RequestException
 from requests_toolbelt.sessions import BaseUrlSession
 
-from . import auth, config, index, mc, node, root, s3token, search, user, workspace
+from . import config
+
+# command name -> (module that defines it, aliases)
+COMMANDS: Dict[str, Tuple[str, List[str]]] = {
+    "workspace": (".workspace", ["w"]),
+    "login": (".auth", []),
+    "info": (".auth", []),
+    "token": (".s3token", ["t"]),
+    "credential-process": (".s3token", []),
+    "mc": (".mc", []),
+    "cp": (".cp", []),
+    "get": (".cp", []),
+    "cat": (".cp", []),
+    "sync": (".sync", []),
+    "index": (".index", []),
+    "node": (".node", ["n"]),
+    "root": (".root", ["r"]),
+    "search": (".search", []),
+    "user": (".user", ["u"]),
+}
+
+
+class LazyGroup(ClickAliasedGroup):
+    """
+    Import a subcommand's module only when that command is invoked, so that
+    `wio mc` doesn't pay for the imports of every other command.
+    Each module registers its commands with `make(group)`, as before.
+    """
+
+    def __init__(
+        self, *args, lazy_commands: Dict[str, Tuple[str, List[str]]], **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands
+        for name, (_, aliases) in lazy_commands.items():
+            for alias in aliases:
+                self._aliases[alias] = name
+            if aliases:
+                self._commands[name] = aliases
+
+    def list_commands(self, ctx: click.Context) -> List[str]:
+        return sorted(set(super().list_commands(ctx)) | set(self.lazy_commands))
+
+    def get_command(self, ctx: click.Context, cmd_name: str) -> Optional[click.Command]:
+        name = self.resolve_alias(cmd_name)
+        if name not in self.commands and name in self.lazy_commands:
+            module = importlib.import_module(self.lazy_commands[name][0], __name__)
+            module.make(self)
+        return super().get_command(ctx, cmd_name)
 
 
 class WioSession(BaseUrlSession):
@@ -38,33 +86,20 @@ class WioSession(BaseUrlSession):
         )
 
 
-@click.group(cls=ClickAliasedGroup)
+@click.group(cls=LazyGroup, lazy_commands=COMMANDS)
 @click.option("--api-url", envvar="WIO_ENDPOINT_URL")
 @click.option(
     "--config-path",
-    default=os.path.join(os.path.expanduser("~"), ".config", "wio.json"),
+    default=config.CONFIG_PATH,
     envvar="WIO_CONFIG_PATH",
     type=click.Path(dir_okay=False, file_okay=True, writable=True, resolve_path=True),
 )
 @click.version_option()
 @click.pass_context
 def cli(ctx, api_url, config_path):
-    conf = config.load_config(config_path)
-    if api_url:
-        conf.api_url = api_url
+    conf = config.load(api_url, config_path)
     ctx.obj = {
         "configPath": config_path,
         "config": conf,
         "session": WioSession(conf),
     }
-
-
-workspace.make(cli)
-auth.make(cli)
-s3token.make(cli)
-mc.make(cli)
-index.make(cli)
-node.make(cli)
-root.make(cli)
-search.make(cli)
-user.make(cli)
@@ -6,13 +6,15 @@ import click
 from pydantic import BaseModel
 from requests_toolbelt.sessions import BaseUrlSession
 
-from workspacesio.common import schemas
+CONFIG_PATH = os.path.join(os.path.expanduser("~"), ".config", "wio.json")
 
 
 class Config(BaseModel):
     access_key: Optional[str]
     secret_key: Optional[str]
     api_url: str = "http://localhost:8100/api"
+    # MiB of downloaded objects to keep for --cache
+    read_cache_size: int = 10240
 
 
 class Ctx(BaseModel):
@@ -45,3 +47,16 @@ def load_config(path: str) -> Config:
         except:
             return make()
     return make()
+
+
+def load(api_url: Optional[str] = None, config_path: Optional[str] = None) -> Config:
+    """
+    Config the way every wio client finds it: read from config_path, else
+    WIO_CONFIG_PATH, else CONFIG_PATH, with the api url overridden by api_url,
+    else WIO_ENDPOINT_URL
+    """
+    conf = load_config(config_path or os.getenv("WIO_CONFIG_PATH") or CONFIG_PATH)
+    api_url = api_url or os.getenv("WIO_ENDPOINT_URL")
+    if api_url:
+        conf.api_url = api_url
+    return conf
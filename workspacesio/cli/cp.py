@@ -0,0 +1,276 @@
+import mmap
+import os
+import posixpath
+import sys
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import click
+from tqdm import tqdm
+
+from workspacesio.common import schemas
+
+from . import config, credentials, readcache, transfer
+from .util import exit_with
+
+MEGABYTE = 1024 * 1024
+
+
+def transfer_options(f):
+    f = click.option(
+        "--concurrency",
+        type=click.IntRange(min=1),
+        default=transfer.DEFAULT_CONCURRENCY,
+        show_default=True,
+        help="Parts and files in flight at once",
+    )(f)
+    f = click.option(
+        "--part-size",
+        type=click.IntRange(min=5),
+        default=transfer.DEFAULT_PART_SIZE // MEGABYTE,
+        show_default=True,
+        help="Multipart chunk size in MiB",
+    )(f)
+    return f
+
+
+cache_option = click.option(
+    "--cache/--no-cache",
+    default=False,
+    envvar="WIO_READ_CACHE",
+    show_default=True,
+    help="Serve unchanged objects from the local read cache",
+)
+
+
+def make_engine(
+    wrapper: schemas.TokenNodeWrapper, part_size: int, concurrency: int, total: int
+) -> Tuple[transfer.TransferEngine, tqdm]:
+    bar = tqdm(total=total, unit="B", unit_scale=True, unit_divisor=1024)
+    lock = threading.Lock()
+
+    def progress(n: int):
+        with lock:
+            bar.update(n)
+
+    engine = transfer.TransferEngine(
+        transfer.s3_client(wrapper, max_pool_connections=concurrency * 2),
+        part_size=part_size * MEGABYTE,
+        concurrency=concurrency,
+        progress=progress,
+    )
+    return engine, bar
+
+
+def resolve(
+    ctx: config.Ctx, term: str
+) -> Tuple[schemas.TokenNodeWrapper, schemas.S3TokenSearchResponseWorkspacePart]:
+    response = credentials.search(ctx, [term])
+    match = response.workspaces.get(term, None)
+    if match is None:
+        exit_with({"error": f"{term} is not a local path or a known workspace"})
+    return transfer.token_for(response, match.workspace), match
+
+
+def upload_pairs(
+    sources: List[str], key: str, into_prefix: bool
+) -> List[Tuple[str, str]]:
+    """(local file, object key) for every file under sources"""
+    into_prefix = into_prefix or len(sources) > 1
+    pairs: List[Tuple[str, str]] = []
+    for source in sources:
+        source = os.path.abspath(os.path.expanduser(source))
+        if os.path.isdir(source):
+            base = os.path.dirname(source)
+            for dirpath, _, filenames in os.walk(source):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    relative = os.path.relpath(path, base).replace(os.sep, "/")
+                    pairs.append((path, posixpath.join(key, relative)))
+        elif into_prefix:
+            pairs.append((source, posixpath.join(key, os.path.basename(source))))
+        else:
+            pairs.append((source, key))
+    return pairs
+
+
+def download_pairs(
+    engine: transfer.TransferEngine,
+    bucket: str,
+    key: str,
+    destination: str,
+    read_cache: Optional[readcache.ReadCache] = None,
+) -> List[Tuple[str, str, Dict[str, Any]]]:
+    """(object key, local file, head) for the object at key, or every object under it"""
+    from botocore.exceptions import ClientError
+
+    destination = os.path.abspath(os.path.expanduser(destination))
+    if key and not key.endswith("/"):
+        try:
+            if read_cache is not None:
+                head = read_cache.head(engine.client, engine.endpoint, bucket, key)
+            else:
+                head = engine.client.head_object(Bucket=bucket, Key=key)
+            if os.path.isdir(destination):
+                destination = os.path.join(destination, posixpath.basename(key))
+            return [(key, destination, head)]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ["404", "NoSuchKey"]:
+                raise
+    prefix = posixpath.join(key, "") if key else ""
+    base = posixpath.dirname(prefix.rstrip("/"))
+    return [
+        (
+            obj["Key"],
+            os.path.join(destination, *posixpath.relpath(obj["Key"], base).split("/")),
+            {"ContentLength": obj["Size"], "ETag": obj["ETag"]},
+        )
+        for obj in engine.list(bucket, prefix)
+        if not obj["Key"].endswith("/")
+    ]
+
+
+def open_cache(ctx: config.Ctx, cache: bool) -> Optional[readcache.ReadCache]:
+    if cache and ctx.config.read_cache_size > 0:
+        return readcache.ReadCache(ctx.config.read_cache_size * MEGABYTE)
+    return None
+
+
+def download(
+    ctx: config.Ctx,
+    source: str,
+    destination: str,
+    part_size: int,
+    concurrency: int,
+    cache: bool,
+):
+    wrapper, match = resolve(ctx, source)
+    bucket = match.workspace.root.bucket
+    engine, bar = make_engine(wrapper, part_size, concurrency, 0)
+    read_cache = open_cache(ctx, cache)
+    with engine, bar:
+        pairs = download_pairs(
+            engine, bucket, transfer.object_key(match), destination, read_cache
+        )
+        if read_cache is not None:
+            read_cache.validated(
+                engine.endpoint, bucket, [(key, head) for key, _, head in pairs]
+            )
+            misses = []
+            for key, path, head in pairs:
+                cached = read_cache.get(engine.endpoint, bucket, key, head["ETag"])
+                if cached is None:
+                    misses.append((key, path, head))
+                else:
+                    read_cache.link(cached, path)
+            pairs = misses
+        bar.total = sum(head["ContentLength"] for _, _, head in pairs)
+        bar.refresh()
+        etags = run(engine.download_many, bucket, pairs)
+        if read_cache is not None:
+            for (key, path, _), etag in zip(pairs, etags):
+                read_cache.put(engine.endpoint, bucket, key, etag, path)
+            read_cache.close()
+
+
+def print_object(ctx: config.Ctx, source: str, cache: bool):
+    wrapper, match = resolve(ctx, source)
+    bucket = match.workspace.root.bucket
+    key = transfer.object_key(match)
+    read_cache = open_cache(ctx, cache)
+    out = sys.stdout.buffer
+    if read_cache is None:
+        client = transfer.s3_client(wrapper, max_pool_connections=1)
+        body = client.get_object(Bucket=bucket, Key=key)["Body"]
+        for chunk in body.iter_chunks(transfer.READ_CHUNK_SIZE):
+            out.write(chunk)
+        return
+    engine = transfer.TransferEngine(
+        transfer.s3_client(
+            wrapper, max_pool_connections=transfer.DEFAULT_CONCURRENCY * 2
+        )
+    )
+    with engine, read_cache:
+        head = read_cache.head(engine.client, engine.endpoint, bucket, key)
+        cached = read_cache.get(engine.endpoint, bucket, key, head["ETag"])
+        staged: Optional[str] = None
+        if cached is None:
+            staging = os.path.join(read_cache.directory, "staging")
+            os.makedirs(staging, mode=0o700, exist_ok=True)
+            staged = os.path.join(staging, str(os.getpid()))
+            etag = run(engine.download, bucket, key, staged, head)
+            # The staged file itself, if it was too large to cache
+            cached = read_cache.put(engine.endpoint, bucket, key, etag, staged)
+        try:
+            if head["ContentLength"] > 0:
+                with open(cached, "rb") as f, mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ
+                ) as data:
+                    out.write(data)
+        finally:
+            if staged is not None:
+                os.unlink(staged)
+
+
+def run(func, *args):
+    try:
+        return func(*args)
+    except transfer.TransferError as e:
+        exit_with({"error": str(e)})
+
+
+def make(cli: click.Group):
+    @cli.command(name="cp")
+    @click.argument("sources", nargs=-1, required=True)
+    @click.argument("destination", nargs=1)
+    @transfer_options
+    @cache_option
+    @click.pass_obj
+    def cp(ctx, sources, destination, part_size, concurrency, cache):
+        """
+        Copy local files and directories into a workspace, or
+        a workspace path to local disk.
+
+        Interrupted copies resume when run again with the same arguments.
+        """
+        ctx = config.getctx(ctx)
+        if all(os.path.exists(os.path.expanduser(s)) for s in sources):
+            wrapper, match = resolve(ctx, destination)
+            pairs = upload_pairs(
+                list(sources),
+                transfer.object_key(match),
+                # A workspace, or a path ending in /, is a destination prefix
+                into_prefix=destination.endswith("/") or match.path.strip("/") == "",
+            )
+            total = sum(os.path.getsize(path) for path, _ in pairs)
+            engine, bar = make_engine(wrapper, part_size, concurrency, total)
+            with engine, bar:
+                run(engine.upload_many, pairs, match.workspace.root.bucket)
+        elif len(sources) == 1:
+            download(ctx, sources[0], destination, part_size, concurrency, cache)
+        else:
+            exit_with({"error": "Multiple sources must all be local paths"})
+
+    @cli.command(name="get")
+    @click.argument("source")
+    @click.argument("destination", default=".")
+    @transfer_options
+    @cache_option
+    @click.pass_obj
+    def get(ctx, source, destination, part_size, concurrency, cache):
+        """
+        Download an object, or everything under a workspace path.
+
+        Interrupted downloads resume when run again with the same arguments.
+        """
+        download(config.getctx(ctx), source, destination, part_size, concurrency, cache)
+
+    @cli.command(name="cat")
+    @click.argument("source")
+    @cache_option
+    @click.pass_obj
+    def cat(ctx, source, cache):
+        """
+        Write an object to standard output.
+        """
+        print_object(config.getctx(ctx), source, cache)
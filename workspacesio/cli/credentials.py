@@ -0,0 +1,164 @@
+"""
+Local cache of token/search results, so that repeated commands against the
+same workspaces don't need a round trip to the server.
+
+Everything is stored in a single JSON file that only the current user can read.
+Resolved terms are kept for TERM_TTL.  Terms that matched nothing are kept
+only for MISS_TTL, so a workspace created or shared since is found soon.
+Credentials are kept for each storage node and set of workspaces, and reused
+until EXPIRY_MARGIN before they expire.
+"""
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional, Sequence
+
+from workspacesio.common import schemas
+
+from . import config
+from .util import exit_with, handle_request_error
+
+CACHE_DIR = os.getenv(
+    "WIO_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".config", "wio")
+)
+CACHE_FILE = "credentials.json"
+TERM_TTL = timedelta(minutes=10)
+MISS_TTL = timedelta(seconds=30)
+EXPIRY_MARGIN = timedelta(minutes=5)
+
+
+def _now() -> datetime:
+    return datetime.utcnow()
+
+
+def constellation_key(node_id: Any, workspaces: Sequence[schemas.WorkspaceDB]):
+    """Client-side identity of a token: its node and the workspaces it covers"""
+    return f"{node_id}:{','.join(sorted(set(str(w.id) for w in workspaces)))}"
+
+
+def fresh(wrappers: List[schemas.TokenNodeWrapper], now: datetime) -> bool:
+    return all(
+        w.token.expiration is not None and w.token.expiration - EXPIRY_MARGIN > now
+        for w in wrappers
+    )
+
+
+class CredentialCache:
+    def __init__(self, ctx: config.Ctx, directory: str = CACHE_DIR):
+        self.path = os.path.join(directory, CACHE_FILE)
+        # Separate entries for each server and identity
+        self.scope = f"{ctx.config.api_url}|{ctx.config.access_key}"
+        self.data: Dict[str, Any] = {}
+        try:
+            with open(self.path) as cache_file:
+                self.data = json.load(cache_file)
+        except (OSError, ValueError):
+            self.data = {}
+        self.entries = self.data.setdefault(self.scope, {"terms": {}, "tokens": {}})
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        os.chmod(directory, 0o700)
+        # mkstemp creates the file with mode 0600
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".credentials-")
+        try:
+            with os.fdopen(fd, "w") as out:
+                json.dump(self.data, out)
+            os.replace(tmp, self.path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def clear(self):
+        self.data.pop(self.scope, None)
+        self.entries = self.data.setdefault(self.scope, {"terms": {}, "tokens": {}})
+        self.save()
+
+    def get(self, terms: Sequence[str]) -> Optional[schemas.S3TokenSearchResponse]:
+        """Assemble a search response entirely from cache, or return None"""
+        now = _now()
+        workspaces: Dict[str, schemas.S3TokenSearchResponseWorkspacePart] = {}
+        by_node: Dict[str, List[schemas.WorkspaceDB]] = {}
+        for term in terms:
+            entry = self.entries["terms"].get(term)
+            if entry is None or datetime.fromisoformat(entry["expires"]) < now:
+                return None
+            if entry["match"] is None:
+                continue
+            match = schemas.S3TokenSearchResponseWorkspacePart(**entry["match"])
+            workspaces[term] = match
+            by_node.setdefault(str(match.workspace.root.node_id), []).append(
+                match.workspace
+            )
+        tokens: List[schemas.TokenNodeWrapper] = []
+        for node_id, node_workspaces in by_node.items():
+            entry = self.entries["tokens"].get(
+                constellation_key(node_id, node_workspaces)
+            )
+            if entry is None:
+                return None
+            wrappers = [schemas.TokenNodeWrapper(**w) for w in entry]
+            if not fresh(wrappers, now):
+                return None
+            tokens += wrappers
+        return schemas.S3TokenSearchResponse(tokens=tokens, workspaces=workspaces)
+
+    def put(self, terms: Sequence[str], response: schemas.S3TokenSearchResponse):
+        now = _now()
+        self._expire(now)
+        by_node: Dict[str, List[schemas.WorkspaceDB]] = {}
+        for term in terms:
+            match = response.workspaces.get(term)
+            if match is None:
+                # The workspace may be created or shared at any moment
+                self.entries["terms"][term] = {
+                    "expires": (now + MISS_TTL).isoformat(),
+                    "match": None,
+                }
+                continue
+            self.entries["terms"][term] = {
+                "expires": (now + TERM_TTL).isoformat(),
+                "match": json.loads(match.json()),
+            }
+            by_node.setdefault(str(match.workspace.root.node_id), []).append(
+                match.workspace
+            )
+        for node_id, node_workspaces in by_node.items():
+            wrappers = [
+                json.loads(w.json())
+                for w in response.tokens
+                if str(w.node.id) == node_id
+            ]
+            if len(wrappers):
+                key = constellation_key(node_id, node_workspaces)
+                self.entries["tokens"][key] = wrappers
+        self.save()
+
+    def _expire(self, now: datetime):
+        terms = self.entries["terms"]
+        for term in [
+            t for t, e in terms.items() if datetime.fromisoformat(e["expires"]) < now
+        ]:
+            del terms[term]
+        tokens = self.entries["tokens"]
+        for key in [
+            k
+            for k, wrappers in tokens.items()
+            if not fresh([schemas.TokenNodeWrapper(**w) for w in wrappers], now)
+        ]:
+            del tokens[key]
+
+
+def search(ctx: config.Ctx, terms: Sequence[str]) -> schemas.S3TokenSearchResponse:
+    """POST token/search, unless the cache can already answer it"""
+    cache = CredentialCache(ctx)
+    response = cache.get(terms)
+    if response is None:
+        r = ctx.session.post("token/search", json={"search_terms": list(terms)})
+        if not r.ok:
+            exit_with(handle_request_error(r))
+        response = schemas.S3TokenSearchResponse(**r.json())
+        cache.put(terms, response)
+    return response
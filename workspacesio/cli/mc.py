@@ -8,7 +8,8 @@ import click
 
 from workspacesio.common import schemas
 
-from .util import exit_with, handle_request_error
+from . import config, credentials, transfer
+from .util import exit_with
 
 SUPPORTED_MINIO_COMMANDS = [
     "ls",
@@ -34,8 +35,8 @@ def isrealpath(s: str) -> bool:
     return os.path.exists(os.path.abspath(os.path.expanduser(s)))
 
 
-def transform_arguments(args: List[str]):
-    """attempt to """
+def transform_arguments(args: List[str]) -> List[str]:
+    """Arguments of a supported mc command that may name workspaces"""
     if len(args) < 2 or not (args[0] in SUPPORTED_MINIO_COMMANDS):
         return []
     possible_workspaces = []
@@ -60,43 +61,42 @@ def make(cli: click.Group):
     def mc(ctx, args):
         from workspacesio.common import s3utils
 
-        r = ctx["session"].post(
-            "token/search",
-            json={
-                "search_terms": args,
-            },
-        )
-        if r.ok:
-            response = r.json()
-            assembled = " ".join(args)
-            mc_env = ""
-            for arg, match in response["workspaces"].items():
-                workspace = schemas.WorkspaceDB(**match["workspace"])
-                scope = workspace.root.root_type.lower()
-                key = s3utils.getWorkspaceKey(workspace)
-                path = "/".join(
-                    [
-                        "myalias",
-                        workspace.root.bucket,
-                        key,
-                        match["path"].lstrip("/"),
-                    ]
-                )
-                assembled = assembled.replace(arg, path)
-            if len(response["tokens"]) == 1:
-                token = response["tokens"][0]["token"]
-                access_key = token["access_key_id"]
-                secret = token["secret_access_key"]
-                session_token = token["session_token"]
-                api_url = response["tokens"][0]["node"]["api_url"]
-                url = urllib.parse.urlparse(api_url)
-                mc_env = (
-                    f"{url.scheme}://{access_key}:{secret}:{session_token}@{url.netloc}"
+        terms = transform_arguments(list(args))
+        response = schemas.S3TokenSearchResponse(tokens=[], workspaces={})
+        if terms:
+            response = credentials.search(config.getctx(ctx), terms)
+        assembled = " ".join(args)
+        mc_env = dict(os.environ)
+        # One mc alias for each token, since workspaces may need different ones
+        aliases: Dict[str, str] = {}
+        for arg, match in response.workspaces.items():
+            workspace = match.workspace
+            try:
+                wrapper = transfer.token_for(response, workspace)
+            except transfer.TransferError as e:
+                exit_with({"error": str(e)})
+            token = wrapper.token
+            alias = aliases.get(token.access_key_id)
+            if alias is None:
+                alias = "myalias" + (str(len(aliases)) if aliases else "")
+                aliases[token.access_key_id] = alias
+                url = urllib.parse.urlparse(wrapper.node.api_url)
+                mc_env[f"MC_HOST_{alias}"] = (
+                    f"{url.scheme}://{token.access_key_id}:{token.secret_access_key}"
+                    f":{token.session_token}@{url.netloc}"
                 )
-            command = (
-                "mc",
-                *assembled.split(" "),
+            key = s3utils.getWorkspaceKey(workspace)
+            path = "/".join(
+                [
+                    alias,
+                    workspace.root.bucket,
+                    key,
+                    match.path.lstrip("/"),
+                ]
             )
-            os.execvpe(command[0], command, dict(os.environ, MC_HOST_myalias=mc_env))
-        else:
-            exit_with(handle_request_error(r))
+            assembled = assembled.replace(arg, path)
+        command = (
+            "mc",
+            *assembled.split(" "),
+        )
+        os.execvpe(command[0], command, mc_env)
@@ -39,6 +39,11 @@ def make(cli: click.Group):
     @click.argument("secret_access_key", type=click.STRING)
     @click.option("--region-name", type=click.STRING, default="us-east-1")
     @click.option("--sts-api-url", type=click.STRING)
+    @click.option(
+        "--token-duration",
+        type=click.INT,
+        help="Lifetime in seconds of STS credentials issued for this node",
+    )
     @click.option(
         "--role-arn",
         type=click.STRING,
@@ -53,6 +58,7 @@ def make(cli: click.Group):
         secret_access_key,
         region_name,
         sts_api_url,
+        token_duration,
         role_arn,
     ):
         r = ctx["session"].post(
@@ -65,6 +71,7 @@ def make(cli: click.Group):
                 "region_name": region_name,
                 "sts_api_url": sts_api_url,
                 "assume_role_arn": role_arn,
+                "token_duration_seconds": token_duration,
             },
         )
         exit_with(handle_request_error(r))
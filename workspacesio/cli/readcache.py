@@ -0,0 +1,208 @@
+"""
+Content-addressed cache of downloaded objects.
+
+Each object is stored once per (storage node, bucket, key, ETag) and handed out
+as a read-only hard link, or a copy when the destination is on another
+filesystem.  A SQLite index records sizes and last use so the cache can be
+trimmed to a byte budget, least recently used first.
+"""
+import hashlib
+import os
+import shutil
+import sqlite3
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from . import credentials, transfer
+
+READ_CACHE_DIR = os.path.join(credentials.CACHE_DIR, "objects")
+# Objects validated this recently are served without a conditional HEAD
+REVALIDATE_AFTER = 60
+
+
+def _is_not_modified(e: Exception) -> bool:
+    return getattr(e, "response", {}).get("Error", {}).get("Code") in [
+        "304",
+        "NotModified",
+    ]
+
+
+class ReadCache:
+    """
+    :param budget: bytes of object data to keep
+    """
+
+    def __init__(self, budget: int, directory: str = READ_CACHE_DIR):
+        self.budget = budget
+        self.directory = directory
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(directory, "index.sqlite"))
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS objects (
+                digest TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS ix_objects_last_used ON objects (last_used);
+            CREATE TABLE IF NOT EXISTS latest (
+                location TEXT PRIMARY KEY,
+                etag TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                validated REAL NOT NULL
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    @staticmethod
+    def digest(endpoint: str, bucket: str, key: str, etag: str) -> str:
+        identity = "|".join([endpoint, bucket, key, transfer._strip_etag(etag)])
+        return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, endpoint: str, bucket: str, key: str, etag: str) -> Optional[str]:
+        """Path of the cached object, or None"""
+        digest = self.digest(endpoint, bucket, key, etag)
+        row = self.db.execute(
+            "SELECT size FROM objects WHERE digest = ?", (digest,)
+        ).fetchone()
+        if row is None:
+            return None
+        path = self.path_for(digest)
+        try:
+            if os.stat(path).st_size != row[0]:
+                raise FileNotFoundError(path)
+        except FileNotFoundError:
+            self._forget(digest)
+            return None
+        with self.db:
+            self.db.execute(
+                "UPDATE objects SET last_used = ? WHERE digest = ?",
+                (time.time(), digest),
+            )
+        return path
+
+    def put(self, endpoint: str, bucket: str, key: str, etag: str, source: str) -> str:
+        """
+        Add a downloaded file to the cache, and return its cached path.  Files
+        larger than the whole budget are not cached, and source is returned.
+        """
+        size = os.stat(source).st_size
+        if size > self.budget:
+            return source
+        digest = self.digest(endpoint, bucket, key, etag)
+        path = self.path_for(digest)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        self._place(source, path)
+        os.chmod(path, 0o444)
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO objects VALUES (?, ?, ?)",
+                (digest, size, time.time()),
+            )
+        self.evict(keep=digest)
+        return path
+
+    def link(self, cached: str, destination: str):
+        """Materialize a cached object at destination"""
+        os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+        self._place(cached, destination)
+
+    @staticmethod
+    def _place(source: str, destination: str):
+        """Hard link source to destination, replacing it, or copy across devices"""
+        tmp = f"{destination}.{os.getpid()}.wio-link"
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        try:
+            os.link(source, tmp)
+        except OSError:
+            shutil.copyfile(source, tmp)
+        os.replace(tmp, destination)
+
+    def head(self, client, endpoint: str, bucket: str, key: str) -> Dict[str, Any]:
+        """
+        head_object for key, skipped if the cached copy was validated within
+        REVALIDATE_AFTER, and conditional on its ETag otherwise
+        """
+        location = "|".join([endpoint, bucket, key])
+        row = self.db.execute(
+            "SELECT etag, size, validated FROM latest WHERE location = ?",
+            (location,),
+        ).fetchone()
+        if row is not None:
+            etag, size, validated = row
+            cached = {"ContentLength": size, "ETag": etag}
+            if time.time() - validated < REVALIDATE_AFTER:
+                return cached
+            try:
+                head = client.head_object(Bucket=bucket, Key=key, IfNoneMatch=etag)
+            except Exception as e:
+                if not _is_not_modified(e):
+                    raise
+                head = cached
+        else:
+            head = client.head_object(Bucket=bucket, Key=key)
+        self.validated(endpoint, bucket, [(key, head)])
+        return head
+
+    def validated(
+        self, endpoint: str, bucket: str, heads: List[Tuple[str, Dict[str, Any]]]
+    ):
+        """Record the current ETag of each (key, head)"""
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO latest VALUES (?, ?, ?, ?)",
+                [
+                    (
+                        "|".join([endpoint, bucket, key]),
+                        h["ETag"],
+                        h["ContentLength"],
+                        now,
+                    )
+                    for key, h in heads
+                ],
+            )
+
+    def evict(self, keep: Optional[str] = None):
+        """
+        Remove least recently used objects until the cache fits its budget.
+
+        :param keep: digest of an object to leave in place, such as one just added
+        """
+        total = self.db.execute("SELECT coalesce(sum(size), 0) FROM objects").fetchone()
+        excess = total[0] - self.budget
+        if excess <= 0:
+            return
+        victims: List[str] = []
+        for digest, size in self.db.execute(
+            "SELECT digest, size FROM objects ORDER BY last_used"
+        ):
+            if excess <= 0:
+                break
+            if digest == keep:
+                continue
+            victims.append(digest)
+            excess -= size
+        for digest in victims:
+            self._forget(digest)
+
+    def _forget(self, digest: str):
+        try:
+            os.unlink(self.path_for(digest))
+        except FileNotFoundError:
+            pass
+        with self.db:
+            self.db.execute("DELETE FROM objects WHERE digest = ?", (digest,))
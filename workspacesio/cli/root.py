@@ -1,3 +1,6 @@
+import asyncio
+from typing import List
+
 import click
 from click_aliases import ClickAliasedGroup
 
@@ -55,6 +58,7 @@ def make(cli: click.Group):
     def import_all_workspaces(ctx, root_id, index_all):
         # Dynamic, expensive imports
         from workspacesio.common import producers
+        from workspacesio.sdk import ApiError, AsyncWioClient
 
         ctx = config.getctx(ctx)
         r = ctx.session.post(f"root/{root_id}/import")
@@ -64,25 +68,32 @@ def make(cli: click.Group):
         root_contents = producers.minio_list_root_children(
             node=rdata.node, root=rdata.root
         )
-        workspace_list: List[schemas.WorkspaceDB] = []
+        creates: List[schemas.WorkspaceCreate] = []
         for folder in root_contents:
             prefix = folder.object_name.lstrip(rdata.root.base_path).strip("/")
             if len(prefix) > 0:
                 print(f"Discovered {prefix}")
-                workspace = ctx.session.post(
-                    "workspace",
-                    json={
-                        "name": prefix,
-                        "public": False,
-                        "unmanaged": True,
-                        "base_path": prefix,
-                        "node_name": rdata.node.name,
-                        "root_id": str(rdata.root.id),
-                    },
+                creates.append(
+                    schemas.WorkspaceCreate(
+                        name=prefix,
+                        public=False,
+                        unmanaged=True,
+                        base_path=prefix,
+                        node_name=rdata.node.name,
+                        root_id=rdata.root.id,
+                    )
                 )
-                if not workspace.ok and workspace.status_code != 409:
-                    exit_with(handle_request_error(workspace))
-                workspace_list.append(schemas.WorkspaceDB(**workspace.json()))
+
+        async def create_all():
+            async with AsyncWioClient.from_config(ctx.config) as client:
+                return await client.create_workspaces(creates, exist_ok=True)
+
+        try:
+            workspace_list = asyncio.run(create_all())
+        except ApiError as e:
+            exit_with({"error": e.detail, "status": e.status_code})
+        created = len([w for w in workspace_list if w is not None])
+        print(f"Imported {created} new workspaces")
 
     @root.command(
         name="import-workspace", help="Import a particular prefix as a workspace."
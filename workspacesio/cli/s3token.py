@@ -1,10 +1,13 @@
+import json
 from datetime import datetime
+from typing import Dict
 
 import click
 from click_aliases import ClickAliasedGroup
 
 from workspacesio.common import schemas
 
+from . import config, credentials, transfer
 from .util import exit_with, handle_request_error
 
 
@@ -19,24 +22,20 @@ def make(cli: click.Group):
     def create_token(ctx, workspaces):
         if len(workspaces) == 0:
             return
-        r = ctx["session"].post("token/search", json={"search_terms": workspaces})
-        if r.ok:
-            response = schemas.S3TokenSearchResponse(**r.json())
-            for wrapper in response.tokens:
-                node = wrapper.node
-                token = wrapper.token
-                click.secho(
-                    f"Credentials for {[w.name for w in token.workspaces]} @ {node.api_url}",
-                    fg="green",
-                )
-                click.secho(
-                    f"Expires in {token.expiration - datetime.utcnow()}\n", fg="yellow"
-                )
-                click.secho(f"export AWS_ACCESS_KEY_ID={token.access_key_id}")
-                click.secho(f"export AWS_SECRET_ACCESS_KEY={token.secret_access_key}")
-                click.secho(f"export AWS_SESSION_TOKEN={token.session_token}\n")
-        else:
-            exit_with(handle_request_error(r))
+        response = credentials.search(config.getctx(ctx), workspaces)
+        for wrapper in response.tokens:
+            node = wrapper.node
+            token = wrapper.token
+            click.secho(
+                f"Credentials for {[w.name for w in token.workspaces]} @ {node.api_url}",
+                fg="green",
+            )
+            click.secho(
+                f"Expires in {token.expiration - datetime.utcnow()}\n", fg="yellow"
+            )
+            click.secho(f"export AWS_ACCESS_KEY_ID={token.access_key_id}")
+            click.secho(f"export AWS_SECRET_ACCESS_KEY={token.secret_access_key}")
+            click.secho(f"export AWS_SESSION_TOKEN={token.session_token}\n")
 
     @token.command(name="list", aliases=["l", "ls"])
     @click.pass_obj
@@ -49,10 +48,50 @@ def make(cli: click.Group):
     @click.argument("token_id", required=False)
     @click.pass_obj
     def delete_token(ctx, all, token_id):
+        credentials.CredentialCache(config.getctx(ctx)).clear()
         if all:
             r = ctx["session"].delete("token")
         else:
             r = ctx["session"].delete(f"token/{token_id}")
         exit_with(handle_request_error(r))
 
+    @cli.command(name="credential-process")
+    @click.argument("workspaces", type=click.STRING, nargs=-1, required=True)
+    @click.pass_obj
+    def credential_process(ctx, workspaces):
+        """
+        Print credentials in the format expected by credential_process
+        in ~/.aws/config, for example:
+
+        credential_process = wio credential-process myworkspace
+        """
+        response = credentials.search(config.getctx(ctx), workspaces)
+        # Every workspace must be covered by the same token
+        tokens: Dict[str, schemas.S3TokenDB] = {}
+        try:
+            for match in response.workspaces.values():
+                token = transfer.token_for(response, match.workspace).token
+                tokens[token.access_key_id] = token
+        except transfer.TransferError as e:
+            exit_with({"error": str(e)})
+        if len(tokens) != 1:
+            exit_with(
+                {
+                    "error": f"Expected credentials from exactly one token, "
+                    f"found {len(tokens)}.  Request fewer workspaces at once."
+                }
+            )
+        (token,) = tokens.values()
+        click.echo(
+            json.dumps(
+                {
+                    "Version": 1,
+                    "AccessKeyId": token.access_key_id,
+                    "SecretAccessKey": token.secret_access_key,
+                    "SessionToken": token.session_token,
+                    "Expiration": f"{token.expiration.isoformat()}Z",
+                }
+            )
+        )
+
     cli.add_command(token)
@@ -0,0 +1,277 @@
+"""
+Incremental one-way sync from a local directory into a workspace.
+
+A SQLite manifest per (storage node, bucket, prefix, local directory) records
+the size, mtime and ETag of every file already in the workspace, so that a
+run only needs to stat the local tree and upload what changed.
+
+Each run lists only the objects that sort after the end of the previous
+listing.  Objects that others add earlier in key order, overwrite or delete
+are only noticed by a run with --verify, which lists the whole prefix.
+"""
+import hashlib
+import os
+import posixpath
+import sqlite3
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import click
+
+from . import config, cp, credentials, transfer
+from .util import exit_with
+
+MANIFEST_DIR = os.path.join(credentials.CACHE_DIR, "sync")
+# Rows written per transaction while uploads complete
+COMMIT_INTERVAL = 500
+
+
+def walk(root: str) -> Iterator[Tuple[str, int, int]]:
+    """Yield (relative posix path, size, mtime_ns) for every file under root"""
+    stack = [""]
+    while stack:
+        relative_dir = stack.pop()
+        with os.scandir(os.path.join(root, relative_dir)) as entries:
+            for entry in entries:
+                relative = posixpath.join(relative_dir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(relative)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    yield relative, stat.st_size, stat.st_mtime_ns
+
+
+class Manifest:
+    """
+    files: what this directory last uploaded, by relative path
+    remote: objects seen under the prefix, by relative path
+    meta: listed_until, the last path returned by a listing of the prefix
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                etag TEXT NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS remote (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                etag TEXT NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            ) WITHOUT ROWID;
+            """
+        )
+
+    def files(self) -> Dict[str, Tuple[int, int]]:
+        return {
+            path: (size, mtime_ns)
+            for path, size, mtime_ns in self.db.execute(
+                "SELECT path, size, mtime_ns FROM files"
+            )
+        }
+
+    def remote(self, paths: List[str]) -> Dict[str, Tuple[int, str]]:
+        found: Dict[str, Tuple[int, str]] = {}
+        for start in range(0, len(paths), 500):
+            batch = paths[start : start + 500]
+            found.update(
+                (path, (size, etag))
+                for path, size, etag in self.db.execute(
+                    "SELECT path, size, etag FROM remote WHERE path IN "
+                    f"({','.join('?' * len(batch))})",
+                    batch,
+                )
+            )
+        return found
+
+    def listed_until(self) -> Optional[str]:
+        row = self.db.execute(
+            "SELECT value FROM meta WHERE key = 'listed_until'"
+        ).fetchone()
+        return row[0] if row else None
+
+    def clear_remote(self):
+        """Forget every remote object, ahead of a full listing.  Not committed."""
+        self.db.execute("DELETE FROM remote")
+        self.db.execute("DELETE FROM meta WHERE key = 'listed_until'")
+
+    def record_listing(self, rows: List[Tuple[str, int, str]]):
+        """Record one page of a listing, in key order"""
+        self.db.executemany("INSERT OR REPLACE INTO remote VALUES (?, ?, ?)", rows)
+        if rows:
+            self.db.execute(
+                "INSERT OR REPLACE INTO meta VALUES ('listed_until', ?)",
+                (rows[-1][0],),
+            )
+        self.db.commit()
+
+    def forget_changed_files(self) -> int:
+        """
+        Drop files whose object is missing from remote or has another ETag,
+        so that they are uploaded again
+        """
+        cursor = self.db.execute(
+            """
+            DELETE FROM files WHERE NOT EXISTS (
+                SELECT 1 FROM remote
+                WHERE remote.path = files.path AND remote.etag = files.etag
+            )
+            """
+        )
+        self.db.commit()
+        return cursor.rowcount
+
+    def record_files(self, rows: List[Tuple[str, int, int, str]]):
+        self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)", rows)
+        self.db.executemany(
+            "INSERT OR REPLACE INTO remote VALUES (?, ?, ?)",
+            [(path, size, etag) for path, size, _, etag in rows],
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+def manifest_path(endpoint: str, bucket: str, prefix: str, local: str) -> str:
+    identity = "|".join([endpoint, bucket, prefix, local])
+    name = hashlib.sha256(identity.encode("utf-8")).hexdigest()
+    return os.path.join(MANIFEST_DIR, f"{name}.sqlite")
+
+
+def refresh_remote(
+    engine: transfer.TransferEngine,
+    manifest: Manifest,
+    bucket: str,
+    prefix: str,
+    verify: bool = False,
+) -> int:
+    """
+    Record objects under prefix that sort after the end of the previous
+    listing.  The first run lists everything; later runs only list new keys
+    at the end.  Uploads made by this manifest don't move the cursor, so
+    keys that others add among them before the next run are still found.
+
+    :param verify: list everything, replacing what the manifest knew
+    """
+    paginator = engine.client.get_paginator("list_objects_v2")
+    kwargs = dict(Bucket=bucket, Prefix=prefix)
+    if verify:
+        # Committed with the first page, so an interrupted listing resumes
+        manifest.clear_remote()
+    else:
+        listed_until = manifest.listed_until()
+        if listed_until is not None:
+            kwargs["StartAfter"] = prefix + listed_until
+    seen = 0
+    for page in paginator.paginate(**kwargs):
+        rows = [
+            (
+                obj["Key"][len(prefix) :],
+                obj["Size"],
+                obj["ETag"].strip('"'),
+            )
+            for obj in page.get("Contents", [])
+        ]
+        manifest.record_listing(rows)
+        seen += len(rows)
+    return seen
+
+
+def already_remote(
+    engine: transfer.TransferEngine, local_path: str, size: int, remote: Tuple[int, str]
+) -> bool:
+    """True if an object not uploaded by this manifest has the same content"""
+    remote_size, etag = remote
+    if remote_size != size:
+        return False
+    part_size: Optional[int] = None
+    if "-" in etag:
+        part_size = engine._part_size_for(size)
+    return transfer.file_etag(local_path, part_size) == etag
+
+
+def make(cli: click.Group):
+    @cli.command(name="sync")
+    @click.argument(
+        "local", type=click.Path(exists=True, file_okay=False, resolve_path=True)
+    )
+    @click.argument("workspace")
+    @cp.transfer_options
+    @click.option("--dry-run", is_flag=True, help="List changes without uploading")
+    @click.option(
+        "--verify",
+        is_flag=True,
+        help="List the whole workspace, and upload files changed or deleted there",
+    )
+    @click.pass_obj
+    def sync(ctx, local, workspace, part_size, concurrency, dry_run, verify):
+        """
+        Upload new and changed files under LOCAL into WORKSPACE.
+
+        Files that were deleted locally are not deleted from the workspace.
+        Objects changed or deleted in the workspace by others are only noticed
+        with --verify.
+        """
+        ctx = config.getctx(ctx)
+        wrapper, match = cp.resolve(ctx, workspace)
+        bucket = match.workspace.root.bucket
+        prefix = posixpath.join(transfer.object_key(match), "")
+        engine, bar = cp.make_engine(wrapper, part_size, concurrency, 0)
+        manifest = Manifest(manifest_path(engine.endpoint, bucket, prefix, local))
+        try:
+            refresh_remote(engine, manifest, bucket, prefix, verify)
+            if verify:
+                manifest.forget_changed_files()
+            known = manifest.files()
+            changed = [
+                (path, size, mtime_ns)
+                for path, size, mtime_ns in walk(local)
+                if known.get(path) != (size, mtime_ns)
+            ]
+            remote = manifest.remote(
+                [path for path, _, _ in changed if path not in known]
+            )
+
+            uploads: Dict[str, Tuple[str, int, int]] = {}
+            adopted: List[Tuple[str, int, int, str]] = []
+            for path, size, mtime_ns in changed:
+                local_path = os.path.join(local, *path.split("/"))
+                if path in remote and already_remote(
+                    engine, local_path, size, remote[path]
+                ):
+                    adopted.append((path, size, mtime_ns, remote[path][1]))
+                else:
+                    uploads[local_path] = (path, size, mtime_ns)
+            manifest.record_files(adopted)
+
+            if dry_run:
+                bar.close()
+                exit_with({"upload": sorted(path for path, _, _ in uploads.values())})
+            bar.total = sum(size for _, size, _ in uploads.values())
+            bar.refresh()
+            done: List[Tuple[str, int, int, str]] = []
+            with engine, bar:
+                try:
+                    for local_path, _, etag in engine.upload_each(
+                        [(p, prefix + uploads[p][0]) for p in uploads], bucket
+                    ):
+                        path, size, mtime_ns = uploads[local_path]
+                        done.append((path, size, mtime_ns, etag))
+                        if len(done) >= COMMIT_INTERVAL:
+                            manifest.record_files(done)
+                            done = []
+                except transfer.TransferError as e:
+                    exit_with({"error": str(e)})
+                finally:
+                    manifest.record_files(done)
+        finally:
+            manifest.close()
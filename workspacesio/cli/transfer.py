@@ -0,0 +1,491 @@
+"""
+Parallel S3 transfers for the wio cli.
+
+Large uploads use multipart uploads and large downloads use ranged GETs, with
+parts moved concurrently.  Completed parts are recorded in a journal under
+JOURNAL_DIR so that an interrupted transfer resumes where it stopped.
+Every part is sent with its MD5 so the server rejects corrupted parts, and
+finished objects are checked against their ETag.
+"""
+import base64
+import hashlib
+import json
+import math
+import os
+import posixpath
+import re
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import TYPE_CHECKING, Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from workspacesio.common import s3utils, schemas
+
+from . import credentials
+
+if TYPE_CHECKING:
+    import boto3
+
+JOURNAL_DIR = os.path.join(credentials.CACHE_DIR, "transfers")
+DEFAULT_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_CONCURRENCY = 8
+# S3 rejects multipart uploads with more parts than this
+MAX_PARTS = 10000
+READ_CHUNK_SIZE = 1024 * 1024
+PARTIAL_SUFFIX = ".wio-partial"
+
+
+class TransferError(Exception):
+    pass
+
+
+def s3_client(wrapper: schemas.TokenNodeWrapper, max_pool_connections: int):
+    """S3 client that uses the credentials in a token/search result"""
+    import boto3
+    from botocore.client import Config
+
+    return boto3.client(
+        "s3",
+        region_name=wrapper.node.region_name,
+        endpoint_url=wrapper.node.api_url,
+        aws_access_key_id=wrapper.token.access_key_id,
+        aws_secret_access_key=wrapper.token.secret_access_key,
+        aws_session_token=wrapper.token.session_token,
+        config=Config(
+            signature_version="s3v4", max_pool_connections=max_pool_connections
+        ),
+    )
+
+
+def token_for(
+    response: schemas.S3TokenSearchResponse, workspace: schemas.WorkspaceDB
+) -> schemas.TokenNodeWrapper:
+    """
+    Pick the credentials in a search response that cover workspace.  A node's
+    workspaces may be split across several tokens, so the node alone is not
+    enough to choose one.
+    """
+    candidates = [w for w in response.tokens if w.node.id == workspace.root.node_id]
+    for wrapper in candidates:
+        if workspace.id in wrapper.workspace_ids:
+            return wrapper
+    # Servers that don't report workspace_ids issue one token per node
+    if len(candidates) == 1 and not candidates[0].workspace_ids:
+        return candidates[0]
+    raise TransferError(f"No credentials were issued for {workspace.name}")
+
+
+def object_key(match: schemas.S3TokenSearchResponseWorkspacePart) -> str:
+    return posixpath.join(
+        s3utils.getWorkspaceKey(match.workspace), match.path.lstrip("/")
+    )
+
+
+def _strip_etag(etag: str) -> str:
+    return etag.strip('"')
+
+
+def _md5_base64(digest: bytes) -> str:
+    return base64.b64encode(digest).decode("ascii")
+
+
+def multipart_etag(part_md5s: List[str]) -> str:
+    """The ETag S3 assigns to a multipart upload made of parts with these MD5s"""
+    combined = b"".join(bytes.fromhex(m) for m in part_md5s)
+    return f"{hashlib.md5(combined).hexdigest()}-{len(part_md5s)}"
+
+
+def file_etag(path: str, part_size: Optional[int] = None) -> str:
+    """
+    Compute the ETag S3 would give this file: its MD5, or if part_size is given,
+    the ETag of a multipart upload with parts of that size.
+    """
+    with open(path, "rb") as f:
+        if part_size is None:
+            digest = hashlib.md5()
+            for chunk in iter(lambda: f.read(READ_CHUNK_SIZE), b""):
+                digest.update(chunk)
+            return digest.hexdigest()
+        md5s: List[str] = []
+        while True:
+            digest = hashlib.md5()
+            read = 0
+            while read < part_size:
+                chunk = f.read(min(READ_CHUNK_SIZE, part_size - read))
+                if not chunk:
+                    break
+                digest.update(chunk)
+                read += len(chunk)
+            if read == 0 and len(md5s):
+                break
+            md5s.append(digest.hexdigest())
+            if read < part_size:
+                break
+    return multipart_etag(md5s)
+
+
+class Journal:
+    """Small JSON state file for one transfer, written atomically"""
+
+    def __init__(self, kind: str, identity: str, directory: str = JOURNAL_DIR):
+        name = hashlib.sha256(identity.encode("utf-8")).hexdigest()
+        self.directory = directory
+        self.path = os.path.join(directory, f"{kind}-{name}.json")
+        self.lock = threading.Lock()
+
+    def load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path) as journal_file:
+                return json.load(journal_file)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, state: Dict[str, Any]):
+        with self.lock:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".journal-")
+            with os.fdopen(fd, "w") as out:
+                json.dump(state, out)
+            os.replace(tmp, self.path)
+
+    def delete(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class TransferEngine:
+    """
+    Moves files between local disk and a single storage node.
+
+    :param client: boto3 s3 client with max_pool_connections >= concurrency
+    :param part_size: bytes per part; files no larger than this are sent whole
+    :param concurrency: parts in flight at once, and files in flight at once
+    :param progress: optional callable taking a number of bytes transferred
+    """
+
+    def __init__(
+        self,
+        client: "boto3.Session",
+        part_size: int = DEFAULT_PART_SIZE,
+        concurrency: int = DEFAULT_CONCURRENCY,
+        progress=None,
+        journal_dir: str = JOURNAL_DIR,
+    ):
+        self.client = client
+        self.part_size = part_size
+        self.concurrency = concurrency
+        self.progress = progress or (lambda n: None)
+        self.journal_dir = journal_dir
+        self.endpoint = client.meta.endpoint_url
+        # Separate pools, so file-level tasks can wait on their parts
+        self.part_pool = ThreadPoolExecutor(max_workers=concurrency)
+        self.file_pool = ThreadPoolExecutor(max_workers=concurrency)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file_pool.shutdown(wait=True)
+        self.part_pool.shutdown(wait=True)
+
+    def _part_size_for(self, size: int) -> int:
+        return max(self.part_size, math.ceil(size / MAX_PARTS))
+
+    # Uploads
+
+    def upload(self, path: str, bucket: str, key: str) -> str:
+        """Upload one file, returning its ETag"""
+        stat = os.stat(path)
+        part_size = self._part_size_for(stat.st_size)
+        if stat.st_size <= part_size:
+            with open(path, "rb") as f:
+                data = f.read()
+            digest = hashlib.md5(data)
+            response = self.client.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=data,
+                ContentMD5=_md5_base64(digest.digest()),
+            )
+            self.progress(len(data))
+            etag = _strip_etag(response["ETag"])
+            if etag != digest.hexdigest():
+                raise TransferError(f"Checksum mismatch uploading {path} to {key}")
+            return etag
+        return self._upload_multipart(path, bucket, key, stat, part_size)
+
+    def _upload_multipart(
+        self, path: str, bucket: str, key: str, stat: os.stat_result, part_size: int
+    ) -> str:
+        journal = Journal(
+            "upload",
+            "|".join(
+                [
+                    self.endpoint,
+                    bucket,
+                    key,
+                    os.path.abspath(path),
+                    str(stat.st_size),
+                    str(stat.st_mtime_ns),
+                    str(part_size),
+                ]
+            ),
+            self.journal_dir,
+        )
+        state = journal.load()
+        # part number -> md5 of parts already on the server
+        done: Dict[int, str] = {}
+        upload_id: Optional[str] = state.get("upload_id", None)
+        if upload_id is not None:
+            uploaded = self._uploaded_parts(bucket, key, upload_id, state["parts"])
+            if uploaded is None:
+                upload_id = None
+            else:
+                done = uploaded
+        if upload_id is None:
+            upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key)[
+                "UploadId"
+            ]
+            done = {}
+        state = {"upload_id": upload_id, "parts": {str(n): m for n, m in done.items()}}
+        journal.save(state)
+
+        count = math.ceil(stat.st_size / part_size)
+        self.progress(sum(self._part_length(stat.st_size, part_size, n) for n in done))
+        futures = [
+            self.part_pool.submit(
+                self._upload_part, path, bucket, key, upload_id, n, part_size
+            )
+            for n in range(1, count + 1)
+            if n not in done
+        ]
+        for future in as_completed(futures):
+            n, md5 = future.result()
+            done[n] = md5
+            state["parts"][str(n)] = md5
+            journal.save(state)
+
+        response = self.client.complete_multipart_upload(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            MultipartUpload={
+                "Parts": [
+                    {"PartNumber": n, "ETag": f'"{done[n]}"'} for n in sorted(done)
+                ]
+            },
+        )
+        journal.delete()
+        etag = _strip_etag(response["ETag"])
+        if etag != multipart_etag([done[n] for n in sorted(done)]):
+            raise TransferError(f"Checksum mismatch uploading {path} to {key}")
+        return etag
+
+    def _uploaded_parts(
+        self, bucket: str, key: str, upload_id: str, recorded: Dict[str, str]
+    ) -> Optional[Dict[int, str]]:
+        """Parts of an interrupted upload that the server has and the journal trusts"""
+        from botocore.exceptions import ClientError
+
+        done: Dict[int, str] = {}
+        try:
+            paginator = self.client.get_paginator("list_parts")
+            for page in paginator.paginate(Bucket=bucket, Key=key, UploadId=upload_id):
+                for part in page.get("Parts", []):
+                    n = part["PartNumber"]
+                    if recorded.get(str(n)) == _strip_etag(part["ETag"]):
+                        done[n] = recorded[str(n)]
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "NoSuchUpload":
+                return None
+            raise
+        return done
+
+    @staticmethod
+    def _part_length(size: int, part_size: int, n: int) -> int:
+        return min(part_size, size - (n - 1) * part_size)
+
+    def _upload_part(
+        self,
+        path: str,
+        bucket: str,
+        key: str,
+        upload_id: str,
+        n: int,
+        part_size: int,
+    ) -> Tuple[int, str]:
+        with open(path, "rb") as f:
+            f.seek((n - 1) * part_size)
+            data = f.read(part_size)
+        digest = hashlib.md5(data)
+        response = self.client.upload_part(
+            Bucket=bucket,
+            Key=key,
+            UploadId=upload_id,
+            PartNumber=n,
+            Body=data,
+            ContentMD5=_md5_base64(digest.digest()),
+        )
+        if _strip_etag(response["ETag"]) != digest.hexdigest():
+            raise TransferError(f"Checksum mismatch on part {n} of {key}")
+        self.progress(len(data))
+        return n, digest.hexdigest()
+
+    def upload_many(self, pairs: Iterable[Tuple[str, str]], bucket: str) -> List[str]:
+        """Upload (local path, key) pairs concurrently"""
+        futures = [
+            self.file_pool.submit(self.upload, path, bucket, key) for path, key in pairs
+        ]
+        return [f.result() for f in futures]
+
+    def upload_each(
+        self, pairs: Iterable[Tuple[str, str]], bucket: str
+    ) -> Iterator[Tuple[str, str, str]]:
+        """Upload (local path, key) pairs concurrently, yielding (path, key, etag)
+        as each one finishes"""
+        futures = {
+            self.file_pool.submit(self.upload, path, bucket, key): (path, key)
+            for path, key in pairs
+        }
+        try:
+            for future in as_completed(futures):
+                path, key = futures[future]
+                yield path, key, future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+    # Downloads
+
+    def download(
+        self,
+        bucket: str,
+        key: str,
+        path: str,
+        head: Optional[Dict[str, Any]] = None,
+    ) -> str:
+        """Download one object to path, returning its ETag"""
+        if head is None:
+            head = self.client.head_object(Bucket=bucket, Key=key)
+        size: int = head["ContentLength"]
+        etag: str = head["ETag"]
+        part_size = self._part_size_for(size)
+        count = max(1, math.ceil(size / part_size))
+        partial = path + PARTIAL_SUFFIX
+        journal = Journal(
+            "download",
+            "|".join([self.endpoint, bucket, key, os.path.abspath(path)]),
+            self.journal_dir,
+        )
+        state = journal.load()
+        if (
+            state.get("etag") != etag
+            or state.get("part_size") != part_size
+            or not os.path.exists(partial)
+        ):
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            with open(partial, "wb") as f:
+                f.truncate(size)
+            state = {"etag": etag, "part_size": part_size, "done": []}
+            journal.save(state)
+        done = set(state["done"])
+        self.progress(sum(self._part_length(size, part_size, n) for n in done))
+        if size > 0:
+            futures = [
+                self.part_pool.submit(
+                    self._download_part, bucket, key, etag, partial, n, part_size, size
+                )
+                for n in range(1, count + 1)
+                if n not in done
+            ]
+            for future in as_completed(futures):
+                done.add(future.result())
+                state["done"] = sorted(done)
+                journal.save(state)
+        self._verify(partial, bucket, key, etag, size)
+        os.replace(partial, path)
+        journal.delete()
+        return _strip_etag(etag)
+
+    def _download_part(
+        self,
+        bucket: str,
+        key: str,
+        etag: str,
+        partial: str,
+        n: int,
+        part_size: int,
+        size: int,
+    ) -> int:
+        start = (n - 1) * part_size
+        end = min(start + part_size, size) - 1
+        response = self.client.get_object(
+            Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag
+        )
+        with open(partial, "r+b") as f:
+            f.seek(start)
+            for chunk in response["Body"].iter_chunks(READ_CHUNK_SIZE):
+                f.write(chunk)
+                self.progress(len(chunk))
+        return n
+
+    def _uploaded_part_size(
+        self, bucket: str, key: str, etag: str, size: int, parts: int
+    ) -> Optional[int]:
+        """
+        The part size a multipart object was uploaded with, from the length of
+        its first part, or None if the server can't tell
+        """
+        from botocore.exceptions import BotoCoreError, ClientError
+
+        try:
+            head = self.client.head_object(
+                Bucket=bucket, Key=key, PartNumber=1, IfMatch=etag
+            )
+        except (BotoCoreError, ClientError):
+            return None
+        part_size = head.get("ContentLength")
+        if not part_size or math.ceil(size / part_size) != parts:
+            # PartNumber was ignored, or the parts differ in size
+            return None
+        return part_size
+
+    def _verify(self, path: str, bucket: str, key: str, etag: str, size: int):
+        etag = _strip_etag(etag)
+        match = re.fullmatch(r"([0-9a-f]{32})(?:-(\d+))?", etag)
+        if match is None:
+            # Encrypted objects have ETags that aren't MD5s
+            return
+        multipart_size: Optional[int] = None
+        if match.group(2) is not None:
+            # The ETag depends on the part size used by whoever uploaded it,
+            # which a matching part count alone doesn't tell
+            multipart_size = self._uploaded_part_size(
+                bucket, key, etag, size, int(match.group(2))
+            )
+            if multipart_size is None:
+                return
+        if file_etag(path, multipart_size) != etag:
+            os.unlink(path)
+            raise TransferError(f"Checksum mismatch downloading {key}")
+
+    def list(self, bucket: str, prefix: str) -> Iterable[Dict[str, Any]]:
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            yield from page.get("Contents", [])
+
+    def download_many(
+        self, bucket: str, pairs: Iterable[Tuple[str, str, Optional[Dict[str, Any]]]]
+    ) -> List[str]:
+        """Download (key, local path, head or None) triples concurrently"""
+        futures = [
+            self.file_pool.submit(self.download, bucket, key, path, head)
+            for key, path, head in pairs
+        ]
+        return [f.result() for f in futures]
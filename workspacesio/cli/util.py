@@ -1,7 +1,7 @@
 import json
 from collections.abc import Iterable
 from json.decoder import JSONDecodeError
-from typing import List
+from typing import List, NoReturn
 
 import click
 from requests import Response
@@ -40,7 +40,7 @@ def handle_request_error(r: Response) -> dict:
     return {"response": r.json()}
 
 
-def exit_with(out: dict):
+def exit_with(out: dict) -> NoReturn:
     if out.get("error"):
         click.secho(json.dumps(out, indent=2, sort_keys=True), fg="red")
         exit(1)
@@ -156,6 +156,13 @@ def make(cli: click.Group):
                 data=payload.json(),
             )
             r.raise_for_status()
+            added = indexing_schemas.IndexBulkAddedResponse(**r.json())
+            for failure in added.failures:
+                click.secho(
+                    f"index failed status={failure.status} path={failure.path} "
+                    f"error={failure.error}",
+                    fg="red",
+                )
         exit_with(
             handle_request_error(
                 ctx.session.post(
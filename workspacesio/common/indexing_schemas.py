@@ -130,6 +130,14 @@ class IndexDB(schemas.DBBaseModel, IndexBase):
     root: schemas.WorkspaceRootDB
 
 
+class ElasticHealth(BaseModel):
+    """Readiness of the elasticsearch cluster"""
+
+    ready: bool
+    status: Optional[str]
+    number_of_nodes: Optional[int]
+
+
 class IndexBulkAdd(BaseModel):
     """Bulk add records from a workspace into the index"""
 
@@ -146,9 +154,18 @@ class IndexBulkAdd(BaseModel):
         return v
 
 
+class IndexBulkFailure(BaseModel):
+    """A document that elasticsearch rejected, which the client may resend"""
+
+    path: str
+    status: int
+    error: str
+
+
 class IndexBulkAddedResponse(BaseModel):
     index: IndexDB
     count: int
+    failures: List[IndexBulkFailure] = []
 
 
 class EventUserIdentity(BaseModel):
@@ -194,6 +211,15 @@ class BucketEventNotification(BaseModel):
     Key: Optional[str]
 
 
+class BucketEventDeadLetterDB(schemas.DBBaseModel):
+    bucket: str
+    key: str
+    event_name: str
+    record: dict
+    attempts: int
+    error: str
+
+
 class ElasticUpsertIndexDocument(BaseModel):
     doc: IndexDocument
     doc_as_upsert = True
@@ -8,25 +8,65 @@ import hmac
 import os
 import posixpath
 import sys
+import threading
 import urllib.parse
 import uuid
-from typing import List, Optional, Set, Tuple, TypedDict, Union
-
-import boto3
-import minio
-from botocore.client import Config
+from collections import OrderedDict
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    Union,
+)
 
 from . import schemas
 
+if TYPE_CHECKING:
+    # boto3 and minio are slow to import, and most callers (including the
+    # CLI) only need the key helpers in this module
+    import boto3
+    import minio
+
 
 class Boto3ClientCache:
     """
     There may be many s3 nodes in the cluser.  Once a client has been established,
     cache it for future use.  This class works for sts and s3 type clients.
+
+    A single cache is intended to be shared for the life of the process, so
+    access is guarded by a lock and the least recently used clients are evicted
+    once more than `maxsize` have been created.
+
+    :param maxsize: maximum number of clients to hold at once
+    :param max_pool_connections: default urllib3 connection pool size per client
+    :param node_pool_connections: pool size overrides by storage node name
+    :param timeout: connect and read timeout in seconds, or None for botocore defaults
     """
 
-    def __init__(self):
-        self.cache: Dict[str, boto3.Session] = {}
+    def __init__(
+        self,
+        maxsize: int = 64,
+        max_pool_connections: int = 10,
+        node_pool_connections: Optional[Dict[str, int]] = None,
+        timeout: Optional[float] = None,
+    ):
+        self.maxsize = maxsize
+        self.max_pool_connections = max_pool_connections
+        self.node_pool_connections = node_pool_connections or {}
+        self.timeout = timeout
+        self.cache: "OrderedDict[str, Any]" = OrderedDict()
+        # Most recent primary key for each (client type, node id) so that
+        # clients built with stale credentials can be dropped eagerly.
+        self.node_keys: Dict[Tuple[str, str], str] = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
 
     @staticmethod
     def _get_primary_key(client_type: str, node: schemas.StorageNodeOperator) -> str:
@@ -42,18 +82,55 @@ class Boto3ClientCache:
         )
         return hashlib.sha256(primary_key).hexdigest()
 
+    def _pool_connections(self, node: schemas.StorageNodeOperator) -> int:
+        return self.node_pool_connections.get(node.name, self.max_pool_connections)
+
+    def _get_or_create(
+        self,
+        client_kind: str,
+        node: schemas.StorageNodeOperator,
+        primary_key: str,
+        factory: Callable[[], Any],
+    ) -> Any:
+        with self.lock:
+            client = self.cache.get(primary_key, None)
+            if client is not None:
+                self.hits += 1
+                self.cache.move_to_end(primary_key)
+                return client
+            self.misses += 1
+            node_key = (client_kind, str(node.id))
+            stale_key = self.node_keys.get(node_key)
+            if stale_key is not None and stale_key != primary_key:
+                # Node credentials or endpoint changed since the last client was built
+                self.cache.pop(stale_key, None)
+            # boto3's default session is not thread safe, so build under the lock
+            client = factory()
+            self.cache[primary_key] = client
+            self.node_keys[node_key] = primary_key
+            while len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+            return client
+
     def get_client(
         self,
         client_type: str,
         node: schemas.StorageNodeOperator,
-    ) -> boto3.Session:
+    ) -> "boto3.Session":
         primary_key_short_sha256 = Boto3ClientCache._get_primary_key(client_type, node)
-        client = self.cache.get(primary_key_short_sha256, None)
-        if client is None:
-            config = Config()
+
+        def factory():
+            import boto3
+            from botocore.client import Config
+
+            config = Config(max_pool_connections=self._pool_connections(node))
+            if self.timeout is not None:
+                config = config.merge(
+                    Config(connect_timeout=self.timeout, read_timeout=self.timeout)
+                )
             if client_type == "s3":
-                config = Config(signature_version="s3v4")
-                client = boto3.client(
+                config = config.merge(Config(signature_version="s3v4"))
+                return boto3.client(
                     client_type,
                     region_name=node.region_name,
                     endpoint_url=node.api_url,
@@ -68,33 +145,45 @@ class Boto3ClientCache:
                     api_url = node.sts_api_url
                 elif is_aws:
                     api_url = f"https://sts.{node.region_name}.amazonaws.com"
-                client = boto3.client(
+                return boto3.client(
                     client_type,
                     region_name=node.region_name,
                     endpoint_url=api_url,
                     aws_access_key_id=node.access_key_id,
                     aws_secret_access_key=node.secret_access_key,
+                    config=config,
                 )
             else:
                 raise NotImplementedError("Client type not implemented")
-            self.cache[primary_key_short_sha256] = client
-        return client
 
-    def get_minio_sdk_client(self, node: schemas.StorageNodeOperator) -> minio.Minio:
+        return self._get_or_create(client_type, node, primary_key_short_sha256, factory)
+
+    def get_minio_sdk_client(self, node: schemas.StorageNodeOperator) -> "minio.Minio":
         primary_key_short_sha256 = (
             Boto3ClientCache._get_primary_key("s3", node) + "minio"
         )
-        client = self.cache.get(primary_key_short_sha256, None)
-        url = urllib.parse.urlparse(node.api_url)
-        if client is None:
-            client = minio.Minio(
+
+        def factory():
+            import minio
+
+            url = urllib.parse.urlparse(node.api_url)
+            return minio.Minio(
                 url.netloc,
                 access_key=node.access_key_id,
                 secret_key=node.secret_access_key,
                 secure=False,
             )
-            self.cache[primary_key_short_sha256] = client
-        return client
+
+        return self._get_or_create("minio", node, primary_key_short_sha256, factory)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {
+                "size": len(self.cache),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
 
 
 def sanitize(name: str) -> str:
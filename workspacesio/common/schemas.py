@@ -59,6 +59,7 @@ class StorageNodeBase(BaseModel):
     api_url: str
     sts_api_url: Optional[str]
     region_name: str
+    token_duration_seconds: Optional[int]
 
 
 class StorageNodeCreate(StorageNodeBase):
@@ -204,6 +205,9 @@ class S3TokenSearchResponseWorkspacePart(BaseModel):
 class TokenNodeWrapper(BaseModel):
     token: S3TokenDB
     node: StorageNodeDB
+    # Requested workspaces that this token grants access to.  A node's
+    # workspaces may be split across several tokens.
+    workspace_ids: List[uuid.UUID] = []
 
 
 class S3TokenSearchResponse(BaseModel):
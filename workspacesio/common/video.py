@@ -1,8 +1,6 @@
 import posixpath
 import urllib.parse
 
-import ffmpeg
-
 from . import indexing_schemas, s3utils, schemas
 
 
@@ -12,6 +10,8 @@ def probe(
     root: schemas.WorkspaceRootDB,
     workspace: schemas.WorkspaceDB,
 ):
+    import ffmpeg
+
     endpoint = node.api_url
     parsed = urllib.parse.urlparse(endpoint)
     host = parsed.netloc
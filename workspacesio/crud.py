@@ -1,8 +1,13 @@
+import concurrent.futures
 import datetime
+import hashlib
 import json
 import logging
 import os
+import random
 import secrets
+import threading
+import time
 import urllib.parse
 import uuid
 from typing import Dict, List, Optional, Tuple, Union
@@ -10,12 +15,12 @@ from typing import Dict, List, Optional, Tuple, Union
 import bcrypt
 import boto3
 import elasticsearch
-from botocore.exceptions import ClientError
+from botocore.exceptions import BotoCoreError, ClientError
 from fastapi import FastAPI, HTTPException, Request
 from fastapi.responses import JSONResponse
-from sqlalchemy import and_, any_, func, or_
+from sqlalchemy import and_, any_, exists, func, or_
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, joinedload
 from sqlalchemy.sql import text
 
 from workspacesio.common import s3utils, schemas
@@ -23,6 +28,12 @@ from workspacesio.common import s3utils, schemas
 from . import models, s3policy, settings
 
 logger = logging.getLogger("api")
+# Avoid a write on every token reuse
+TOKEN_LAST_USED_RESOLUTION = datetime.timedelta(minutes=1)
+# Bounded pool for concurrent STS calls across storage nodes
+sts_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=settings.settings.sts_max_workers
+)
 
 
 def register_handlers(app: FastAPI):
@@ -55,8 +66,31 @@ def group_workspaces_by_node(
     return node_groups
 
 
+def share_map(
+    db: Session, requester: schemas.UserDB, workspaces: List[models.Workspace]
+) -> Dict[uuid.UUID, models.Share]:
+    """Load requester's shares for all of the workspaces in a single query"""
+    foreign_ids = [w.id for w in workspaces if w.owner_id != requester.id]
+    if len(foreign_ids) == 0:
+        return {}
+    shares: List[models.Share] = (
+        db.query(models.Share)
+        .filter(
+            and_(
+                models.Share.workspace_id.in_(foreign_ids),
+                models.Share.sharee_id == requester.id,
+            )
+        )
+        .all()
+    )
+    return {share.workspace_id: share for share in shares}
+
+
 def segment_workspaces(
-    db: Session, workspaces: List[models.Workspace], requester: schemas.UserDB
+    db: Session,
+    workspaces: List[models.Workspace],
+    requester: schemas.UserDB,
+    shares: Optional[Dict[uuid.UUID, models.Share]] = None,
 ) -> Tuple[
     List[models.Workspace],
     List[Tuple[models.Workspace, Optional[models.Share]]],
@@ -65,20 +99,13 @@ def segment_workspaces(
     # foreign workspaces are the matches that have an owner other than the requester
     # that the requester DOES have a share for.  If the workspace is public and unshared,
     # Access is covered by the default policy
+    if shares is None:
+        shares = share_map(db, requester, workspaces)
     requester_workspaces: List[models.Workspace] = []
     foreign_workspaces: List[Tuple[models.Workspace, Optional[models.Share]]] = []
     for w in workspaces:
         if w.owner_id != requester.id:
-            share: models.Share = (
-                db.query(models.Share)
-                .filter(
-                    and_(
-                        models.Share.workspace_id == w.id,
-                        models.Share.sharee_id == requester.id,
-                    )
-                )
-                .first()
-            )
+            share = shares.get(w.id, None)
             if share:
                 foreign_workspaces.append(
                     (
@@ -122,82 +149,172 @@ def segment_workspaces(
     )
 
 
+def constellation_hash(
+    roots: List[models.WorkspaceRoot],
+    foreign_workspaces: List[Tuple[models.Workspace, Optional[models.Share]]],
+) -> str:
+    """
+    Canonical hash of everything that determines a token's policy: the roots
+    covered by default policy, and each foreign workspace with its share permission.
+    """
+    parts = sorted(f"root:{r.id}" for r in roots) + sorted(
+        f"workspace:{w.id}:{share.permission.value if share else ''}"
+        for w, share in foreign_workspaces
+    )
+    return hashlib.sha256("\n".join(parts).encode("utf-8")).hexdigest()
+
+
 def get_token_for_workspace_constellation(
     db: Session,
     requester_id: uuid.UUID,
-    workspaces: List[models.Workspace],
-    foreign_workspaces=List[models.Workspace],
+    storage_node_id: uuid.UUID,
+    constellation: str,
 ) -> Optional[models.S3Token]:
     """
     Workspace constellation must all be from the same server
     """
-    query = db.query(models.S3Token)
-    filters = []
-    if len(foreign_workspaces) > 0:
-        query = query.outerjoin(models.Workspace, models.S3Token.workspaces)
-        filters.append(or_(*[models.Workspace.id == w.id for w in foreign_workspaces]))
-    if len(workspaces) > 0:
-        query = query.outerjoin(models.WorkspaceRoot, models.S3Token.roots)
-        filters.append(
-            or_(*[models.WorkspaceRoot.id == w.root_id for w in workspaces]),
+    return (
+        db.query(models.S3Token)
+        .filter(
+            and_(
+                models.S3Token.owner_id == requester_id,
+                models.S3Token.storage_node_id == storage_node_id,
+                models.S3Token.constellation_hash == constellation,
+            )
         )
+        .order_by(models.S3Token.expiration.desc())
+        .first()
+    )
+
 
-    # https://stackoverflow.com/questions/11468572/postgresql-where-all-in-array
-    query = (
-        query.filter(and_(models.S3Token.owner_id == requester_id, *filters))
-        .group_by(models.S3Token.id)
-        .having(func.count("*") >= (len(foreign_workspaces) + len(workspaces)))
+def token_is_fresh(token: Optional[models.S3Token]) -> bool:
+    return token is not None and token.expiration > datetime.datetime.utcnow()
+
+
+def token_touch(token: models.S3Token):
+    """Record use of a token so that the refresher keeps it warm"""
+    now = datetime.datetime.utcnow()
+    if token.last_used is None or now - token.last_used > TOKEN_LAST_USED_RESOLUTION:
+        token.last_used = now
+
+
+def lock_constellation(
+    db: Session,
+    requester_id: uuid.UUID,
+    storage_node_id: uuid.UUID,
+    constellation: str,
+    wait: bool = True,
+) -> bool:
+    """
+    Single-flight token issuance across all workers.  The postgres advisory lock is
+    held until the transaction ends, so concurrent identical requests wait for the
+    first one to commit its token and then find it with a normal lookup.
+
+    :param wait: if False, return False immediately when the lock is taken
+    """
+    digest = hashlib.sha256(
+        f"{requester_id}:{storage_node_id}:{constellation}".encode("utf-8")
+    ).digest()
+    key = int.from_bytes(digest[:8], "big", signed=True)
+    if wait:
+        db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": key})
+        return True
+    return db.execute(
+        text("SELECT pg_try_advisory_xact_lock(:key)"), {"key": key}
+    ).scalar()
+
+
+def policy_get_or_create(db: Session, policy: s3policy.PolicyDoc) -> models.S3Policy:
+    """Policy documents are stored once and shared by every token that uses them"""
+    policy_hash = s3policy.hashPolicy(policy)
+    # Share-locked so that policy_delete_unused can't remove it before the
+    # token that will reference it is committed
+    policy_db: Optional[models.S3Policy] = (
+        db.query(models.S3Policy)
+        .filter(models.S3Policy.policy_hash == policy_hash)
+        .with_for_update(read=True)
+        .first()
     )
-    return query.first()
+    if policy_db is None:
+        try:
+            with db.begin_nested():
+                policy_db = models.S3Policy(policy_hash=policy_hash, document=policy)
+                db.add(policy_db)
+        except IntegrityError:
+            # Lost a race with another request inserting the same document
+            policy_db = (
+                db.query(models.S3Policy)
+                .filter(models.S3Policy.policy_hash == policy_hash)
+                .one()
+            )
+    return policy_db
 
 
-def match_terms(
-    db: Session, requester: schemas.UserDB, term: str, sep: str = "/"
-) -> Tuple[Optional[models.Workspace], Optional[str]]:
+def resolve_terms(
+    db: Session, requester: schemas.UserDB, terms: List[str], sep: str = "/"
+) -> Dict[str, Tuple[Optional[models.Workspace], Optional[str]]]:
     """
-    Annoying search criteria.
+    Annoying search criteria, resolved for many terms at once with
+    one query for users and one for workspaces.
     """
     # Look for either 'workspacename' or 'username/workspacename'
-    all_term_parts = term.strip(sep).split(sep)
-    term_parts = all_term_parts
-    user_id: Optional[uuid.UUID] = None
-
-    if len(term_parts) >= 2:
-        # if there are at least two terms, there's a chance
-        # the first term is a username
-        user: Optional[models.User] = (
-            db.query(models.User)
-            .filter(models.User.username.ilike(term_parts[0]))
-            .first()
-        )
-        if user is not None:
-            user_id = user.id
-            term_parts = term_parts[1:]
-    if len(term_parts) >= 1:
-        # if there's at least 1 remaining term,
-        # it could be a workspace, and user_id could have been set
-        matches: List[models.Workspace] = workspace_search(
-            db,
-            requester,
-            name=term_parts[0],
-            owner_id=user_id,
+    split_terms = {term: term.strip(sep).split(sep) for term in terms}
+    # if there are at least two parts, there's a chance
+    # the first part is a username
+    candidate_usernames = set(
+        parts[0].lower() for parts in split_terms.values() if len(parts) >= 2
+    )
+    users: Dict[str, uuid.UUID] = {}
+    if len(candidate_usernames):
+        for user_id, username in (
+            db.query(models.User.id, models.User.username)
+            .filter(func.lower(models.User.username).in_(candidate_usernames))
+            .order_by(models.User.created)
+        ):
+            users.setdefault(username.lower(), user_id)
+
+    # term -> (workspace name, owner_id or None, interior path parts)
+    wanted: Dict[str, Tuple[str, Optional[uuid.UUID], List[str]]] = {}
+    for term, parts in split_terms.items():
+        owner_id: Optional[uuid.UUID] = None
+        if len(parts) >= 2 and parts[0].lower() in users:
+            owner_id = users[parts[0].lower()]
+            parts = parts[1:]
+        # if there's at least 1 remaining part,
+        # it could be a workspace, and owner_id could have been set
+        wanted[term] = (parts[0], owner_id, parts[1:])
+
+    by_name: Dict[str, List[models.Workspace]] = {}
+    names = set(name for name, _, _ in wanted.values())
+    if len(names):
+        visible: List[models.Workspace] = (
+            visible_workspaces(db, requester, public=True)
+            .filter(models.Workspace.name.in_(names))
+            .all()
         )
+        for w in visible:
+            by_name.setdefault(w.name, []).append(w)
+
+    resolved: Dict[str, Tuple[Optional[models.Workspace], Optional[str]]] = {}
+    for term, (name, owner_id, rest) in wanted.items():
+        matches = [
+            w
+            for w in by_name.get(name, [])
+            if owner_id is None or w.owner_id == owner_id
+        ]
         if len(matches) == 1:
-            return matches[0], sep.join(term_parts[1:])
+            resolved[term] = (matches[0], sep.join(rest))
         elif len(matches) > 1:
-            raise RuntimeError(f"Multiple workspace matches for {term_parts[0]}")
+            raise RuntimeError(f"Multiple workspace matches for {name}")
         else:
-            # hail mary search, for when you found a user match for arg1
-            # but there was no workspace for arg2, so maybe the arg1
-            # match was a coincidence
-            hail_mary_matches: List[models.Workspace] = workspace_search(
-                db, requester, name=all_term_parts[0]
-            )
-            if len(matches) == 1:
-                return matches[0], sep.join(all_term_parts[1:])
-            elif len(matches) > 1:
-                raise RuntimeError(f"Multiple workspace matches for {term_parts[0]}")
-    return None, None
+            resolved[term] = (None, None)
+    return resolved
+
+
+def match_terms(
+    db: Session, requester: schemas.UserDB, term: str, sep: str = "/"
+) -> Tuple[Optional[models.Workspace], Optional[str]]:
+    return resolve_terms(db, requester, [term], sep=sep)[term]
 
 
 def get_user_by(
@@ -310,6 +427,25 @@ def root_start_import(db: Session, creator: schemas.UserDB, root_id: uuid.UUID):
     return schemas.RootCredentials(root=root, node=node)
 
 
+def visible_workspaces(db: Session, requester: schemas.UserDB, public: bool = False):
+    """Query for workspaces the requester owns or has a share for, and optionally
+    all public workspaces"""
+    main_filter = or_(
+        models.Workspace.owner_id == requester.id,
+        models.Share.sharee_id == requester.id,
+    )
+    if public:
+        main_filter = or_(
+            main_filter, models.Workspace.root.has(root_type=schemas.RootType.PUBLIC)
+        )
+    return (
+        db.query(models.Workspace)
+        .outerjoin(models.Share)
+        .filter(main_filter)
+        .group_by(models.Workspace.id)
+    )
+
+
 def workspace_search(
     db: Session,
     requester: schemas.UserDB,
@@ -321,26 +457,16 @@ def workspace_search(
     """Show workspaces that are public,
     the requester owns, or has a share for, that meet the optional
     conditions"""
-    q = db.query(models.Workspace).outerjoin(models.Share)
-    main_filter = or_(
-        models.Workspace.owner_id == requester.id,
-        models.Share.sharee_id == requester.id,
-    )
-    if name is not None:
+    if name is not None or like is not None:
         # when name is specified, automatically include public
-        q = q.filter(models.Workspace.name == name)
         public = True
+    q = visible_workspaces(db, requester, public=bool(public))
+    if name is not None:
+        q = q.filter(models.Workspace.name == name)
     if like is not None:
         q = q.filter(models.Workspace.name.contains(like))
-        public = True
-    if public:
-        main_filter = or_(
-            main_filter, models.Workspace.root.has(root_type=schemas.RootType.PUBLIC)
-        )
-    q = q.filter(main_filter)
     if owner_id is not None:
         q = q.filter(models.Workspace.owner_id == owner_id)
-    q = q.group_by(models.Workspace.id)
 
     return q.all()
 
@@ -454,12 +580,15 @@ def apikey_create(db: Session, requester: models.User) -> schemas.ApiKeyCreateRe
     return schemas.ApiKeyCreateResponse(**schemad.dict(), secret=key_str)
 
 
-def apikey_delete_all(db: Session, requester: models.User):
+def apikey_delete_all(db: Session, requester: models.User) -> List[str]:
+    """Delete all of requester's keys, and return their key ids"""
     keys: List[models.ApiKey] = (
         db.query(models.ApiKey).filter(models.ApiKey.user_id == requester.id).all()
     )
+    key_ids = [key.key_id for key in keys]
     [db.delete(key) for key in keys]
     db.commit()
+    return key_ids
 
 
 def token_list(db: Session, requester: schemas.UserDB) -> List[models.S3Token]:
@@ -476,6 +605,27 @@ def token_list(db: Session, requester: schemas.UserDB) -> List[models.S3Token]:
     )
 
 
+def assume_role(
+    b3: s3utils.Boto3ClientCache,
+    node: models.StorageNode,
+    requester_id: uuid.UUID,
+    policy: s3policy.PolicyDoc,
+) -> dict:
+    """Issue temporary credentials restricted to policy"""
+    duration = {}
+    if node.token_duration_seconds:
+        duration["DurationSeconds"] = node.token_duration_seconds
+    new_token = b3.get_client("sts", node).assume_role(
+        RoleArn=node.assume_role_arn
+        or "arn:xxx:xxx:xxx:xxxx",  # Not meaningful for Minio
+        RoleSessionName=str(requester_id),  # Not meaningful for Minio
+        # Session policy limits count packed bytes
+        Policy=json.dumps(policy, separators=(",", ":")),
+        **duration,
+    )
+    return new_token["Credentials"]
+
+
 def token_create(
     db: Session,
     b3: s3utils.Boto3ClientCache,
@@ -483,11 +633,18 @@ def token_create(
     token: schemas.S3TokenCreate,
 ) -> List[schemas.TokenNodeWrapper]:
     """Create s3 sts token for requester if they have permissions"""
-    # Find all workspaces in the query
+    # Find all workspaces in the query, along with everything that
+    # policy generation will touch, so that nothing is lazy-loaded per workspace
     workspace_query_list: List[models.Workspace] = (
         db.query(
             models.Workspace,
         )
+        .options(
+            joinedload(models.Workspace.owner),
+            joinedload(models.Workspace.root).joinedload(
+                models.WorkspaceRoot.storage_node
+            ),
+        )
         .filter(models.Workspace.id.in_(token.workspaces))
         .all()
     )
@@ -495,68 +652,265 @@ def token_create(
     if len(workspace_query_list) == 0:
         return []
 
-    tokens: List[schemas.TokenNodeWrapper] = []
+    # token, node, and the requested workspaces it covers
+    tokens: List[Tuple[models.S3Token, models.StorageNode, List[uuid.UUID]]] = []
     groups = group_workspaces_by_node(workspace_query_list)
-
+    shares = share_map(db, requester, workspace_query_list)
+    # A node's workspaces are covered by one token, or several if its policy
+    # would be too large for STS.  Each one is keyed by its own constellation.
+    # Only the first carries the node's roots, and with them the requester's
+    # own workspaces.
+    wanted: List[
+        Tuple[
+            uuid.UUID,
+            str,
+            List[models.WorkspaceRoot],
+            s3policy.ForeignWorkspaces,
+            models.StorageNode,
+            s3policy.PolicyDoc,
+            List[uuid.UUID],
+        ]
+    ] = []
     for node_id, workspaces in groups.items():
         my_workspaces, foreign_workspaces, roots = segment_workspaces(
-            db=db, workspaces=workspaces, requester=requester
+            db=db, workspaces=workspaces, requester=requester, shares=shares
         )
         storage_node: models.StorageNode
         if len(roots) > 0:
             storage_node = roots[0].storage_node
         elif len(foreign_workspaces) > 0:
             storage_node = foreign_workspaces[0][0].root.storage_node
-        existing = get_token_for_workspace_constellation(
-            db=db,
-            requester_id=requester.id,
+        compiled = s3policy.compilePolicies(
+            requester,
             workspaces=my_workspaces,
-            foreign_workspaces=[f[0] for f in foreign_workspaces],
+            foreign_workspaces=foreign_workspaces,
+            key=constellation_hash(roots, foreign_workspaces),
         )
-        if existing and existing.expiration > datetime.datetime.utcnow():
-            tokens.append(
-                schemas.TokenNodeWrapper(
-                    token=existing,
-                    node=storage_node,
+        for index, (foreign_chunk, policy) in enumerate(compiled):
+            chunk_roots = roots if index == 0 else []
+            covered = [w.id for w, _ in foreign_chunk]
+            if index == 0:
+                covered += [w.id for w in my_workspaces]
+            constellation = constellation_hash(chunk_roots, foreign_chunk)
+            wanted.append(
+                (
+                    node_id,
+                    constellation,
+                    chunk_roots,
+                    foreign_chunk,
+                    storage_node,
+                    policy,
+                    covered,
                 )
             )
-            continue
+
+    # constellation -> token to update (or args for a new one), node, policy,
+    # and covered workspaces
+    pending: Dict[
+        str,
+        Tuple[
+            Optional[models.S3Token],
+            dict,
+            models.StorageNode,
+            s3policy.PolicyDoc,
+            List[uuid.UUID],
+        ],
+    ] = {}
+    # Locks are always taken in the same order so overlapping requests cannot deadlock
+    for (
+        node_id,
+        constellation,
+        roots,
+        foreign_workspaces,
+        storage_node,
+        policy,
+        covered,
+    ) in sorted(wanted, key=lambda w: (str(w[0]), w[1])):
+        lookup = dict(
+            db=db,
+            requester_id=requester.id,
+            storage_node_id=node_id,
+            constellation=constellation,
+        )
+        existing = get_token_for_workspace_constellation(**lookup)
+        if not token_is_fresh(existing):
+            # Only wait on the lock when a token actually has to be issued
+            lock_constellation(db, requester.id, node_id, constellation)
+            existing = get_token_for_workspace_constellation(**lookup)
+        if existing and token_is_fresh(existing):
+            token_touch(existing)
+            tokens.append((existing, storage_node, covered))
         else:
-            policy = s3policy.makePolicy(
-                requester,
-                workspaces=my_workspaces,
-                foreign_workspaces=foreign_workspaces,
-            )
             token_args = dict(
                 owner_id=requester.id,
-                policy=policy,
                 workspaces=[f[0] for f in foreign_workspaces],
                 roots=roots,
                 storage_node_id=node_id,
+                constellation_hash=constellation,
             )
-            new_token = b3.get_client(
-                "sts", workspaces[0].root.storage_node
-            ).assume_role(
-                RoleArn=storage_node.assume_role_arn
-                or "arn:xxx:xxx:xxx:xxxx",  # Not meaningful for Minio
-                RoleSessionName=str(requester.id),  # Not meaningful for Minio
-                Policy=json.dumps(policy),
-                # DurationSeconds=900,
+            pending[constellation] = (
+                existing,
+                token_args,
+                storage_node,
+                policy,
+                covered,
+            )
+
+    failed: List[str] = []
+    if len(pending):
+        # The session sits idle while workers run, and node attributes were
+        # eagerly loaded above, so reading them from worker threads is safe.
+        futures = {
+            constellation: sts_executor.submit(
+                assume_role, b3, storage_node, requester.id, policy
             )
+            for constellation, (_, _, storage_node, policy, _) in pending.items()
+        }
+        concurrent.futures.wait(
+            futures.values(), timeout=settings.settings.s3_client_timeout
+        )
+        for constellation, future in futures.items():
+            existing, token_args, storage_node, policy, covered = pending[constellation]
+            try:
+                credentials = future.result(timeout=0)
+            except (
+                ClientError,
+                BotoCoreError,
+                concurrent.futures.TimeoutError,
+            ) as e:
+                future.cancel()
+                logger.warning(f"STS assume_role failed for {storage_node.name}: {e}")
+                failed.append(storage_node.name)
+                continue
+            policy_db = policy_get_or_create(db, policy)
             token_db = existing or models.S3Token(**token_args)
-            token_db.access_key_id = new_token["Credentials"]["AccessKeyId"]
-            token_db.secret_access_key = new_token["Credentials"]["SecretAccessKey"]
-            token_db.session_token = new_token["Credentials"]["SessionToken"]
-            token_db.expiration = new_token["Credentials"]["Expiration"]
+            token_db.policy_document = policy_db
+            token_db.access_key_id = credentials["AccessKeyId"]
+            token_db.secret_access_key = credentials["SecretAccessKey"]
+            token_db.session_token = credentials["SessionToken"]
+            token_db.expiration = credentials["Expiration"]
+            token_db.last_used = datetime.datetime.utcnow()
             db.add(token_db)
-            db.commit()
-            tokens.append(
-                schemas.TokenNodeWrapper(
-                    token=token_db,
-                    node=storage_node,
-                )
+            tokens.append((token_db, storage_node, covered))
+    db.flush()
+    # Serialized before commit expires the workspaces, owners and roots loaded above
+    wrappers = [
+        schemas.TokenNodeWrapper(
+            token=token_db, node=storage_node, workspace_ids=covered
+        )
+        for token_db, storage_node, covered in tokens
+    ]
+    db.commit()
+    if len(tokens) == 0 and len(failed):
+        raise HTTPException(
+            status_code=502,
+            detail=f"Could not issue credentials for nodes {', '.join(failed)}",
+        )
+    return wrappers
+
+
+def _refresh_credentials(
+    b3: s3utils.Boto3ClientCache,
+    semaphore: threading.BoundedSemaphore,
+    node: models.StorageNode,
+    requester_id: uuid.UUID,
+    policy: s3policy.PolicyDoc,
+) -> dict:
+    # Spread refreshes out so that tokens issued together aren't renewed together
+    time.sleep(random.uniform(0, settings.settings.token_refresh_jitter))
+    with semaphore:
+        return assume_role(b3, node, requester_id, policy)
+
+
+def token_refresh_expiring(db: Session, b3: s3utils.Boto3ClientCache) -> int:
+    """
+    Reissue tokens that are about to expire and were used recently, so that
+    active users never wait on STS.  Tokens whose shares have changed since they
+    were issued are left alone and rebuilt on the next request.
+    """
+    now = datetime.datetime.utcnow()
+    horizon = now + datetime.timedelta(seconds=settings.settings.token_refresh_window)
+    candidates: List[models.S3Token] = (
+        db.query(models.S3Token)
+        .options(
+            joinedload(models.S3Token.owner),
+            joinedload(models.S3Token.storage_node),
+            joinedload(models.S3Token.policy_document),
+        )
+        .filter(
+            and_(
+                models.S3Token.expiration < horizon,
+                models.S3Token.last_used
+                > now
+                - datetime.timedelta(
+                    seconds=settings.settings.token_refresh_active_window
+                ),
             )
-    return tokens
+        )
+        .order_by(models.S3Token.expiration)
+        .limit(settings.settings.token_refresh_batch_size)
+        .all()
+    )
+    refreshable: List[models.S3Token] = []
+    for token_db in candidates:
+        shares = share_map(db, token_db.owner, token_db.workspaces)
+        foreign_workspaces = [(w, shares.get(w.id, None)) for w in token_db.workspaces]
+        if any(
+            share is None and w.owner_id != token_db.owner_id
+            for w, share in foreign_workspaces
+        ):
+            continue
+        constellation = constellation_hash(token_db.roots, foreign_workspaces)
+        if constellation != token_db.constellation_hash:
+            continue
+        # Another worker may already be refreshing this constellation
+        if not lock_constellation(
+            db, token_db.owner_id, token_db.storage_node_id, constellation, wait=False
+        ):
+            continue
+        # ...or may have finished since the candidates were loaded
+        db.refresh(token_db)
+        if token_db.expiration < horizon:
+            refreshable.append(token_db)
+    if len(refreshable) == 0:
+        db.commit()
+        return 0
+
+    semaphores = {
+        node_id: threading.BoundedSemaphore(
+            settings.settings.token_refresh_node_concurrency
+        )
+        for node_id in set(t.storage_node_id for t in refreshable)
+    }
+    refreshed = 0
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(semaphores) * settings.settings.token_refresh_node_concurrency
+    ) as executor:
+        futures = {
+            executor.submit(
+                _refresh_credentials,
+                b3,
+                semaphores[token_db.storage_node_id],
+                token_db.storage_node,
+                token_db.owner_id,
+                token_db.policy,
+            ): token_db
+            for token_db in refreshable
+        }
+        for future in concurrent.futures.as_completed(futures):
+            token_db = futures[future]
+            try:
+                credentials = future.result()
+            except (ClientError, BotoCoreError) as e:
+                logger.warning(f"Failed to refresh token {token_db.id}: {e}")
+                continue
+            token_db.access_key_id = credentials["AccessKeyId"]
+            token_db.secret_access_key = credentials["SecretAccessKey"]
+            token_db.session_token = credentials["SessionToken"]
+            token_db.expiration = credentials["Expiration"]
+            refreshed += 1
+    db.commit()
+    return refreshed
 
 
 def token_revoke(db: Session, token_id: uuid.UUID):
@@ -571,19 +925,92 @@ def token_revoke(db: Session, token_id: uuid.UUID):
     db.commit()
 
 
+def token_delete_where(db: Session, criterion, batch_size: int = 1000) -> int:
+    """
+    Delete tokens matching criterion, along with their association rows, in
+    set-based batches.  Each batch is committed so that locks are held briefly.
+    Outstanding tokens in AWS/MinIO will continue to function until they expire.
+    """
+    deleted = 0
+    while True:
+        ids = [
+            row[0]
+            for row in db.query(models.S3Token.id)
+            .filter(criterion)
+            .limit(batch_size)
+            .all()
+        ]
+        if len(ids) == 0:
+            break
+        policy_ids = [
+            row[0]
+            for row in db.query(models.S3Token.policy_id)
+            .filter(models.S3Token.id.in_(ids))
+            .distinct()
+        ]
+        for table in [
+            models.workspace_s3token_association_table,
+            models.root_s3token_association_table,
+        ]:
+            db.execute(table.delete().where(table.c.s3token_id.in_(ids)))
+        db.query(models.S3Token).filter(models.S3Token.id.in_(ids)).delete(
+            synchronize_session=False
+        )
+        policy_delete_unused(db, policy_ids)
+        db.commit()
+        deleted += len(ids)
+        if len(ids) < batch_size:
+            break
+    return deleted
+
+
+def policy_delete_unused(db: Session, policy_ids: Optional[List[uuid.UUID]] = None):
+    """
+    Delete policy documents that no token references, among policy_ids or
+    among all of them.  Not committed.
+    """
+    unused = ~exists().where(models.S3Token.policy_id == models.S3Policy.id)
+    query = db.query(models.S3Policy).filter(unused)
+    if policy_ids is not None:
+        if len(policy_ids) == 0:
+            return
+        query = query.filter(models.S3Policy.id.in_(policy_ids))
+    try:
+        with db.begin_nested():
+            query.delete(synchronize_session=False)
+    except IntegrityError:
+        # A concurrent token_create reused one of them; the next sweep retries
+        pass
+
+
+def token_sweep_expired(db: Session) -> int:
+    """
+    Remove tokens that expired more than token_sweep_grace seconds ago.  The grace
+    period leaves recently expired tokens for the request path to reissue in place.
+    """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+        seconds=settings.settings.token_sweep_grace
+    )
+    swept = token_delete_where(
+        db,
+        models.S3Token.expiration < cutoff,
+        batch_size=settings.settings.token_sweep_batch_size,
+    )
+    # Also catch policies left behind when a token was reissued with a new one
+    policy_delete_unused(db)
+    db.commit()
+    return swept
+
+
 def token_revoke_all(db: Session, user: schemas.UserDB) -> int:
     """
     Remove all tokens from DB
     """
-    all_tokens: List[models.S3Token] = (
-        db.query(models.S3Token).filter(models.S3Token.owner_id == user.id).all()
+    return token_delete_where(
+        db,
+        models.S3Token.owner_id == user.id,
+        batch_size=settings.settings.token_sweep_batch_size,
     )
-    for t in all_tokens:
-        t.workspaces.clear()
-        t.roots.clear()
-        db.delete(t)
-    db.commit()
-    return len(all_tokens)
 
 
 def token_search(
@@ -595,8 +1022,9 @@ def token_search(
     """Search for a set of credentials that satisfy the terms"""
     workspaces: Dict[str, schemas.S3TokenSearchResponseWorkspacePart] = {}
     tokens: List[schemas.TokenNodeWrapper] = []
+    resolved = resolve_terms(db, requester, search.search_terms)
     for path in search.search_terms:
-        match, interior_path = match_terms(db, requester, path)
+        match, interior_path = resolved[path]
         if match:
             workspaces[path] = schemas.S3TokenSearchResponseWorkspacePart(
                 workspace=match,
@@ -1,12 +1,24 @@
 """
 FastAPI endpoint dependencies
 """
+from typing import Optional
+
 from elasticsearch import Elasticsearch
 
 from workspacesio.common import s3utils
 
 from . import database, dbutils, settings
 
+# Shared for the life of the process so that connection pools are reused
+boto_client_cache = s3utils.Boto3ClientCache(
+    maxsize=settings.settings.s3_client_cache_size,
+    max_pool_connections=settings.settings.s3_max_pool_connections,
+    node_pool_connections=settings.settings.s3_node_pool_connections,
+    timeout=settings.settings.s3_client_timeout,
+)
+# Created on application startup and closed on shutdown
+elastic_client: Optional[Elasticsearch] = None
+
 
 def get_db():
     db = database.SessionLocal(query_cls=dbutils.Query)
@@ -17,12 +29,42 @@ def get_db():
 
 
 def get_boto():
-    yield s3utils.Boto3ClientCache()
+    yield boto_client_cache
+
+
+def make_elastic_client() -> Elasticsearch:
+    es_settings = settings.settings
+    sniff_args = {}
+    if es_settings.es_sniff:
+        sniff_args = dict(
+            sniff_on_start=True,
+            sniff_on_connection_fail=True,
+            sniffer_timeout=es_settings.es_sniffer_timeout,
+        )
+    return Elasticsearch(
+        es_settings.es_nodes,
+        maxsize=es_settings.es_maxsize,
+        timeout=es_settings.es_timeout,
+        max_retries=es_settings.es_max_retries,
+        retry_on_timeout=es_settings.es_retry_on_timeout,
+        **sniff_args,
+    )
+
+
+def open_elastic_client() -> Elasticsearch:
+    """Create the process-wide elasticsearch client if it does not exist yet"""
+    global elastic_client
+    if elastic_client is None:
+        elastic_client = make_elastic_client()
+    return elastic_client
+
+
+def close_elastic_client():
+    global elastic_client
+    if elastic_client is not None:
+        elastic_client.close()
+        elastic_client = None
 
 
 def get_elastic_client():
-    client = Elasticsearch(settings.settings.es_nodes)
-    try:
-        yield client
-    finally:
-        client.close()
+    yield open_elastic_client()
@@ -1,12 +1,16 @@
 import uuid
+from typing import List, Optional
 
 import boto3
 from botocore.client import Config
 from elasticsearch import Elasticsearch
-from fastapi import Depends, Request
+from fastapi import Depends, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
 from fastapi.routing import APIRouter
+from starlette.concurrency import run_in_threadpool
 
-from workspacesio import auth, database
+from workspacesio import auth, database, models
 from workspacesio.common import indexing_schemas, schemas
 from workspacesio.depends import get_boto, get_db, get_elastic_client
 
@@ -60,17 +64,13 @@ def create_workspace_crawl(
     return crud.workspace_crawl_create(db, user, workspace_id)
 
 
-@router.post(
-    "/minio/events",
-    tags=["hooks"],
-    status_code=200,
-)
+@router.post("/minio/events", tags=["hooks"], status_code=200, response_model=int)
 def create_event(
     body: indexing_schemas.BucketEventNotification,
     db: database.SessionLocal = Depends(get_db),
-    es: Elasticsearch = Depends(get_elastic_client),
 ):
-    return crud.handle_bucket_event(db, es, body)
+    """Queue the notification's records for the event workers"""
+    return crud.event_queue_append(db, body)
 
 
 @router.head("/minio/events", tags=["hooks"], status_code=200)
@@ -79,11 +79,44 @@ def head_event(r: Request):
     return ""
 
 
+@router.get(
+    "/minio/events/dead",
+    tags=["hooks"],
+    response_model=List[indexing_schemas.BucketEventDeadLetterDB],
+)
+def list_dead_events(
+    limit: int = 100,
+    db: database.SessionLocal = Depends(get_db),
+    user: models.User = Depends(auth.get_admin_user),
+):
+    return crud.event_dead_letters(db, limit)
+
+
+@router.post("/minio/events/dead/replay", tags=["hooks"], response_model=int)
+def replay_dead_events(
+    limit: Optional[int] = None,
+    db: database.SessionLocal = Depends(get_db),
+    user: models.User = Depends(auth.get_admin_user),
+):
+    """Queue dead lettered events again, oldest first"""
+    return crud.event_dead_letter_replay(db, limit)
+
+
 @router.get("/search", tags=["search"])
 def search(q: str, ec: Elasticsearch = Depends(get_elastic_client)):
     return crud.search(q, ec)
 
 
+@router.get(
+    "/health/elastic", tags=["info"], response_model=indexing_schemas.ElasticHealth
+)
+def elastic_health(response: Response, ec: Elasticsearch = Depends(get_elastic_client)):
+    health = crud.elastic_health(ec)
+    if not health.ready:
+        response.status_code = 503
+    return health
+
+
 @router.post(
     "/workspace/{workspace_id}/bulk_index",
     tags=["index"],
@@ -98,3 +131,49 @@ def bulk_add(
     es: Elasticsearch = Depends(get_elastic_client),
 ):
     return crud.bulk_index_add(db, es, user, workspace_id, body)
+
+
+@router.post(
+    "/workspace/{workspace_id}/bulk_index/stream",
+    tags=["index"],
+    status_code=201,
+    response_model=indexing_schemas.IndexBulkAddedResponse,
+)
+async def bulk_add_stream(
+    workspace_id: uuid.UUID,
+    request: Request,
+    last_indexed_key: Optional[str] = None,
+    succeeded: bool = False,
+    user: schemas.UserDB = Depends(auth.get_current_user),
+    db: database.SessionLocal = Depends(get_db),
+    es: Elasticsearch = Depends(get_elastic_client),
+):
+    """
+    Index a stream of IndexDocumentBase records sent as application/x-ndjson
+    or application/msgpack, optionally with Content-Encoding: gzip.  Records
+    are indexed as they arrive, and the crawl round is updated once at the end.
+
+    If the stream cannot be decoded, the records before the bad chunk are
+    still indexed and recorded on the crawl round, which is left unfinished
+    with last_indexed_key set to the last of them.  The 400 response carries
+    the same summary, so the crawler can resume after that key.
+    """
+    decoder = crud.RecordDecoder(
+        request.headers.get("content-type", ""),
+        request.headers.get("content-encoding"),
+    )
+    writer = await run_in_threadpool(crud.BulkIndexWriter, db, es, user, workspace_id)
+    try:
+        async for chunk in request.stream():
+            docs = decoder.feed(chunk)
+            if docs:
+                await run_in_threadpool(writer.add_many, docs)
+        docs = decoder.close()
+    except ValueError as e:
+        partial = await run_in_threadpool(writer.finish, None, False)
+        return JSONResponse(
+            status_code=400,
+            content={"message": str(e), **jsonable_encoder(partial)},
+        )
+    await run_in_threadpool(writer.add_many, docs)
+    return await run_in_threadpool(writer.finish, last_indexed_key, succeeded)
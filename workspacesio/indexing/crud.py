@@ -4,19 +4,27 @@ import json
 import posixpath
 import urllib
 import uuid
-from typing import Optional, Union
+import zlib
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple, TypeVar
 
 import boto3
 import elasticsearch
-from sqlalchemy import and_, desc, func
+import msgpack
+import pydantic
+from pydantic.json import pydantic_encoder
+from sqlalchemy import desc, func, tuple_
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from sqlalchemy.sql import text
 
 from workspacesio import crud, models
 from workspacesio.common import indexing_schemas, s3utils, schemas
+from workspacesio.settings import settings
 
 from . import models as indexing_models
+from .resolver import UnresolvedObject, event_resolver, workspace_document_fields
+
+T = TypeVar("T")
 
 
 def verify_root_permissions(user: schemas.UserDB, root: models.WorkspaceRoot):
@@ -121,234 +129,523 @@ def workspace_crawl_create(
     )
 
 
+def bulk_send(
+    ec: elasticsearch.Elasticsearch, body: bytes, tags: List[T]
+) -> List[Tuple[T, int, str]]:
+    """Send one bulk request, returning (tag, status, error) for each failed action"""
+    try:
+        response = ec.bulk(body=body)
+    except elasticsearch.exceptions.TransportError as e:
+        status = e.status_code if isinstance(e.status_code, int) else 503
+        return [(tag, status, str(e.error)) for tag in tags]
+    if not response.get("errors"):
+        return []
+    failures: List[Tuple[T, int, str]] = []
+    for tag, item in zip(tags, response["items"]):
+        result = next(iter(item.values()))
+        if "error" in result:
+            error = result["error"]
+            if isinstance(error, dict):
+                error = f'{error.get("type")}: {error.get("reason")}'
+            failures.append((tag, result["status"], str(error)))
+    return failures
+
+
+class BulkIndexWriter:
+    """
+    Index documents from one workspace into its root's index during a crawl.
+    Documents are serialized into a buffer that is sent to elasticsearch
+    whenever it reaches WIO_ES_BULK_MAX_BYTES, and the crawl round is updated
+    once, by finish().
+    """
+
+    def __init__(
+        self,
+        db: Session,
+        ec: elasticsearch.Elasticsearch,
+        user: schemas.UserDB,
+        workspace_id: uuid.UUID,
+        max_bytes: Optional[int] = None,
+    ):
+        workspace: models.Workspace = db.query(models.Workspace).get_or_404(
+            workspace_id
+        )
+        self.crawl: indexing_models.WorkspaceCrawlRound = (
+            db.query(indexing_models.WorkspaceCrawlRound)
+            .filter(indexing_models.WorkspaceCrawlRound.workspace_id == workspace.id)
+            .order_by(desc(indexing_models.WorkspaceCrawlRound.start_time))
+            .first_or_404()
+        )
+        if self.crawl.succeeded == True:
+            raise ValueError(f"no outstanding crawl round for this workspace found")
+        root: models.WorkspaceRoot = workspace.root
+        verify_root_permissions(user, root)
+        self.index: indexing_models.RootIndex = (
+            db.query(indexing_models.RootIndex)
+            .filter(indexing_models.RootIndex.root_id == root.id)
+            .first()
+        )
+        if self.index is None:
+            raise ValueError(
+                f"index does not exist for workspace {workspace.name}::{workspace.id}"
+            )
+        self.db = db
+        self.ec = ec
+        self.max_bytes = max_bytes or settings.es_bulk_max_bytes
+        self.fields = workspace_document_fields(db, workspace, self.crawl.id)
+        # Serialized once, then spliced into each document's own json
+        self.shared_json = json.dumps(self.fields, default=pydantic_encoder)[1:-1]
+        self.buffer = bytearray()
+        self.pending: List[indexing_schemas.IndexDocumentBase] = []
+        self.last_path: Optional[str] = None
+        self.count = 0
+        self.size = 0
+        self.failures: List[indexing_schemas.IndexBulkFailure] = []
+
+    def add(self, doc: indexing_schemas.IndexDocumentBase):
+        _id = make_record_primary_key(
+            self.fields["server"],
+            self.fields["bucket"],
+            self.fields["root_path"],
+            doc.path,
+        )
+        action = json.dumps({"index": {"_index": self.index.index_type, "_id": _id}})
+        source = f"{doc.json()[:-1]},{self.shared_json}}}"
+        self.buffer += f"{action}\n{source}\n".encode("utf-8")
+        self.pending.append(doc)
+        self.last_path = doc.path
+        if len(self.buffer) >= self.max_bytes:
+            self.flush()
+
+    def add_many(self, docs: List[indexing_schemas.IndexDocumentBase]):
+        for doc in docs:
+            self.add(doc)
+
+    def flush(self):
+        if not self.pending:
+            return
+        failed = set()
+        for doc, status, error in bulk_send(self.ec, bytes(self.buffer), self.pending):
+            failed.add(id(doc))
+            self.failures.append(
+                indexing_schemas.IndexBulkFailure(
+                    path=doc.path, status=status, error=error
+                )
+            )
+        for doc in self.pending:
+            if id(doc) not in failed:
+                self.count += 1
+                self.size += doc.size or 0
+        self.buffer = bytearray()
+        self.pending = []
+
+    def finish(
+        self, last_indexed_key: Optional[str] = None, succeeded: Optional[bool] = False
+    ) -> indexing_schemas.IndexBulkAddedResponse:
+        """
+        Send what remains and record progress on the crawl round.
+        last_indexed_key defaults to the path of the last document added.
+        """
+        self.flush()
+        # Added in SQL, since batches of one crawl may finish concurrently
+        self.crawl.total_objects = (
+            indexing_models.WorkspaceCrawlRound.total_objects + self.count
+        )
+        self.crawl.total_size = (
+            indexing_models.WorkspaceCrawlRound.total_size + self.size
+        )
+        if self.last_path is not None:
+            self.crawl.last_indexed_key = last_indexed_key or self.last_path
+        if succeeded:
+            self.crawl.succeeded = True
+            self.crawl.end_time = datetime.datetime.utcnow()
+        self.db.add(self.crawl)
+        self.db.commit()
+        return indexing_schemas.IndexBulkAddedResponse(
+            index=self.index, count=self.count, failures=self.failures
+        )
+
+
 def bulk_index_add(
     db: Session,
     ec: elasticsearch.Elasticsearch,
     user: schemas.UserDB,
     workspace_id: uuid.UUID,
     docs: indexing_schemas.IndexBulkAdd,
-):
-    workspace: models.Workspace = db.query(models.Workspace).get_or_404(workspace_id)
-    last_crawl: indexing_models.WorkspaceCrawlRound = (
-        db.query(indexing_models.WorkspaceCrawlRound)
-        .filter(indexing_models.WorkspaceCrawlRound.workspace_id == workspace.id)
-        .order_by(desc(indexing_models.WorkspaceCrawlRound.start_time))
-        .first_or_404()
-    )
-    if last_crawl.succeeded == True:
-        raise ValueError(f"no outstanding crawl round for this workspace found")
-    root: models.WorkspaceRoot = workspace.root
-    verify_root_permissions(user, root)
-    bulk_operations = ""
-    index: indexing_models.RootIndex = (
-        db.query(indexing_models.RootIndex)
-        .filter(indexing_models.RootIndex.root_id == root.id)
-        .first()
+) -> indexing_schemas.IndexBulkAddedResponse:
+    writer = BulkIndexWriter(db, ec, user, workspace_id)
+    writer.add_many(docs.documents)
+    return writer.finish(docs.last_indexed_key, docs.succeeded)
+
+
+class RecordDecoder:
+    """
+    Incrementally decode IndexDocumentBase records from a request body of
+    NDJSON or msgpack, optionally gzip compressed.  feed() takes raw chunks
+    as they arrive and returns the records completed so far.
+    """
+
+    NDJSON = "application/x-ndjson"
+    MSGPACK = "application/msgpack"
+
+    def __init__(self, content_type: str, content_encoding: Optional[str] = None):
+        content_type = (content_type or "").split(";")[0].strip().lower()
+        if content_type not in [self.NDJSON, self.MSGPACK]:
+            raise ValueError(
+                f"Content-Type must be {self.NDJSON} or {self.MSGPACK}, not {content_type}"
+            )
+        content_encoding = (content_encoding or "identity").strip().lower()
+        if content_encoding not in ["identity", "gzip"]:
+            raise ValueError(f"Unsupported Content-Encoding {content_encoding}")
+        self.decompressor = None
+        if content_encoding == "gzip":
+            # wbits offset 16 expects a gzip header and trailer
+            self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.unpacker = None
+        if content_type == self.MSGPACK:
+            self.unpacker = msgpack.Unpacker(raw=False, timestamp=3)
+        self.partial = b""
+
+    def feed(self, chunk: bytes) -> List[indexing_schemas.IndexDocumentBase]:
+        if self.decompressor is not None:
+            try:
+                chunk = self.decompressor.decompress(chunk)
+            except zlib.error as e:
+                raise ValueError(f"Invalid gzip stream: {e}")
+        return self._decode(chunk)
+
+    def close(self) -> List[indexing_schemas.IndexDocumentBase]:
+        """Decode whatever is left once the body has ended"""
+        tail = b""
+        if self.decompressor is not None:
+            try:
+                tail = self.decompressor.flush()
+            except zlib.error as e:
+                raise ValueError(f"Invalid gzip stream: {e}")
+            if not self.decompressor.eof:
+                raise ValueError("Truncated gzip stream")
+        records = self._decode(tail)
+        if self.unpacker is None and self.partial.strip():
+            records.append(self._parse_line(self.partial))
+        elif self.unpacker is not None and self._msgpack_leftover():
+            raise ValueError("Truncated msgpack stream")
+        self.partial = b""
+        return records
+
+    def _msgpack_leftover(self) -> bool:
+        try:
+            return len(self.unpacker.read_bytes(1)) > 0
+        except ValueError:
+            # msgpack refuses while it holds part of an object
+            return True
+
+    def _decode(self, data: bytes) -> List[indexing_schemas.IndexDocumentBase]:
+        if self.unpacker is not None:
+            self.unpacker.feed(data)
+            return [self._parse_object(obj) for obj in self.unpacker]
+        lines = (self.partial + data).split(b"\n")
+        self.partial = lines.pop()
+        return [self._parse_line(line) for line in lines if line.strip()]
+
+    @staticmethod
+    def _parse_line(line: bytes) -> indexing_schemas.IndexDocumentBase:
+        try:
+            return indexing_schemas.IndexDocumentBase.parse_raw(line)
+        except pydantic.ValidationError as e:
+            raise ValueError(f"Invalid record: {e}")
+
+    @staticmethod
+    def _parse_object(obj: Any) -> indexing_schemas.IndexDocumentBase:
+        try:
+            return indexing_schemas.IndexDocumentBase.parse_obj(obj)
+        except pydantic.ValidationError as e:
+            raise ValueError(f"Invalid record: {e}")
+
+
+CREATED_EVENTS = [
+    "s3:ObjectCreated:Put",
+    "s3:ObjectCreated:Post",
+    "s3:ObjectCreated:Copy",
+    "s3:ObjectCreated:CompleteMultipartUpload",
+]
+REMOVED_EVENTS = ["s3:ObjectRemoved:Delete"]
+# Longest delay in seconds before a failed bucket event is tried again
+EVENT_RETRY_MAX_DELAY = 300
+
+
+class EventQueueResult(NamedTuple):
+    # Queue rows locked by this run
+    claimed: int
+    indexed: int
+    # Dropped because a later event for the same object was indexed instead
+    superseded: int
+    dead: int
+    # Rows left in the queue to try again later
+    retrying: int
+
+
+def bucket_event_action(
+    db: Session, record: indexing_schemas.EventNotificationRecord
+) -> bytes:
+    """Elasticsearch bulk action for one record, or ValueError"""
+    object_key = urllib.parse.unquote(record.s3.object.key)
+    found = event_resolver.resolve(db, record.s3.bucket.name, object_key)
+    fields = found.workspace.fields
+    primary_key_short_sha256 = make_record_primary_key(
+        api_url=fields["server"],
+        bucket=fields["bucket"],
+        workspace_prefix=fields["root_path"],
+        path=found.path,
     )
-    if index is None:
-        raise ValueError(
-            f"index does not exist for workspace {workspace.name}::{workspace.id}"
+    if record.eventName in CREATED_EVENTS:
+        # this could be an overwrite, so update in place to keep fields
+        # that only a crawl fills in.
+        doc = indexing_schemas.IndexDocumentBase(
+            time=record.eventTime,
+            size=record.s3.object.size,
+            eTag=record.s3.object.eTag,
+            path=found.path,
+            filename=posixpath.basename(found.path),
+            extension=posixpath.splitext(found.path)[-1],
         )
-    object_count = len(docs.documents)
-    object_size_sum = 0
-    for doc in docs.documents:
-        workspacekey = s3utils.getWorkspaceKey(workspace)
-        upsertdoc = indexing_schemas.IndexDocument(
-            **doc.dict(),
-            workspace_id=workspace.id,
-            workspace_name=workspace.name,
-            workspace_base_path=workspace.base_path,
-            last_seen_crawl_id=last_crawl.id,
-            owner_id=workspace.owner_id,
-            owner_name=workspace.owner.username,
-            bucket=root.bucket,
-            server=root.storage_node.api_url,
-            root_path=workspacekey,
-            root_id=root.id,
-            user_shares=[share.sharee.id for share in workspace.shares],
-            # TODO: group shares
-        )
-        object_size_sum = object_size_sum + (doc.size or 0)
-        bulk_operations = bulk_operations.__add__(
-            json.dumps(
-                {
-                    "update": {
-                        "_index": index.index_type,
-                        "_id": make_record_primary_key(
-                            root.storage_node.api_url,
-                            root.bucket,
-                            workspacekey,
-                            doc.path,
-                        ),
-                    }
-                },
+        source = doc.dict(exclude_none=True)
+        # Events are not part of a crawl, so leave last_seen_crawl_id alone
+        source.update((k, v) for k, v in fields.items() if k != "last_seen_crawl_id")
+        action = {
+            "update": {
+                "_index": found.index_type,
+                "_id": primary_key_short_sha256,
+            }
+        }
+        return (
+            json.dumps(action)
+            + "\n"
+            + json.dumps(
+                {"doc": source, "doc_as_upsert": True}, default=pydantic_encoder
             )
             + "\n"
-        )
-        bulk_operations = bulk_operations.__add__(
-            indexing_schemas.ElasticUpsertIndexDocument(doc=upsertdoc).json() + "\n"
-        )
+        ).encode("utf-8")
+    elif record.eventName in REMOVED_EVENTS:
+        action = {
+            "delete": {
+                "_index": found.index_type,
+                "_id": primary_key_short_sha256,
+            }
+        }
+        return (json.dumps(action) + "\n").encode("utf-8")
+    raise ValueError(f"Bucket notification type unsupported: {record.eventName}")
 
-    last_crawl.total_objects += object_count
-    last_crawl.total_size += object_size_sum
-    if len(docs.documents):
-        last_crawl.last_indexed_key = docs.last_indexed_key
-    if docs.succeeded:
-        last_crawl.succeeded = True
-        last_crawl.end_time = datetime.datetime.utcnow()
-    db.add(last_crawl)
-    if len(bulk_operations):
-        ec.bulk(bulk_operations)
-    db.commit()
+
+def event_queue_append(
+    db: Session, event: indexing_schemas.BucketEventNotification
+) -> int:
+    """Queue the records of a bucket notification for the event workers"""
+    now = datetime.datetime.utcnow()
+    rows = [
+        {
+            "id": uuid.uuid4(),
+            "created": now,
+            "bucket": record.s3.bucket.name,
+            "key": urllib.parse.unquote(record.s3.object.key),
+            "event_name": record.eventName,
+            "record": json.loads(record.json()),
+            "attempts": 0,
+        }
+        for record in event.Records
+    ]
+    if rows:
+        db.execute(indexing_models.BucketEvent.__table__.insert(), rows)
+        db.commit()
+    return len(rows)
 
 
-def handle_bucket_event(
+def _dead_letter(
+    row: indexing_models.BucketEvent, error: str
+) -> indexing_models.BucketEventDeadLetter:
+    return indexing_models.BucketEventDeadLetter(
+        bucket=row.bucket,
+        key=row.key,
+        event_name=row.event_name,
+        record=row.record,
+        attempts=row.attempts,
+        error=error,
+    )
+
+
+def event_queue_process(
     db: Session,
     ec: elasticsearch.Elasticsearch,
-    event: indexing_schemas.BucketEventNotification,
-):
-    # Find workspace for event
-    bulk_operations = ""
-    for record in event.Records:
-        bucket = record.s3.bucket.name
+    batch_size: Optional[int] = None,
+    window: Optional[float] = None,
+    max_attempts: Optional[int] = None,
+) -> EventQueueResult:
+    """
+    Claim up to batch_size queued records that are at least `window` seconds
+    old, index the newest record for each object and drop the ones it
+    supersedes.  Malformed records, and records that elasticsearch rejects,
+    go to the dead letter table.  Records that don't match a workspace yet, or
+    that fail for a transient reason, are delayed and stay queued until they
+    have been tried max_attempts times.
+    """
+    batch_size = batch_size or settings.event_queue_batch_size
+    window = settings.event_coalesce_window if window is None else window
+    max_attempts = max_attempts or settings.event_max_attempts
+    Event = indexing_models.BucketEvent
+    now = datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(seconds=window)
+    rows: List[indexing_models.BucketEvent] = (
+        db.query(Event)
+        .filter(Event.created <= cutoff)
+        .order_by(Event.position)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all()
+    )
+    if not rows:
+        db.rollback()
+        return EventQueueResult(0, 0, 0, 0, 0)
 
-        object_key = urllib.parse.unquote(record.s3.object.key)
-        parent_index: indexing_models.RootIndex = (
-            db.query(indexing_models.RootIndex)
-            .join(models.WorkspaceRoot)
-            .filter(
-                and_(
-                    func.strpos(models.WorkspaceRoot.base_path, object_key) == 0,
-                    models.WorkspaceRoot.bucket == record.s3.bucket.name,
-                )
-            )
-            .first()
-        )
-        if parent_index is None:
-            raise ValueError(f"no index for object {object_key}")
-        # Find the user who caused this event
-        actor_db: Union[models.User, None] = (
-            db.query(models.User)
-            .join(models.S3Token)
-            .filter(models.S3Token.access_key_id == record.userIdentity.principalId)
-            .first()
+    by_object: Dict[Tuple[str, str], List[indexing_models.BucketEvent]] = {}
+    for row in rows:
+        by_object.setdefault((row.bucket, row.key), []).append(row)
+    # Another worker holds older records for an object, so it goes first
+    first_queued = dict(
+        ((bucket, key), position)
+        for bucket, key, position in db.query(
+            Event.bucket, Event.key, func.min(Event.position)
         )
-        # Find the workspace
-        workspace: Optional[models.Workspace] = None
-        workspace_prefix = ""
-        workspace_inner_path = ""
-        if parent_index.root.root_type in [
-            schemas.RootType.PRIVATE,
-            schemas.RootType.PRIVATE,
-        ]:
-            # Extrapolate path parts from root type, assume it's {scope}/{user}/{workspace}
-            key_parts = object_key.split("/")
-            scope = key_parts[0]
-            user_name = key_parts[1]
-            workspace_name = key_parts[2]
-            workspace_inner_path = "/".join(key_parts[3:])
-            workspace = (
-                db.query(models.Workspace)
-                .join(models.User)
-                .filter(
-                    and_(
-                        models.Workspace.name == workspace_name,
-                        models.User.username == user_name,
-                    )
-                )
-                .first()
-            )
-            workspace_prefix = f"{scope}/{user_name}/{workspace_name}"
-
-        elif parent_index.root.root_type == schemas.RootType.UNMANAGED:
-            # Search again for matching base
-            workspace_inner_path = object_key.lstrip(
-                parent_index.root.base_path
-            ).lstrip("/")
-            workspace = (
-                db.query(models.Workspace)
-                .filter(
-                    func.strpos(models.Workspace.base_path, workspace_inner_path) == 0
-                )
-                .first()
-            )
-            if workspace is None:
-                raise ValueError(f"No workspace found for object {object_key}")
+        .filter(tuple_(Event.bucket, Event.key).in_(list(by_object)))
+        .group_by(Event.bucket, Event.key)
+    )
+    done: List[indexing_models.BucketEvent] = []
+    dead: List[indexing_models.BucketEventDeadLetter] = []
+    indexed = 0
+    superseded = 0
+    retrying = 0
+    buffer = bytearray()
+    pending: List[indexing_models.BucketEvent] = []
 
-            workspace_prefix = workspace.base_path
-            workspace_inner_path = workspace_inner_path.lstrip(
-                workspace.base_path
-            ).lstrip("/")
+    def retry(row: indexing_models.BucketEvent, error: str):
+        nonlocal retrying
+        row.attempts += 1
+        if row.attempts >= max_attempts:
+            dead.append(_dead_letter(row, error))
+            done.append(row)
+            return
+        # Back off exponentially, so later records for the object wait too
+        delay = min(max(window, 1) * 2**row.attempts, EVENT_RETRY_MAX_DELAY)
+        row.created = now + datetime.timedelta(seconds=delay)
+        retrying += 1
 
-        if workspace is None:
-            raise ValueError(f"No workspace found for object {object_key}")
-        resource_owner: models.User = workspace.owner
-        root: models.WorkspaceRoot = workspace.root
-        node: models.StorageNode = root.storage_node
+    def flush():
+        nonlocal buffer, pending, indexed
+        if not pending:
+            return
+        failed = {}
+        for row, status, error in bulk_send(ec, bytes(buffer), pending):
+            failed[id(row)] = (row, status, error)
+        for row in pending:
+            if id(row) not in failed:
+                indexed += 1
+                done.append(row)
+                continue
+            _, status, error = failed[id(row)]
+            if status == 429 or status >= 500:
+                retry(row, f"{status} {error}")
+            else:
+                row.attempts += 1
+                dead.append(_dead_letter(row, f"{status} {error}"))
+                done.append(row)
+        buffer = bytearray()
+        pending = []
+
+    for object_key, object_rows in by_object.items():
+        if first_queued[object_key] < object_rows[0].position:
+            continue
+        *older, latest = object_rows
+        superseded += len(older)
+        done.extend(older)
+        try:
+            record = indexing_schemas.EventNotificationRecord(**latest.record)
+            action = bucket_event_action(db, record)
+        except UnresolvedObject as e:
+            retry(latest, str(e))
+            continue
+        except (ValueError, pydantic.ValidationError) as e:
+            dead.append(_dead_letter(latest, str(e)))
+            done.append(latest)
+            continue
+        buffer += action
+        pending.append(latest)
+        if len(buffer) >= settings.es_bulk_max_bytes:
+            flush()
+    flush()
 
-        primary_key_short_sha256 = make_record_primary_key(
-            api_url=node.api_url,
-            bucket=root.bucket,
-            workspace_prefix=workspace_prefix,
-            path=workspace_inner_path,
+    db.add_all(dead)
+    if done:
+        db.query(Event).filter(Event.id.in_([row.id for row in done])).delete(
+            synchronize_session=False
         )
-        if record.eventName in [
-            "s3:ObjectCreated:Put",
-            "s3:ObjectCreated:Post",
-            "s3:ObjectCreated:Copy",
-        ]:
-            # Creaete a new record in elasticsearch
-            # this could be an overwrite operation, so query for the old record first.
-            doc = indexing_schemas.IndexDocument(
-                time=record.eventTime,
-                size=record.s3.object.size,
-                eTag=record.s3.object.eTag,
-                workspace_id=workspace.id,
-                workspace_name=workspace.name,
-                owner_id=resource_owner.id,
-                owner_name=resource_owner.username,
-                bucket=record.s3.bucket.name,
-                server=node.api_url,
-                root_path=root.base_path,
-                root_id=root.id,
-                path=workspace_inner_path,
-                extension=posixpath.splitext(workspace_inner_path)[-1],
-                user_shares=[share.sharee.id for share in workspace.shares],
-                # TODO: group shares
-            )
-            bulk_operations += (
-                json.dumps(
-                    {
-                        "update": {
-                            "_index": parent_index.index_type,
-                            "_id": primary_key_short_sha256,
-                        }
-                    },
-                )
-                + "\n"
-            )
-            bulk_operations += (
-                indexing_schemas.ElasticUpsertIndexDocument(doc=doc).json() + "\n"
-            )
+    db.commit()
+    return EventQueueResult(
+        claimed=len(rows),
+        indexed=indexed,
+        superseded=superseded,
+        dead=len(dead),
+        retrying=retrying,
+    )
 
-        elif record.eventName in ["s3:ObjectRemoved:Delete"]:
-            # Remove an existing record
-            bulk_operations += (
-                json.dumps(
-                    {
-                        "delete": {
-                            "_index": parent_index.index_type,
-                            "_id": primary_key_short_sha256,
-                        }
-                    }
-                )
-                + "\n"
-            )
-        else:
-            raise ValueError(
-                f"Bucket notification type unsupported: {record.eventName}"
+
+def event_dead_letters(
+    db: Session, limit: int = 100
+) -> List[indexing_models.BucketEventDeadLetter]:
+    return (
+        db.query(indexing_models.BucketEventDeadLetter)
+        .order_by(indexing_models.BucketEventDeadLetter.created)
+        .limit(limit)
+        .all()
+    )
+
+
+def event_dead_letter_replay(db: Session, limit: Optional[int] = None) -> int:
+    """Move dead letters back into the queue, oldest first"""
+    DeadLetter = indexing_models.BucketEventDeadLetter
+    query = (
+        db.query(DeadLetter)
+        .order_by(DeadLetter.created)
+        .with_for_update(skip_locked=True)
+    )
+    if limit is not None:
+        query = query.limit(limit)
+    letters: List[indexing_models.BucketEventDeadLetter] = query.all()
+    now = datetime.datetime.utcnow()
+    for letter in letters:
+        db.add(
+            indexing_models.BucketEvent(
+                created=now,
+                bucket=letter.bucket,
+                key=letter.key,
+                event_name=letter.event_name,
+                record=letter.record,
+                attempts=0,
             )
-    ec.bulk(bulk_operations)
+        )
+        db.delete(letter)
+    db.commit()
+    return len(letters)
+
+
+def elastic_health(ec: elasticsearch.Elasticsearch) -> indexing_schemas.ElasticHealth:
+    """Cluster is ready to serve requests if its health is green or yellow"""
+    try:
+        health = ec.cluster.health()
+    except elasticsearch.exceptions.ElasticsearchException:
+        return indexing_schemas.ElasticHealth(ready=False)
+    return indexing_schemas.ElasticHealth(
+        ready=health["status"] in ["green", "yellow"],
+        status=health["status"],
+        number_of_nodes=health["number_of_nodes"],
+    )
 
 
 def search(query: str, ec: elasticsearch.Elasticsearch):
@@ -7,10 +7,12 @@ from sqlalchemy import (
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
+    Sequence,
     String,
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import JSONB, UUID
 from sqlalchemy.orm import relationship
 from sqlalchemy.schema import UniqueConstraint
 
@@ -75,3 +77,43 @@ class WorkspaceCrawlRound(BaseModel):
     total_size = Column(BigInteger, nullable=False, default=0)
 
     workspace = relationship(Workspace, backref="crawl_rounds")
+
+
+class BucketEvent(BaseModel):
+    """
+    One bucket notification record waiting to be indexed.  The webhook only
+    appends to this queue; workers claim records in `position` order, collapse
+    repeated events for the same object, and delete them once indexed.
+    """
+
+    __tablename__ = "bucket_event"
+    __table_args__ = (Index("ix_bucket_event_bucket_key", "bucket", "key"),)
+
+    position = Column(
+        BigInteger,
+        Sequence("bucket_event_position_seq"),
+        nullable=False,
+        index=True,
+    )
+    bucket = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    event_name = Column(String, nullable=False)
+    record = Column(JSONB, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+
+
+class BucketEventDeadLetter(BaseModel):
+    """
+    A bucket notification record that could not be indexed, kept so that it
+    can be replayed once the cause is fixed, such as by creating the missing
+    workspace or root index.
+    """
+
+    __tablename__ = "bucket_event_dead_letter"
+
+    bucket = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    event_name = Column(String, nullable=False)
+    record = Column(JSONB, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String, nullable=False)
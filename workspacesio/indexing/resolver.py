@@ -0,0 +1,292 @@
+"""
+In-memory lookup from bucket notification keys to the root index and workspace
+they belong to, so that handling a bucket event costs a few dictionary and
+trie lookups instead of several queries per record.
+
+The lookup tables are loaded in one pass and reloaded lazily after any commit
+that changes a node, root, root index, workspace, share or user.  Commits in
+other processes are not seen, so WIO_EVENT_RESOLVER_TTL bounds how long a
+stale table can be used, except that an object that matches nothing causes
+a reload at most every MISS_RELOAD_INTERVAL seconds.
+"""
+import threading
+import time
+import uuid
+from typing import Any, Dict, Generic, List, NamedTuple, Optional, Tuple, TypeVar
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session, joinedload
+
+from workspacesio import models
+from workspacesio.common import s3utils
+from workspacesio.settings import settings
+
+from . import models as indexing_models
+
+V = TypeVar("V")
+
+# Changes to these invalidate the resolver
+WATCHED = (
+    models.StorageNode,
+    models.WorkspaceRoot,
+    models.Workspace,
+    models.Share,
+    models.User,
+    indexing_models.RootIndex,
+)
+STALE_FLAG = "wio_event_resolver_stale"
+# Minimum seconds between reloads triggered by an object that matched nothing
+MISS_RELOAD_INTERVAL = 5
+
+
+class UnresolvedObject(ValueError):
+    """
+    No indexed root or workspace contains the object.  It may belong to one
+    that was just created, so the event is worth retrying later.
+    """
+
+
+def workspace_document_fields(
+    db: Session,
+    workspace: models.Workspace,
+    crawl_id: Optional[uuid.UUID] = None,
+    sharee_ids: Optional[List[uuid.UUID]] = None,
+) -> Dict[str, Any]:
+    """
+    IndexDocument fields shared by every object in a workspace.
+    sharee_ids are queried when not given.
+    """
+    root: models.WorkspaceRoot = workspace.root
+    if sharee_ids is None:
+        sharee_ids = [
+            sharee_id
+            for (sharee_id,) in db.query(models.Share.sharee_id).filter(
+                models.Share.workspace_id == workspace.id
+            )
+        ]
+    return {
+        "workspace_id": workspace.id,
+        "workspace_name": workspace.name,
+        "workspace_base_path": workspace.base_path,
+        "last_seen_crawl_id": crawl_id,
+        "owner_id": workspace.owner_id,
+        "owner_name": workspace.owner.username,
+        "bucket": root.bucket,
+        "server": root.storage_node.api_url,
+        "root_path": s3utils.getWorkspaceKey(workspace),
+        "root_id": root.id,
+        "user_shares": sharee_ids,
+        # TODO: group shares
+    }
+
+
+class _Node(Generic[V]):
+    __slots__ = ["children", "value", "present"]
+
+    def __init__(self):
+        self.children: Dict[str, "_Node[V]"] = {}
+        self.value: Optional[V] = None
+        self.present = False
+
+
+class PrefixTrie(Generic[V]):
+    """Trie over "/" separated path segments, for longest prefix lookups"""
+
+    def __init__(self):
+        self.root: _Node[V] = _Node()
+
+    @staticmethod
+    def _segments(path: str) -> List[str]:
+        return [part for part in path.split("/") if part]
+
+    def insert(self, prefix: str, value: V):
+        node = self.root
+        for part in self._segments(prefix):
+            node = node.children.setdefault(part, _Node())
+        node.value = value
+        node.present = True
+
+    def longest(self, key: str) -> Optional[V]:
+        """Value of the longest inserted prefix that key is under, or None"""
+        node = self.root
+        best = node.value if node.present else None
+        for part in self._segments(key):
+            child = node.children.get(part)
+            if child is None:
+                break
+            node = child
+            if node.present:
+                best = node.value
+        return best
+
+
+class RootEntry(NamedTuple):
+    root_id: uuid.UUID
+    index_type: str
+    # Workspaces of this root, by full object prefix
+    workspaces: PrefixTrie["WorkspaceEntry"]
+
+
+class WorkspaceEntry(NamedTuple):
+    workspace_id: uuid.UUID
+    # Full object prefix of the workspace, without a trailing slash
+    prefix: str
+    # IndexDocument fields shared by every object in the workspace
+    fields: Dict[str, Any]
+
+
+class Resolution(NamedTuple):
+    index_type: str
+    workspace: WorkspaceEntry
+    # Object path inside the workspace
+    path: str
+
+
+class EventResolver:
+    """
+    :param ttl: seconds before the tables are reloaded, even if unchanged here
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # bucket -> root base path -> root
+        self.buckets: Dict[str, PrefixTrie[RootEntry]] = {}
+        self.loaded_at: Optional[float] = None
+        self.invalidated_at = 0.0
+        self.missed_at: Optional[float] = None
+        self.reloads = 0
+
+    def invalidate(self):
+        self.invalidated_at = time.monotonic()
+
+    def _stale(self) -> bool:
+        # A load that began before the invalidation may have read old rows
+        return (
+            self.loaded_at is None
+            or self.loaded_at <= self.invalidated_at
+            or time.monotonic() - self.loaded_at > self.ttl
+        )
+
+    def _load(self, db: Session):
+        started = time.monotonic()
+        indexes: List[Tuple[indexing_models.RootIndex, models.WorkspaceRoot]] = (
+            db.query(indexing_models.RootIndex, models.WorkspaceRoot)
+            .join(models.WorkspaceRoot)
+            .all()
+        )
+        root_ids = [root.id for _, root in indexes]
+        workspaces: List[models.Workspace] = (
+            db.query(models.Workspace)
+            .filter(models.Workspace.root_id.in_(root_ids))
+            .options(
+                joinedload(models.Workspace.owner),
+                joinedload(models.Workspace.root).joinedload(
+                    models.WorkspaceRoot.storage_node
+                ),
+            )
+            .all()
+        )
+        sharees: Dict[uuid.UUID, List[uuid.UUID]] = {w.id: [] for w in workspaces}
+        for workspace_id, sharee_id in db.query(
+            models.Share.workspace_id, models.Share.sharee_id
+        ).filter(models.Share.workspace_id.in_(list(sharees))):
+            sharees[workspace_id].append(sharee_id)
+
+        roots: Dict[uuid.UUID, RootEntry] = {}
+        buckets: Dict[str, PrefixTrie[RootEntry]] = {}
+        for index, root in indexes:
+            entry = RootEntry(
+                root_id=root.id, index_type=index.index_type, workspaces=PrefixTrie()
+            )
+            roots[root.id] = entry
+            buckets.setdefault(root.bucket, PrefixTrie()).insert(root.base_path, entry)
+        for workspace in workspaces:
+            prefix = s3utils.getWorkspaceKey(workspace)
+            roots[workspace.root_id].workspaces.insert(
+                prefix,
+                WorkspaceEntry(
+                    workspace_id=workspace.id,
+                    prefix=prefix,
+                    fields=workspace_document_fields(
+                        db, workspace, sharee_ids=sharees[workspace.id]
+                    ),
+                ),
+            )
+        self.buckets = buckets
+        self.loaded_at = started
+        self.reloads += 1
+
+    def _lookup(
+        self, bucket: str, key: str
+    ) -> Tuple[Optional[RootEntry], Optional[WorkspaceEntry]]:
+        roots = self.buckets.get(bucket)
+        root = roots.longest(key) if roots is not None else None
+        if root is None:
+            return None, None
+        return root, root.workspaces.longest(key)
+
+    def _reload_after_miss(self, db: Session, missed_at: float) -> bool:
+        """
+        Reload for an object that matched nothing, unless another miss caused
+        a reload too recently.  Roots and workspaces created by other processes
+        are found this way before the ttl runs out.
+        """
+        with self.lock:
+            if self.loaded_at is not None and self.loaded_at >= missed_at:
+                # Another thread reloaded while this one waited for the lock
+                return True
+            now = time.monotonic()
+            if (
+                self.missed_at is not None
+                and now - self.missed_at < MISS_RELOAD_INTERVAL
+            ):
+                return False
+            self.missed_at = now
+            self._load(db)
+            return True
+
+    def resolve(self, db: Session, bucket: str, key: str) -> Resolution:
+        """Find the index and workspace for an object, or raise UnresolvedObject"""
+        if self._stale():
+            with self.lock:
+                if self._stale():
+                    self._load(db)
+        root, workspace = self._lookup(bucket, key)
+        if workspace is None and self._reload_after_miss(db, time.monotonic()):
+            root, workspace = self._lookup(bucket, key)
+        if root is None:
+            raise UnresolvedObject(f"no index for object {key}")
+        if workspace is None:
+            raise UnresolvedObject(f"No workspace found for object {key}")
+        return Resolution(
+            index_type=root.index_type,
+            workspace=workspace,
+            path=key[len(workspace.prefix) :].strip("/"),
+        )
+
+
+event_resolver = EventResolver(settings.event_resolver_ttl)
+
+
+@event.listens_for(Session, "after_flush")
+def _flag_changes(session: Session, flush_context):
+    if any(
+        isinstance(instance, WATCHED)
+        for instance in [*session.new, *session.dirty, *session.deleted]
+    ):
+        session.info[STALE_FLAG] = True
+
+
+@event.listens_for(Session, "after_bulk_update")
+@event.listens_for(Session, "after_bulk_delete")
+def _flag_bulk_changes(context):
+    if context.mapper is not None and issubclass(context.mapper.class_, WATCHED):
+        context.session.info[STALE_FLAG] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate(session: Session):
+    # Only once committed, or a reload elsewhere could read the old rows again
+    if session.info.pop(STALE_FLAG, False):
+        event_resolver.invalidate()
@@ -0,0 +1,70 @@
+"""
+Index queued bucket events.
+
+Runs inside every server process when WIO_EVENT_WORKER_INTERVAL is set, and
+as a standalone process through the workspaces-event-worker command.  Any
+number of workers can drain the queue at once.
+"""
+import logging
+import signal
+import threading
+
+import elasticsearch
+
+from workspacesio import database, dbutils, depends
+from workspacesio.settings import settings
+
+from . import crud
+
+logger = logging.getLogger("event-worker")
+
+
+def drain(ec: elasticsearch.Elasticsearch) -> crud.EventQueueResult:
+    """
+    Process batches until the queue holds no more ready records, or until
+    elasticsearch reports a transient failure.
+    """
+    total = crud.EventQueueResult(0, 0, 0, 0, 0)
+    db = database.SessionLocal(query_cls=dbutils.Query)
+    try:
+        while True:
+            result = crud.event_queue_process(db, ec)
+            total = crud.EventQueueResult(*(a + b for a, b in zip(total, result)))
+            progressed = result.indexed + result.superseded + result.dead
+            if (
+                result.claimed < settings.event_queue_batch_size
+                or result.retrying
+                or not progressed
+            ):
+                break
+    finally:
+        db.close()
+    if total.claimed:
+        logger.info(
+            f"Indexed {total.indexed} bucket events, {total.superseded} superseded, "
+            f"{total.dead} dead, {total.retrying} to retry"
+        )
+    return total
+
+
+def drain_shared():
+    """drain() with the process-wide elasticsearch client"""
+    drain(depends.open_elastic_client())
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    interval = settings.event_worker_interval or 1
+    stopped = threading.Event()
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda *args: stopped.set())
+    ec = depends.make_elastic_client()
+    try:
+        while not stopped.is_set():
+            try:
+                drain(ec)
+            except Exception:
+                logger.exception("Processing bucket events failed")
+            stopped.wait(interval)
+    finally:
+        ec.close()
@@ -1,5 +1,7 @@
 import datetime
 import enum
+import hashlib
+import hmac
 import secrets
 import uuid
 from typing import Tuple
@@ -11,6 +13,7 @@ from sqlalchemy import (
     DateTime,
     Enum,
     ForeignKey,
+    Index,
     Integer,
     String,
     Table,
@@ -23,6 +26,7 @@ from sqlalchemy.schema import UniqueConstraint
 from workspacesio.common.schemas import RootType, ShareType
 
 from .database import Base
+from .settings import settings
 
 # Many to Many
 # https://docs.sqlalchemy.org/en/13/orm/basic_relationships.html#many-to-many
@@ -33,7 +37,11 @@ workspace_s3token_association_table = Table(
         "workspace_id", UUID(as_uuid=True), ForeignKey("workspace.id"), nullable=False
     ),
     Column(
-        "s3token_id", UUID(as_uuid=True), ForeignKey("minio_token.id"), nullable=False
+        "s3token_id",
+        UUID(as_uuid=True),
+        ForeignKey("minio_token.id"),
+        nullable=False,
+        index=True,
     ),
 )
 
@@ -44,7 +52,11 @@ root_s3token_association_table = Table(
         "root_id", UUID(as_uuid=True), ForeignKey("workspace_root.id"), nullable=False
     ),
     Column(
-        "s3token_id", UUID(as_uuid=True), ForeignKey("minio_token.id"), nullable=False
+        "s3token_id",
+        UUID(as_uuid=True),
+        ForeignKey("minio_token.id"),
+        nullable=False,
+        index=True,
     ),
 )
 
@@ -74,6 +86,10 @@ class User(BaseModel):
 class ApiKey(BaseModel):
     """
     API Key for command line
+
+    Secrets are random 256-bit tokens, so a peppered HMAC is as strong as a slow
+    password hash and far cheaper to check.  `secret_hash` is prefixed with its
+    scheme; anything else is a legacy bcrypt hash and is replaced on next login.
     """
 
     __tablename__ = "apikey"
@@ -84,13 +100,27 @@ class ApiKey(BaseModel):
 
     user = relationship(User, back_populates="apikeys")
 
+    hash_scheme = "$hmac-sha256$"
+
     @staticmethod
     def make_password_hash(password: str):
-        hashstr = bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt())
-        return hashstr.decode("utf-8")
+        pepper = settings.apikey_pepper or settings.secret
+        digest = hmac.new(
+            pepper.encode("utf-8"), password.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+        return ApiKey.hash_scheme + digest
+
+    @property
+    def needs_rehash(self) -> bool:
+        return not self.secret_hash.startswith(ApiKey.hash_scheme)
 
     def verify(self, key: str):
-        return bcrypt.checkpw(key.encode("utf-8"), self.secret_hash.encode("utf-8"))
+        if self.needs_rehash:
+            return bcrypt.checkpw(key.encode("utf-8"), self.secret_hash.encode("utf-8"))
+        return hmac.compare_digest(
+            ApiKey.make_password_hash(key).encode("utf-8"),
+            self.secret_hash.encode("utf-8"),
+        )
 
 
 class StorageNode(BaseModel):
@@ -113,6 +143,8 @@ class StorageNode(BaseModel):
     # ARN used for STS assume role for temporary credentials
     # You DEFINITELY want this role to be empty (no permissions)
     assume_role_arn = Column(String, nullable=True, default=None)
+    # Lifetime of issued STS credentials.  None uses the node's default.
+    token_duration_seconds = Column(Integer, nullable=True, default=None)
 
     creator: User = relationship(User, back_populates="created_nodes")
     roots = relationship("WorkspaceRoot", back_populates="storage_node")
@@ -200,6 +232,19 @@ class Share(BaseModel):
     workspace: Workspace = relationship(Workspace, back_populates="shares")
 
 
+class S3Policy(BaseModel):
+    """
+    A session policy document.  Tokens for the same constellation carry
+    identical policies, so each document is stored once and referenced by hash.
+    """
+
+    __tablename__ = "s3_policy"
+    __table_args__ = (UniqueConstraint("policy_hash"),)
+
+    policy_hash = Column(String, nullable=False)
+    document = Column(JSONB, nullable=False)
+
+
 class S3Token(BaseModel):
     """
     There are two kinds of tokens that users might request
@@ -209,9 +254,21 @@ class S3Token(BaseModel):
     * A specific workspace token for a single shared workspace.
       If a user needs concurrent access to many shared workspaces,
       they must have many outstanding tokens.
+
+    Tokens are looked up by `constellation_hash`, a canonical hash of the roots and
+    shared workspaces (with permissions) that the token's policy was built from.
     """
 
     __tablename__ = "minio_token"
+    __table_args__ = (
+        Index(
+            "ix_minio_token_constellation",
+            "owner_id",
+            "storage_node_id",
+            "constellation_hash",
+        ),
+        Index("ix_minio_token_owner_expiration", "owner_id", "expiration"),
+    )
 
     access_key_id = Column(String, nullable=False)
     secret_access_key = Column(String, nullable=False)
@@ -221,13 +278,17 @@ class S3Token(BaseModel):
         default=datetime.datetime.now() + datetime.timedelta(days=7),
         nullable=False,
     )
-    policy = Column(JSONB, nullable=False)
+    constellation_hash = Column(String, nullable=False)
+    last_used = Column(DateTime, default=datetime.datetime.utcnow, nullable=True)
+    policy_id = Column(UUID(as_uuid=True), ForeignKey("s3_policy.id"), nullable=False)
     owner_id = Column(UUID(as_uuid=True), ForeignKey("user.id"), nullable=False)
     storage_node_id = Column(
         UUID(as_uuid=True), ForeignKey("storage_node.id"), nullable=False
     )
 
     owner = relationship(User, backref="s3_tokens")
+    storage_node: StorageNode = relationship(StorageNode)
+    policy_document: S3Policy = relationship(S3Policy)
     workspaces = relationship(
         "Workspace",
         secondary=workspace_s3token_association_table,
@@ -240,3 +301,7 @@ class S3Token(BaseModel):
         cascade=["all"],
         back_populates="tokens",
     )
+
+    @property
+    def policy(self) -> dict:
+        return self.policy_document.document
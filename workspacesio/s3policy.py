@@ -1,9 +1,13 @@
+import hashlib
+import json
 import posixpath
 import uuid
-from typing import List, Optional, Set, Tuple, TypedDict, Union
+from typing import Dict, Hashable, List, Optional, Set, Tuple, TypedDict, Union
 
 from workspacesio import models
+from workspacesio.cache import TTLCache
 from workspacesio.common import s3utils, schemas
+from workspacesio.settings import settings
 
 PolicyDoc = TypedDict(
     "PolicyDoc",
@@ -13,11 +17,18 @@ PolicyDoc = TypedDict(
     },
 )
 
+ForeignWorkspaces = List[Tuple[models.Workspace, Optional[models.Share]]]
+
+# (user id, constellation hash) -> [(foreign workspace ids, compiled policy)]
+compiled_policies = TTLCache(
+    maxsize=settings.policy_cache_size, ttl=settings.policy_cache_ttl
+)
+
 
 def makePolicy(
     user: models.User,
     workspaces: List[models.Workspace],
-    foreign_workspaces: List[Tuple[models.Workspace, Optional[models.Share]]],
+    foreign_workspaces: ForeignWorkspaces,
 ) -> PolicyDoc:
     """
     Make a policy for the given user to access s3 based on
@@ -174,6 +185,176 @@ def makePolicy(
     }
 
 
+def _covers(pattern: str, value: str) -> bool:
+    """True if every string matched by value is also matched by pattern"""
+    if pattern == value:
+        return True
+    literal = pattern[:-1]
+    return (
+        pattern.endswith("*")
+        and "*" not in literal
+        and "?" not in literal
+        and value.startswith(literal)
+    )
+
+
+def _prune(values: Set[str]) -> List[str]:
+    """Drop values that another value in the set already matches"""
+    return sorted(
+        v for v in values if not any(p != v and _covers(p, v) for p in values)
+    )
+
+
+def _as_list(value: Union[str, List[str]]) -> List[str]:
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _size(policy: PolicyDoc) -> int:
+    return len(json.dumps(policy, separators=(",", ":")))
+
+
+def compactPolicy(policy: PolicyDoc) -> PolicyDoc:
+    """
+    Rewrite a policy into the fewest statements that grant the same access.
+
+    Unconditional Allow statements are regrouped so that each resource appears
+    once, under the union of its actions, and resources already covered by a
+    wildcard resource with the same actions are dropped.  Conditional statements
+    that differ only by s3:prefix are merged into one statement with a list of
+    prefixes, since values for a single condition key are ORed.
+
+    Prefixes are never widened beyond what the input grants.
+    """
+    # resource -> actions for unconditional statements
+    grants: Dict[str, Set[str]] = {}
+    # (actions, resources, condition without s3:prefix) -> prefixes
+    listings: Dict[Tuple[Tuple[str, ...], Tuple[str, ...], str], Set[str]] = {}
+    passthrough: List[dict] = []
+    for statement in policy["Statement"]:
+        actions = _as_list(statement["Action"])
+        resources = _as_list(statement["Resource"])
+        condition = statement.get("Condition", None)
+        if statement["Effect"] != "Allow":
+            passthrough.append(statement)
+        elif condition is None:
+            for resource in resources:
+                grants.setdefault(resource, set()).update(actions)
+        elif (
+            set(condition) == {"StringLike"} and "s3:prefix" in condition["StringLike"]
+        ):
+            rest = {
+                k: v for k, v in condition["StringLike"].items() if k != "s3:prefix"
+            }
+            key = (
+                tuple(sorted(actions)),
+                tuple(sorted(resources)),
+                json.dumps(rest, sort_keys=True),
+            )
+            listings.setdefault(key, set()).update(
+                _as_list(condition["StringLike"]["s3:prefix"])
+            )
+        else:
+            passthrough.append(statement)
+
+    def expand(actions: Set[str]) -> Set[str]:
+        return {"s3:*"} if "s3:*" in actions else actions
+
+    # resource -> actions not already granted by a broader resource
+    remaining: Dict[str, Set[str]] = {}
+    for resource, granted in grants.items():
+        needed = expand(granted)
+        if "s3:*" not in needed:
+            for pattern, broader in grants.items():
+                if pattern != resource and _covers(pattern, resource):
+                    needed = set() if "s3:*" in broader else needed - broader
+        if len(needed):
+            remaining[resource] = needed
+    # actions -> resources
+    statements_by_actions: Dict[Tuple[str, ...], Set[str]] = {}
+    for resource, needed in remaining.items():
+        statements_by_actions.setdefault(tuple(sorted(needed)), set()).add(resource)
+
+    statements: List[dict] = [
+        {"Effect": "Allow", "Action": list(action_key), "Resource": _prune(targets)}
+        for action_key, targets in sorted(statements_by_actions.items())
+    ]
+    for (action_key, resource_key, other_conditions), prefixes in sorted(
+        listings.items()
+    ):
+        statements.append(
+            {
+                "Effect": "Allow",
+                "Action": list(action_key),
+                "Resource": list(resource_key),
+                "Condition": {
+                    "StringLike": {
+                        "s3:prefix": _prune(prefixes),
+                        **json.loads(other_conditions),
+                    }
+                },
+            }
+        )
+    return {
+        "Version": policy["Version"],
+        "Statement": statements + passthrough,
+    }
+
+
+def compilePolicies(
+    user: models.User,
+    workspaces: List[models.Workspace],
+    foreign_workspaces: ForeignWorkspaces,
+    key: Hashable,
+) -> List[Tuple[ForeignWorkspaces, PolicyDoc]]:
+    """
+    Compact policies for a constellation, split so that each stays under
+    settings.sts_policy_max_bytes.  Foreign workspaces are packed in id order so
+    the same constellation always splits the same way.  The first policy
+    covers `workspaces` along with its share of `foreign_workspaces`.
+
+    Results are memoized under (user.id, key), where key must change whenever
+    the inputs would produce a different policy.
+
+    :returns: a list of (foreign workspaces covered, policy)
+    """
+    by_id = {w.id: (w, share) for w, share in foreign_workspaces}
+    cached = compiled_policies.get((user.id, key))
+    if cached is None:
+        max_bytes = settings.sts_policy_max_bytes
+        ordered = sorted(foreign_workspaces, key=lambda f: str(f[0].id))
+        cached = []
+        chunk: ForeignWorkspaces = []
+        policy: Optional[PolicyDoc] = None
+        for foreign in ordered:
+            base = workspaces if len(cached) == 0 else []
+            candidate = compactPolicy(makePolicy(user, base, chunk + [foreign]))
+            if (
+                max_bytes <= 0
+                or _size(candidate) <= max_bytes
+                or (len(chunk) == 0 and len(base) == 0)
+            ):
+                chunk.append(foreign)
+                policy = candidate
+                continue
+            # Close the current chunk and start a new one with this workspace
+            if policy is None:
+                policy = compactPolicy(makePolicy(user, base, chunk))
+            cached.append((tuple(w.id for w, _ in chunk), policy))
+            chunk = [foreign]
+            policy = compactPolicy(makePolicy(user, [], chunk))
+        if policy is None:
+            policy = compactPolicy(makePolicy(user, workspaces, chunk))
+        cached.append((tuple(w.id for w, _ in chunk), policy))
+        compiled_policies.set((user.id, key), cached)
+    return [([by_id[i] for i in ids], policy) for ids, policy in cached]
+
+
+def hashPolicy(policy: PolicyDoc) -> str:
+    """Stable hash of a policy document, independent of key order"""
+    canonical = json.dumps(policy, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
 def makeEmptyPolicy():
     return {
         "Version": "2012-10-17",
@@ -0,0 +1,4 @@
+"""
+Async Python client for the Workspaces API
+"""
+from .client import ApiError, AsyncWioClient
@@ -0,0 +1,397 @@
+import asyncio
+import random
+import uuid
+import zlib
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Literal,
+    Optional,
+    Sequence,
+    Type,
+    TypeVar,
+    Union,
+    overload,
+)
+
+import httpx
+from pydantic import BaseModel, parse_obj_as
+
+from workspacesio.common import indexing_schemas, schemas
+
+T = TypeVar("T")
+U = TypeVar("U")
+
+# Retried for any method: the server did not process the request
+RETRY_ALWAYS = {429, 503}
+# Retried only for methods that are safe to repeat
+RETRY_IDEMPOTENT = {502, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE", "OPTIONS"}
+
+
+class ApiError(Exception):
+    """A non-2xx response from the Workspaces API"""
+
+    def __init__(self, response: httpx.Response):
+        self.response = response
+        self.status_code = response.status_code
+        try:
+            self.detail: Any = response.json().get("detail", response.text)
+        except ValueError:
+            self.detail = response.text
+        super().__init__(
+            f"{response.request.method} {response.request.url}: "
+            f"{self.status_code} {self.detail}"
+        )
+
+
+class AsyncWioClient:
+    """
+    Async client for the Workspaces API.
+
+    One instance holds a pool of keep-alive connections; use it as an async
+    context manager, or call aclose() when done.  At most `concurrency` requests
+    are in flight at once, no matter how many coroutines share the client.
+
+    :param api_url: base url of the API, e.g. http://localhost:8100/api
+    :param concurrency: maximum requests in flight, and pooled connections
+    :param retries: attempts after the first for retryable failures
+    :param backoff: base delay in seconds, doubled on every attempt
+    """
+
+    def __init__(
+        self,
+        api_url: str,
+        access_key: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        concurrency: int = 16,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 30,
+    ):
+        auth = None
+        if access_key and secret_key:
+            auth = httpx.BasicAuth(access_key, secret_key)
+        self.http = httpx.AsyncClient(
+            base_url=f'{api_url.rstrip("/")}/',
+            auth=auth,
+            headers={"User-agent": "wio", "Accept": "application/json"},
+            limits=httpx.Limits(
+                max_connections=concurrency, max_keepalive_connections=concurrency
+            ),
+            timeout=timeout,
+        )
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        # Created on first use, inside the running event loop
+        self.semaphore: Optional[asyncio.Semaphore] = None
+
+    @classmethod
+    def from_config(cls, cfg, **kwargs) -> "AsyncWioClient":
+        """From a CLI config, or anything with api_url, access_key and secret_key"""
+        return cls(cfg.api_url, cfg.access_key, cfg.secret_key, **kwargs)
+
+    async def __aenter__(self) -> "AsyncWioClient":
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    def _delay(self, attempt: int, response: Optional[httpx.Response]) -> float:
+        if response is not None:
+            try:
+                return float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                pass
+        delay = self.backoff * (2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        body: Optional[Union[BaseModel, Any]] = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> httpx.Response:
+        """Send a request, retrying transient failures, and raise ApiError on error"""
+        method = method.upper()
+        idempotent = method in IDEMPOTENT_METHODS
+        kwargs: Dict[str, Any] = {}
+        if isinstance(body, BaseModel):
+            kwargs["content"] = body.json()
+            kwargs["headers"] = {"Content-Type": "application/json"}
+        elif body is not None:
+            kwargs["json"] = body
+        if params is not None:
+            kwargs["params"] = {k: v for k, v in params.items() if v is not None}
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        attempt = 0
+        while True:
+            response: Optional[httpx.Response] = None
+            try:
+                async with self.semaphore:
+                    response = await self.http.request(method, path, **kwargs)
+            except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout):
+                # Never reached the server
+                if attempt >= self.retries:
+                    raise
+            except httpx.TransportError:
+                if not idempotent or attempt >= self.retries:
+                    raise
+            else:
+                retryable = response.status_code in RETRY_ALWAYS or (
+                    idempotent and response.status_code in RETRY_IDEMPOTENT
+                )
+                if not retryable or attempt >= self.retries:
+                    if response.is_error:
+                        raise ApiError(response)
+                    return response
+            await asyncio.sleep(self._delay(attempt, response))
+            attempt += 1
+
+    async def _parse(
+        self,
+        model: Type[T],
+        method: str,
+        path: str,
+        body: Optional[Union[BaseModel, Any]] = None,
+        params: Optional[Dict[str, Any]] = None,
+    ) -> T:
+        response = await self.request(method, path, body=body, params=params)
+        return parse_obj_as(model, response.json())
+
+    @overload
+    async def map(
+        self,
+        func: Callable[[T], Awaitable[U]],
+        items: Iterable[T],
+        return_exceptions: Literal[False] = False,
+    ) -> List[U]:
+        ...
+
+    @overload
+    async def map(
+        self,
+        func: Callable[[T], Awaitable[U]],
+        items: Iterable[T],
+        return_exceptions: bool,
+    ) -> List[Union[U, BaseException]]:
+        ...
+
+    async def map(self, func, items, return_exceptions=False):
+        """
+        Run func over items concurrently, returning results in order.
+        Concurrency is bounded by the client, so items can be arbitrarily many.
+        With return_exceptions, failures are returned in place of results
+        instead of raised.
+        """
+        return await asyncio.gather(
+            *[func(item) for item in items], return_exceptions=return_exceptions
+        )
+
+    # Info and users
+
+    async def info(self) -> schemas.ServerInfo:
+        return await self._parse(schemas.ServerInfo, "GET", "info")
+
+    async def me(self) -> schemas.UserDB:
+        return await self._parse(schemas.UserDB, "GET", "user/me")
+
+    async def list_users(self) -> List[schemas.UserDB]:
+        return await self._parse(List[schemas.UserDB], "GET", "user")
+
+    # Nodes and roots
+
+    async def list_nodes(self) -> List[schemas.StorageNodeDB]:
+        return await self._parse(List[schemas.StorageNodeDB], "GET", "node")
+
+    async def list_roots(
+        self, node_name: Optional[str] = None
+    ) -> List[schemas.WorkspaceRootDB]:
+        return await self._parse(
+            List[schemas.WorkspaceRootDB],
+            "GET",
+            "root",
+            params={"node_name": node_name},
+        )
+
+    async def start_root_import(self, root_id: uuid.UUID) -> schemas.RootCredentials:
+        return await self._parse(
+            schemas.RootCredentials, "POST", f"root/{root_id}/import"
+        )
+
+    # Workspaces
+
+    async def list_workspaces(
+        self,
+        name: Optional[str] = None,
+        owner_id: Optional[str] = None,
+        like: Optional[str] = None,
+        public: Optional[bool] = None,
+    ) -> List[schemas.WorkspaceDB]:
+        return await self._parse(
+            List[schemas.WorkspaceDB],
+            "GET",
+            "workspace",
+            params={"name": name, "owner_id": owner_id, "like": like, "public": public},
+        )
+
+    async def get_workspace(self, workspace_id: uuid.UUID) -> schemas.WorkspaceDB:
+        return await self._parse(
+            schemas.WorkspaceDB, "GET", f"workspace/{workspace_id}"
+        )
+
+    async def create_workspace(
+        self, workspace: schemas.WorkspaceCreate
+    ) -> schemas.WorkspaceDB:
+        return await self._parse(schemas.WorkspaceDB, "POST", "workspace", workspace)
+
+    async def create_workspaces(
+        self, workspaces: Sequence[schemas.WorkspaceCreate], exist_ok: bool = False
+    ) -> List[Optional[schemas.WorkspaceDB]]:
+        """
+        Create many workspaces concurrently.  With exist_ok, workspaces that
+        already exist are returned as None instead of raising.
+        """
+
+        async def create(
+            workspace: schemas.WorkspaceCreate,
+        ) -> Optional[schemas.WorkspaceDB]:
+            try:
+                return await self.create_workspace(workspace)
+            except ApiError as e:
+                if exist_ok and e.status_code == 409:
+                    return None
+                raise
+
+        return await self.map(create, workspaces)
+
+    async def delete_workspace(self, workspace_id: uuid.UUID):
+        await self.request("DELETE", f"workspace/{workspace_id}")
+
+    async def create_share(self, share: schemas.ShareCreate) -> schemas.ShareDB:
+        return await self._parse(schemas.ShareDB, "POST", "workspace/share", share)
+
+    # Tokens
+
+    async def list_tokens(self) -> List[schemas.S3TokenDB]:
+        return await self._parse(List[schemas.S3TokenDB], "GET", "token")
+
+    async def create_token(
+        self, token: schemas.S3TokenCreate
+    ) -> List[schemas.S3TokenDB]:
+        return await self._parse(List[schemas.S3TokenDB], "POST", "token", token)
+
+    async def search_tokens(self, terms: List[str]) -> schemas.S3TokenSearchResponse:
+        return await self._parse(
+            schemas.S3TokenSearchResponse,
+            "POST",
+            "token/search",
+            schemas.S3TokenSearch(search_terms=terms),
+        )
+
+    # Indexing
+
+    async def create_crawl(
+        self, workspace_id: uuid.UUID
+    ) -> indexing_schemas.WorkspaceCrawlRoundResponse:
+        return await self._parse(
+            indexing_schemas.WorkspaceCrawlRoundResponse,
+            "POST",
+            f"workspace/{workspace_id}/crawl",
+        )
+
+    async def bulk_index(
+        self, workspace_id: uuid.UUID, body: indexing_schemas.IndexBulkAdd
+    ) -> indexing_schemas.IndexBulkAddedResponse:
+        return await self._parse(
+            indexing_schemas.IndexBulkAddedResponse,
+            "POST",
+            f"workspace/{workspace_id}/bulk_index",
+            body,
+        )
+
+    async def bulk_index_batches(
+        self,
+        workspace_id: uuid.UUID,
+        documents: Sequence[indexing_schemas.IndexDocumentBase],
+        batch_size: int = 1000,
+    ) -> List[indexing_schemas.IndexBulkAddedResponse]:
+        """
+        Post documents in batches of batch_size, concurrently.  The crawl
+        round's totals add up however the batches interleave, but batches may
+        finish in any order, so crawls that record progress through
+        last_indexed_key should call bulk_index in sequence instead.
+        """
+        batches = [
+            indexing_schemas.IndexBulkAdd(
+                workspace_id=workspace_id,
+                documents=batch,
+                last_indexed_key=batch[-1].path,
+                succeeded=False,
+            )
+            for batch in (
+                list(documents[start : start + batch_size])
+                for start in range(0, len(documents), batch_size)
+            )
+        ]
+        return await self.map(
+            lambda batch: self.bulk_index(workspace_id, batch), batches
+        )
+
+    async def bulk_index_stream(
+        self,
+        workspace_id: uuid.UUID,
+        documents: Union[
+            Iterable[indexing_schemas.IndexDocumentBase],
+            AsyncIterable[indexing_schemas.IndexDocumentBase],
+        ],
+        last_indexed_key: Optional[str] = None,
+        succeeded: bool = False,
+    ) -> indexing_schemas.IndexBulkAddedResponse:
+        """
+        Stream any number of documents in one gzip compressed NDJSON request.
+        Streams can't be replayed, so this request is never retried.
+        """
+
+        async def body() -> AsyncIterator[bytes]:
+            compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+            if isinstance(documents, AsyncIterable):
+                async for doc in documents:
+                    yield compressor.compress(doc.json().encode("utf-8") + b"\n")
+            else:
+                for doc in documents:
+                    yield compressor.compress(doc.json().encode("utf-8") + b"\n")
+            yield compressor.flush()
+
+        params: Dict[str, Any] = {"succeeded": succeeded}
+        if last_indexed_key is not None:
+            params["last_indexed_key"] = last_indexed_key
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+        async with self.semaphore:
+            response = await self.http.post(
+                f"workspace/{workspace_id}/bulk_index/stream",
+                content=body(),
+                params=params,
+                headers={
+                    "Content-Type": "application/x-ndjson",
+                    "Content-Encoding": "gzip",
+                },
+                # Long lived: only the gaps between chunks are bounded
+                timeout=httpx.Timeout(self.http.timeout.read, write=None),
+            )
+        if response.is_error:
+            raise ApiError(response)
+        return indexing_schemas.IndexBulkAddedResponse(**response.json())
@@ -0,0 +1,317 @@
+"""
+fsspec filesystem for wio://username/workspace/path urls, so that pandas,
+xarray, dask and pyarrow can read and write workspaces directly:
+
+    pandas.read_parquet("wio://alice/experiments/run1.parquet")
+
+Workspaces are resolved and S3 credentials issued through token/search.  The
+results are cached for the life of the filesystem instance and fetched again
+shortly before the credentials expire.  Data moves through one s3fs filesystem
+per set of credentials, so block caching, readahead and concurrent cat() work
+as they do for s3:// urls.
+
+Requires the optional dependencies: pip install workspacesio[fsspec]
+"""
+import os
+import posixpath
+import threading
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, NamedTuple, Optional, Tuple
+
+import s3fs
+from fsspec import AbstractFileSystem
+
+from workspacesio.cli import WioSession, config, transfer
+from workspacesio.common import s3utils, schemas
+
+# Credentials are replaced this long before they expire
+EXPIRY_MARGIN = timedelta(minutes=5)
+
+
+class Mount(NamedTuple):
+    """Where a username/workspace term lives, and credentials to reach it"""
+
+    s3: s3fs.S3FileSystem
+    # bucket/workspace key, without a trailing slash
+    base: str
+    expiration: Optional[datetime]
+
+
+class WioFileSystem(AbstractFileSystem):
+    """
+    Connection settings not given are found the same way as by the wio CLI.
+
+    :param api_url: defaults to WIO_ENDPOINT_URL, then the wio CLI config
+    :param access_key: defaults to the wio CLI config
+    :param secret_key: defaults to the wio CLI config
+    :param s3_options: extra keyword arguments for each s3fs.S3FileSystem
+    """
+
+    protocol = "wio"
+    root_marker = ""
+
+    def __init__(
+        self,
+        api_url: Optional[str] = None,
+        access_key: Optional[str] = None,
+        secret_key: Optional[str] = None,
+        s3_options: Optional[Dict[str, Any]] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        cfg = config.load(api_url)
+        cfg.access_key = access_key or cfg.access_key
+        cfg.secret_key = secret_key or cfg.secret_key
+        self.session = WioSession(cfg)
+        self.s3_options = s3_options or {}
+        self.mounts: Dict[str, Mount] = {}
+        self.lock = threading.Lock()
+
+    @classmethod
+    def _strip_protocol(cls, path):
+        if isinstance(path, list):
+            return [cls._strip_protocol(p) for p in path]
+        return super()._strip_protocol(path).strip("/")
+
+    @staticmethod
+    def _split(path: str) -> Tuple[str, str]:
+        """username/workspace/rest -> (username/workspace, rest)"""
+        parts = path.split("/", 2)
+        if len(parts) < 2 or not all(parts[:2]):
+            raise ValueError(
+                f"wio paths look like wio://username/workspace/...: {path}"
+            )
+        return "/".join(parts[:2]), parts[2] if len(parts) > 2 else ""
+
+    def _request(self, method: str, path: str, **kwargs) -> Any:
+        r = self.session.request(method, path, **kwargs)
+        if r.status_code in [401, 403]:
+            raise PermissionError(r.text)
+        r.raise_for_status()
+        return r.json()
+
+    def _fresh(self, mount: Optional[Mount]) -> bool:
+        return mount is not None and (
+            mount.expiration is None
+            or mount.expiration - EXPIRY_MARGIN > datetime.utcnow()
+        )
+
+    def _resolve(self, terms: Iterable[str]) -> Dict[str, Mount]:
+        """Mounts for username/workspace terms, in one token/search for any misses"""
+        terms = set(terms)
+        with self.lock:
+            missing = [t for t in terms if not self._fresh(self.mounts.get(t))]
+            if missing:
+                response = schemas.S3TokenSearchResponse(
+                    **self._request(
+                        "POST", "token/search", json={"search_terms": missing}
+                    )
+                )
+                filesystems: Dict[str, s3fs.S3FileSystem] = {}
+                for term in missing:
+                    match = response.workspaces.get(term)
+                    if match is None:
+                        self.mounts.pop(term, None)
+                        continue
+                    try:
+                        wrapper = transfer.token_for(response, match.workspace)
+                    except transfer.TransferError as e:
+                        raise PermissionError(str(e))
+                    key = wrapper.token.access_key_id
+                    if key not in filesystems:
+                        filesystems[key] = self._s3(wrapper)
+                    self.mounts[term] = Mount(
+                        s3=filesystems[key],
+                        base=posixpath.join(
+                            match.workspace.root.bucket,
+                            s3utils.getWorkspaceKey(match.workspace),
+                        ).rstrip("/"),
+                        expiration=wrapper.token.expiration,
+                    )
+            found = {t: self.mounts[t] for t in terms if t in self.mounts}
+        for term in terms - set(found):
+            raise FileNotFoundError(f"No workspace matches {term}")
+        return found
+
+    def _s3(self, wrapper: schemas.TokenNodeWrapper) -> s3fs.S3FileSystem:
+        return s3fs.S3FileSystem(
+            key=wrapper.token.access_key_id,
+            secret=wrapper.token.secret_access_key,
+            token=wrapper.token.session_token,
+            client_kwargs={
+                "endpoint_url": wrapper.node.api_url,
+                "region_name": wrapper.node.region_name,
+            },
+            skip_instance_cache=True,
+            **self.s3_options,
+        )
+
+    def _locate(self, path: str) -> Tuple[str, Mount, str]:
+        """(username/workspace, mount, bucket/key) for a wio path"""
+        term, rest = self._split(self._strip_protocol(path))
+        mount = self._resolve([term])[term]
+        return term, mount, posixpath.join(mount.base, rest).rstrip("/")
+
+    @staticmethod
+    def _to_wio(term: str, mount: Mount, name: str) -> str:
+        return posixpath.join(term, name[len(mount.base) :].strip("/")).rstrip("/")
+
+    def _entry(self, term: str, mount: Mount, entry: Dict[str, Any]):
+        return {**entry, "name": self._to_wio(term, mount, entry["name"])}
+
+    # Listing
+
+    def _ls_workspaces(self, path: str, detail: bool):
+        """Listing above the workspace level: users, or their workspaces"""
+        workspaces = [
+            schemas.WorkspaceDB(**w) for w in self._request("GET", "workspace")
+        ]
+        if path == "":
+            names = sorted(set(w.owner.username for w in workspaces))
+        else:
+            names = sorted(
+                f"{w.owner.username}/{w.name}"
+                for w in workspaces
+                if w.owner.username == path
+            )
+            if not names:
+                raise FileNotFoundError(path)
+        if detail:
+            return [{"name": n, "type": "directory", "size": 0} for n in names]
+        return names
+
+    def ls(self, path, detail=True, **kwargs):
+        path = self._strip_protocol(path)
+        if path.count("/") < 1:
+            return self._ls_workspaces(path, detail)
+        term, mount, s3path = self._locate(path)
+        entries = mount.s3.ls(s3path, detail=True, **kwargs)
+        entries = [self._entry(term, mount, e) for e in entries]
+        if detail:
+            return entries
+        return [e["name"] for e in entries]
+
+    def find(self, path, maxdepth=None, withdirs=False, detail=False, **kwargs):
+        path = self._strip_protocol(path)
+        if path.count("/") < 1:
+            return super().find(
+                path, maxdepth=maxdepth, withdirs=withdirs, detail=detail, **kwargs
+            )
+        term, mount, s3path = self._locate(path)
+        found = mount.s3.find(
+            s3path, maxdepth=maxdepth, withdirs=withdirs, detail=True, **kwargs
+        )
+        entries = {
+            self._to_wio(term, mount, name): self._entry(term, mount, e)
+            for name, e in found.items()
+        }
+        if detail:
+            return entries
+        return sorted(entries)
+
+    def info(self, path, **kwargs):
+        path = self._strip_protocol(path)
+        if path.count("/") < 1:
+            self._ls_workspaces(path, detail=False)
+            return {"name": path, "type": "directory", "size": 0}
+        term, mount, s3path = self._locate(path)
+        if s3path == mount.base:
+            # A workspace is a directory, even while it is empty
+            return {"name": term, "type": "directory", "size": 0}
+        return self._entry(term, mount, mount.s3.info(s3path, **kwargs))
+
+    def invalidate_cache(self, path=None):
+        super().invalidate_cache(path)
+        for mount in list(self.mounts.values()):
+            mount.s3.invalidate_cache()
+
+    # Reading and writing
+
+    def _open(
+        self,
+        path,
+        mode="rb",
+        block_size=None,
+        autocommit=True,
+        cache_options=None,
+        **kwargs,
+    ):
+        _, mount, s3path = self._locate(path)
+        return mount.s3.open(
+            s3path,
+            mode,
+            block_size=block_size,
+            autocommit=autocommit,
+            cache_options=cache_options,
+            **kwargs,
+        )
+
+    def cat_file(self, path, start=None, end=None, **kwargs):
+        _, mount, s3path = self._locate(path)
+        return mount.s3.cat_file(s3path, start=start, end=end, **kwargs)
+
+    def cat(self, path, recursive=False, on_error="raise", **kwargs):
+        """
+        Fetch many objects concurrently.  Credentials for every workspace
+        involved are resolved in one request, then each storage node's
+        objects are fetched in one concurrent batch.
+        """
+        paths = self.expand_path(path, recursive=recursive)
+        if recursive:
+            # Skip the directories that find() contributed
+            parents = {posixpath.dirname(p) for p in paths}
+            paths = [p for p in paths if p not in parents]
+        terms = {self._split(p)[0] for p in paths}
+        mounts = self._resolve(terms)
+        # s3fs instance -> (s3fs, {bucket/key: wio path})
+        batches: Dict[int, Tuple[s3fs.S3FileSystem, Dict[str, str]]] = {}
+        for p in paths:
+            term, rest = self._split(p)
+            mount = mounts[term]
+            s3path = posixpath.join(mount.base, rest).rstrip("/")
+            batches.setdefault(id(mount.s3), (mount.s3, {}))[1][s3path] = p
+        out: Dict[str, Any] = {}
+        for s3, names in batches.values():
+            result = s3.cat(list(names), on_error=on_error, **kwargs)
+            out.update((names[s3._strip_protocol(k)], v) for k, v in result.items())
+        if (
+            len(paths) > 1
+            or isinstance(path, list)
+            or paths[0] != self._strip_protocol(path)
+        ):
+            return out
+        return out[paths[0]]
+
+    def pipe_file(self, path, value, **kwargs):
+        _, mount, s3path = self._locate(path)
+        mount.s3.pipe_file(s3path, value, **kwargs)
+
+    def put_file(self, lpath, rpath, callback=None, **kwargs):
+        _, mount, s3path = self._locate(rpath)
+        if os.path.isdir(lpath):
+            return
+        mount.s3.put_file(lpath, s3path, **kwargs)
+
+    def get_file(self, rpath, lpath, callback=None, outfile=None, **kwargs):
+        _, mount, s3path = self._locate(rpath)
+        mount.s3.get_file(s3path, lpath, **kwargs)
+
+    def rm_file(self, path):
+        _, mount, s3path = self._locate(path)
+        mount.s3.rm_file(s3path)
+
+    def _rm(self, path):
+        self.rm_file(path)
+
+    def rm(self, path, recursive=False, maxdepth=None):
+        paths = self.expand_path(path, recursive=recursive, maxdepth=maxdepth)
+        for p in reversed(paths):
+            if self.isfile(p):
+                self.rm_file(p)
+
+    def mkdir(self, path, create_parents=True, **kwargs):
+        # Directories are implied by object keys
+        pass
+
+    def makedirs(self, path, exist_ok=False):
+        pass
@@ -1,5 +1,5 @@
 import os
-from typing import List
+from typing import Dict, List, Optional
 
 from pydantic import BaseSettings
 
@@ -8,14 +8,53 @@ class Settings(BaseSettings):
     public_name: str = "http://localhost:8100"
     database_uri: str = f"postgresql:///wio"
     secret: str = "secret"
+    admins: List[str] = []
+    apikey_pepper: Optional[str] = None
+    apikey_cache_size: int = 4096
+    apikey_cache_ttl: int = 300
 
     es_nodes: List[str] = ["http://localhost:9200"]
+    es_maxsize: int = 10
+    es_timeout: int = 10
+    es_max_retries: int = 3
+    es_retry_on_timeout: bool = True
+    es_sniff: bool = False
+    es_sniffer_timeout: int = 60
+    es_bulk_max_bytes: int = 10 * 1024 * 1024
+    event_resolver_ttl: int = 300
+    event_worker_interval: float = 1
+    event_queue_batch_size: int = 1000
+    event_coalesce_window: float = 2
+    event_max_attempts: int = 10
+
+    s3_client_cache_size: int = 64
+    s3_max_pool_connections: int = 10
+    s3_node_pool_connections: Dict[str, int] = {}
+    s3_client_timeout: float = 10
+    sts_max_workers: int = 8
+    sts_policy_max_bytes: int = 2048
+    policy_cache_size: int = 4096
+    policy_cache_ttl: int = 300
+    token_refresh_interval: int = 60
+    token_refresh_window: int = 900
+    token_refresh_active_window: int = 3600
+    token_refresh_node_concurrency: int = 2
+    token_refresh_jitter: float = 5
+    token_refresh_batch_size: int = 100
+    token_sweep_interval: int = 3600
+    token_sweep_grace: int = 3600
+    token_sweep_batch_size: int = 1000
 
     oidc_name: str = "auth0"
     oidc_client_id: str
     oidc_client_secret: str
     oidc_well_known_url: str
     oidc_algos: List[str] = ["RS256"]
+    oidc_jwks_ttl: int = 3600
+    oidc_timeout: float = 10
+    oidc_max_connections: int = 20
+    session_cache_size: int = 4096
+    session_cache_ttl: int = 300
 
     class Config:
         env_prefix = "wio_"
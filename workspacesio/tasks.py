@@ -0,0 +1,80 @@
+"""
+Background work that runs inside each server process
+"""
+import logging
+import threading
+from typing import Callable, Optional
+
+from . import crud, database, dbutils, depends, settings
+from .indexing import worker
+
+logger = logging.getLogger("tasks")
+
+
+class PeriodicTask:
+    """
+    Run a function every `interval` seconds on a daemon thread until stopped.
+    Exceptions are logged and the task carries on with the next run.
+    """
+
+    def __init__(self, name: str, interval: float, func: Callable[[], None]):
+        self.name = name
+        self.interval = interval
+        self.func = func
+        self.stopped = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.func()
+            except Exception:
+                logger.exception(f"Periodic task {self.name} failed")
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(
+                target=self._run, name=self.name, daemon=True
+            )
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.interval)
+            self.thread = None
+
+
+def refresh_tokens():
+    db = database.SessionLocal(query_cls=dbutils.Query)
+    try:
+        refreshed = crud.token_refresh_expiring(db, depends.boto_client_cache)
+        if refreshed:
+            logger.info(f"Refreshed {refreshed} expiring tokens")
+    finally:
+        db.close()
+
+
+token_refresher = PeriodicTask(
+    "token-refresh", settings.settings.token_refresh_interval, refresh_tokens
+)
+
+
+def sweep_tokens():
+    db = database.SessionLocal(query_cls=dbutils.Query)
+    try:
+        swept = crud.token_sweep_expired(db)
+        if swept:
+            logger.info(f"Deleted {swept} expired tokens")
+    finally:
+        db.close()
+
+
+token_sweeper = PeriodicTask(
+    "token-sweep", settings.settings.token_sweep_interval, sweep_tokens
+)
+
+
+event_worker = PeriodicTask(
+    "event-worker", settings.settings.event_worker_interval, worker.drain_shared
+)